@@ -0,0 +1,253 @@
+import os, asyncio
+from telebot import types, TeleBot
+from telebot.async_telebot import AsyncTeleBot, ExceptionHandler
+from telebot.asyncio_handler_backends import CancelUpdate, ContinueHandling
+from backed_bot_utils import parse_command_string, handle_exception, get_username, mention
+from middlewares import AntiFloodMiddleware
+from image_menu import ImageMenu, PhotoMessageChain, PHOTO_MESSAGE_CHAINS
+from auth_manager import AuthManager
+from preprocess import CommandConfig
+from telegram_outbound import outbound
+from webhook import WebhookServer, WEBHOOK_URL, SKIP_PENDING_UPDATES, get_webhook_kwargs
+
+ASYNC_BRIDGE_SIZE = int(os.environ.get("ASYNC_BRIDGE_SIZE", "1024"))
+background_tasks = set()
+
+def spawn(coroutine):
+    # Keeps a reference so fire-and-forget tasks aren't garbage collected
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def delete_later(bot: AsyncTeleBot, message: types.Message, delay_secs):
+    await asyncio.sleep(delay_secs)
+    try: await bot.delete_message(message.chat.id, message.id)
+    except: pass
+
+class AsyncAntiFloodMiddleware(AntiFloodMiddleware):
+    # Same screening as AntiFloodMiddleware, the spam notice is sent and deleted without holding a thread
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.bot_id = None
+
+    def get_bot_id(self):
+        return self.bot_id
+
+    async def check(self, user_id, message):
+        is_flooding, should_notify = self.is_flooding(user_id, message)
+        if not is_flooding:
+            return ContinueHandling()
+        if should_notify:
+            notify_message = await self.bot.send_message(message.chat.id, f"You are spamming commands. Wait for {self.limit} seconds")
+            self.set_notified(user_id, notify_message)
+            spawn(delete_later(self.bot, notify_message, self.temp_message_delay_sec))
+        return CancelUpdate()
+
+    async def pre_process(self, message: types.Message, data):
+        is_handled, check_flood = self.screen(message)
+        if not is_handled:
+            return CancelUpdate()
+        if check_flood:
+            return await self.check(str(message.from_user.id), message)
+        return ContinueHandling()
+
+    async def post_process(self, message, data, exception):
+        pass
+
+class AsyncWorkerBridge:
+    # Handlers only await a bounded queue, a single task hands the requests to the worker's (locking, sometimes
+    # sending) execute on a thread. The worker keeps delivering outputs with the synchronous bot
+    def __init__(self, bot: TeleBot, worker, maxsize=ASYNC_BRIDGE_SIZE):
+        self.bot = bot
+        self.worker = worker
+        self.queue = asyncio.Queue(maxsize)
+
+    async def submit(self, command_name, message: types.Message, parsed_data, **kwargs):
+        await self.queue.put((command_name, message, parsed_data, kwargs))
+
+    async def run(self):
+        while True:
+            command_name, message, parsed_data, kwargs = await self.queue.get()
+            try:
+                await asyncio.to_thread(self.worker.execute, command_name, message, parsed_data, **kwargs)
+            except:
+                handle_exception(self.bot, message)
+
+class AsyncImageMenu(ImageMenu):
+    # The image menu's interactions on AsyncTeleBot. Outputs are still sent by ImageMenu.finish from the worker
+    def __init__(self, async_bot: AsyncTeleBot, bot: TeleBot, bridge: AsyncWorkerBridge, anti_flood: AsyncAntiFloodMiddleware):
+        self.async_bot = async_bot
+        self.bridge = bridge
+        self.menu_messages: dict[str, types.Message] = {}
+        super().__init__(bot, bridge.worker)
+        self.anti_flood = anti_flood
+
+    async def delete_chain(self, pmc: PhotoMessageChain):
+        if len(pmc.message_chains):
+            await self.async_bot.delete_messages(pmc.orig_message.chat.id, [message.id for message in pmc.message_chains])
+
+    async def close_menu(self, id, delay_secs=0):
+        await asyncio.sleep(delay_secs)
+        menu_message = self.menu_messages.pop(id, None)
+        if menu_message is not None:
+            await delete_later(self.async_bot, menu_message, 0)
+
+    async def image_menu(self, _, message: types.Message, parsed_data: dict):
+        if message.content_type not in ["photo", "video", "animation"]: return
+        if message.chat.type == "private":
+            signal = await self.anti_flood.check(message.from_user.id, message)
+            if isinstance(signal, CancelUpdate): return
+        print(f"Sending image menu to @{get_username(message.from_user)} ({message.from_user.id})")
+        pmc, reply_text, markup = await asyncio.to_thread(self.build_menu, message)
+        self.menu_messages[pmc.id] = await self.async_bot.reply_to(message, reply_text, reply_markup=markup, parse_mode="Markdown")
+        PHOTO_MESSAGE_CHAINS[pmc.id] = pmc
+        spawn(self.close_menu(pmc.id, 30))
+
+    async def enqueue(self, pmc: PhotoMessageChain, form, serialized_form, pbar_message: types.Message):
+        pmc.append(pbar_message)
+        self.free_global_pmc(pmc.id)
+        await self.bridge.submit(
+            form["command"],
+            pmc.orig_message, form,
+            pbar_message=pbar_message,
+            image_output_callback=lambda output: self.finish(form["command"], pmc, serialized_form, output)
+        )
+
+    def create_handlers(self):
+        force_reply = types.ForceReply(selective=False)
+        @self.async_bot.callback_query_handler(func=lambda call: True)
+        async def callback_query(call: types.CallbackQuery):
+            command, id, *args = call.data.split('|')
+            pmc = PHOTO_MESSAGE_CHAINS.get(id)
+            if pmc is None or (call.from_user.id != pmc.orig_message.from_user.id):
+                return
+            if command == "close":
+                await self.close_menu(id)
+                return self.free_global_pmc(id)
+            user_id = str(pmc.orig_message.from_user.id)
+            chat_id = pmc.orig_message.chat.id
+            if command == "get_user_info":
+                text = await asyncio.to_thread(AuthManager.serialize_allowed_users, ["normal", "advanced", "banned"], filer_ids=[user_id])
+                await self.async_bot.send_message(chat_id, text, parse_mode="Markdown")
+                await self.close_menu(id)
+                return self.free_global_pmc(id)
+            if command == "guide":
+                guide = (await asyncio.to_thread(CommandConfig.get_guides))[args[0]]
+                text_message = await self.async_bot.send_message(chat_id, mention(pmc.orig_message.from_user) + '\n' + guide.text, parse_mode="Markdown")
+                if guide.pil_images:
+                    await self.async_bot.send_media_group(
+                        chat_id,
+                        [types.InputMediaPhoto(pil_image) for pil_image in guide.pil_images],
+                        reply_to_message_id=text_message.id
+                    )
+                await self.close_menu(id)
+                return self.free_global_pmc(id)
+            if pmc.orig_message.chat.type != "private":
+                signal = await self.anti_flood.check(call.from_user.id, call.message)
+                if isinstance(signal, CancelUpdate): return self.free_global_pmc(id)
+            if self.does_return_original(pmc, command):
+                pmc.append(pmc.orig_message)
+
+            reply_text = self.use_command(pmc, command)
+            if reply_text is not None:
+                notify_message = await self.async_bot.send_message(chat_id, reply_text, parse_mode="Markdown")
+                spawn(delete_later(self.async_bot, notify_message, 10))
+                return
+
+            print(f"@{get_username(call.from_user)} ({call.from_user.id}) called {command}")
+            serialized_form, form, reply_text = await asyncio.to_thread(self.build_form, pmc, command)
+            if reply_text is not None:
+                pmc.append(await self.async_bot.send_message(chat_id, reply_text, reply_markup=force_reply, parse_mode="Markdown"))
+            else:
+                await self.delete_chain(pmc)
+                pbar_message = await self.async_bot.send_message(chat_id, f"{mention(pmc.orig_message.from_user)} Queuing...", parse_mode="Markdown")
+                await self.enqueue(pmc, form, serialized_form, pbar_message)
+
+        @self.async_bot.message_handler(func=lambda message: message.reply_to_message is not None and not (message.text or '').startswith("/get_ids"),
+                                        content_types=["text", "photo", "video", "animation"])
+        async def input_chain(message: types.Message):
+            input_chain = self.get_input_chain(message)
+            if input_chain is None: return
+            pmc, query, form, form_types = input_chain
+            pmc.append(message)
+            try:
+                reply_text, is_complete, serialized_form = self.fill_form(pmc, query, form, form_types, message)
+            except ValueError as e:
+                await self.async_bot.send_message(message.chat.id, str(e))
+                return await self.delete_chain(pmc)
+
+            if not is_complete:
+                pmc.append(
+                    await self.async_bot.send_message(pmc.orig_message.chat.id, reply_text, reply_markup=force_reply, parse_mode="Markdown")
+                )
+            else:
+                await self.delete_chain(pmc)
+                pbar_message = await self.async_bot.send_message(pmc.orig_message.chat.id, reply_text, parse_mode="Markdown")
+                await self.enqueue(pmc, form, serialized_form, pbar_message)
+
+class AsyncExceptionHandler(ExceptionHandler):
+    def __init__(self, bot: TeleBot):
+        self.bot = bot
+
+    def handle(self, exception):
+        handle_exception(self.bot)
+        return True
+
+class AsyncFrontend:
+    # Receives and answers updates on one event loop. Special commands, which block on the database and the
+    # synchronous bot, run on threads; everything else awaits
+    def __init__(self, bot: TeleBot, worker, special_commands: dict, free_commands: list, anti_flood_kwargs: dict, enable_commands=False, admin_user_id=''):
+        self.bot = bot
+        self.async_bot = AsyncTeleBot(bot.token, parse_mode=None, exception_handler=AsyncExceptionHandler(bot))
+        self.anti_flood = AsyncAntiFloodMiddleware(bot=self.async_bot, **anti_flood_kwargs)
+        self.bridge = AsyncWorkerBridge(bot, worker)
+        @self.async_bot.callback_query_handler(func=lambda call: call.data.startswith("users|"))
+        async def page_users(call: types.CallbackQuery):
+            await asyncio.to_thread(AuthManager.page_users, bot, call)
+        self.image_menu = AsyncImageMenu(self.async_bot, bot, self.bridge, self.anti_flood)
+        self.special_commands = special_commands
+        self.free_commands = free_commands
+        self.enable_commands = enable_commands
+        self.admin_user_id = admin_user_id
+        self.create_handlers()
+
+    def create_handlers(self):
+        @self.async_bot.message_handler(["get_ids"], content_types=["text"])
+        async def get_ids(message: types.Message):
+            if message.reply_to_message is not None and str(message.from_user.id) == self.admin_user_id:
+                _message = message.reply_to_message
+            else:
+                _message = message
+            await self.async_bot.reply_to(message, f"Chat ID: {_message.chat.id}, User ID: {_message.from_user.id}")
+
+        @self.async_bot.message_handler(func=lambda message: message.reply_to_message is None, content_types=["text", "photo", "video", "animation"])
+        async def main(message: types.Message):
+            text = message.caption if message.content_type in ['photo', 'video', 'animation'] else message.text
+            if (message.content_type in ['photo', 'video', 'animation']) and (text is None or len(text.strip()) == 0):
+                return await self.image_menu.image_menu(self.async_bot, message, {"prompt": ''})
+            command_name = text.strip().split()[0][1:] # Extract command name without '/'
+            parsed_data = parse_command_string(text, command_name)
+            if command_name in self.free_commands: return
+            print(f"Executing command {command_name}")
+            if command_name == "image_menu":
+                await self.image_menu.image_menu(self.async_bot, message, parsed_data)
+            elif command_name in self.special_commands:
+                await asyncio.to_thread(self.special_commands[command_name], self.bot, message, parsed_data)
+            elif self.enable_commands:
+                await self.bridge.submit(command_name, message, parsed_data)
+
+    async def run(self):
+        outbound.install_async()
+        self.anti_flood.bot_id = (await self.async_bot.get_me()).id
+        self.async_bot.setup_middleware(self.anti_flood)
+        spawn(self.bridge.run())
+        if WEBHOOK_URL:
+            await self.async_bot.set_webhook(**get_webhook_kwargs())
+            loop = asyncio.get_running_loop()
+            # The consumer thread waits for each batch, so the webhook queue still pushes back on Telegram
+            WebhookServer(lambda updates: asyncio.run_coroutine_threadsafe(self.async_bot.process_new_updates(updates), loop).result()).start()
+            await asyncio.Event().wait()
+        else:
+            await self.async_bot.delete_webhook()
+            await self.async_bot.infinity_polling(skip_pending=bool(SKIP_PENDING_UPDATES))
@@ -1,21 +1,31 @@
 from telebot import types, TeleBot
-from backed_bot_utils import get_username, get_sqldict_db
-import schedule, os
+from telebot.apihelper import ApiTelegramException
+from backed_bot_utils import get_username, get_sqldict_db, get_auth_db_path
+import os, atexit, threading, time, math, pickle, sqlite3
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from preprocess import analyze_argument_from_preprocessed
+from metrics import CACHE_LOOKUPS
 from dataclasses import dataclass, field
 from time import sleep
 
 ADMIN_USER_ID = os.environ.get("ADMIN_USER_ID", '')
 COMMAND_IS_ADVANCED = bool(int(os.environ.get("COMMAND_IS_ADVANCED", '1')))
+USERS_FLUSH_SECS = float(os.environ.get("USERS_FLUSH_SECS", "2")) # Longest a user change waits before being committed
+USERS_PAGE_SIZE = int(os.environ.get("USERS_PAGE_SIZE", "20"))
+USER_STATUSES = ["normal", "advanced", "banned"]
 
 @dataclass
 class AdvancedInfo:
     start_date: datetime
     duration_days: float
 
+    def get_revoke_at(self):
+        return self.start_date.timestamp() + self.duration_days * 86400
+
 class DefaultNormalUses:
     default_normal_uses = get_sqldict_db("default_normal_uses")
+    value = None
 
     @classmethod
     def warmup(cls):
@@ -24,11 +34,14 @@ class DefaultNormalUses:
     
     @classmethod
     def get(cls):
-        return int(cls.default_normal_uses["value"])
+        if cls.value is None:
+            cls.value = int(cls.default_normal_uses["value"])
+        return cls.value
     
     @classmethod
     def set(cls, new_default: int):
         cls.default_normal_uses["value"] = int(new_default)
+        cls.value = int(new_default)
 
 @dataclass
 class UserInfo:
@@ -38,37 +51,316 @@ class UserInfo:
     remain_normal_uses: int = field(default_factory=DefaultNormalUses.get)
     advanced_info: AdvancedInfo = None
 
-class AutoRevokeAdvanced:
-    jobs: dict[str, schedule.Job] = {}
+class UserTable:
+    # Users as rows, indexed by status, revoke time and name. The pickled allowed_users SqliteDict table it replaces
+    # is migrated in one transaction on first use and kept as allowed_users_legacy
+    def __init__(self, path, legacy_table="allowed_users"):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL COLLATE NOCASE,
+                status TEXT NOT NULL,
+                is_allowed INTEGER NOT NULL,
+                remain_normal_uses INTEGER NOT NULL,
+                advanced_start REAL,
+                advanced_days REAL,
+                revoke_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS users_status ON users(status, advanced_days);
+            CREATE INDEX IF NOT EXISTS users_revoke_at ON users(revoke_at) WHERE revoke_at IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS users_name ON users(name);
+        """)
+        self.migrate(legacy_table)
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def migrate(self, legacy_table):
+        tables = [row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        if legacy_table not in tables: return
+        with self.transaction() as conn:
+            rows = conn.execute(f'SELECT key, value FROM "{legacy_table}"').fetchall()
+            conn.executemany(
+                "INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [self.to_row(pickle.loads(bytes(value))) for _, value in rows]
+            )
+            conn.execute(f'ALTER TABLE "{legacy_table}" RENAME TO "{legacy_table}_legacy"')
+        print(f"Migrated {len(rows)} users from the {legacy_table} table")
+
+    @staticmethod
+    def get_status(user_info: UserInfo):
+        if not user_info.is_allowed: return "banned"
+        return "normal" if user_info.advanced_info is None else "advanced"
+
     @classmethod
-    def create_job(cls, allowed_users: dict[str, UserInfo], user_id: str):
-        def job_func(user_id):
-            allowed_users: dict[str, UserInfo] = AuthManager.allowed_users
-            if user_id in allowed_users:
-                AuthManager.update_user_info(user_id, advanced_info=None)
-            else:
-                print(f"Advanced user {user_id} is already revoked")
-            del cls.jobs[user_id]
-            return schedule.CancelJob
-        
-        if user_id not in allowed_users or allowed_users[user_id].advanced_info is None:
-            return cls.cancel(user_id)
-        advanced_info = allowed_users[user_id].advanced_info
-        revoke_date = advanced_info.start_date + timedelta(days=advanced_info.duration_days)
-        remain_seconds = (revoke_date - datetime.now()).total_seconds()
-        if remain_seconds < 0:
-            AuthManager.update_user_info(user_id, advanced_info=None)
-            return cls.cancel(user_id)
-        cls.jobs[user_id] = schedule.every(remain_seconds).seconds.do(job_func, user_id)
-        return cls.jobs[user_id]
-    
+    def to_row(cls, user_info: UserInfo):
+        advanced_info = user_info.advanced_info
+        advanced_start = advanced_days = revoke_at = None
+        if advanced_info is not None:
+            advanced_start, advanced_days = advanced_info.start_date.timestamp(), float(advanced_info.duration_days)
+            revoke_at = advanced_info.get_revoke_at()
+        return (
+            user_info.id, user_info.name, cls.get_status(user_info), int(user_info.is_allowed),
+            int(user_info.remain_normal_uses), advanced_start, advanced_days, revoke_at
+        )
+
+    @staticmethod
+    def from_row(row):
+        id, name, _, is_allowed, remain_normal_uses, advanced_start, advanced_days, _ = row
+        advanced_info = None
+        if advanced_start is not None:
+            advanced_info = AdvancedInfo(datetime.fromtimestamp(advanced_start), advanced_days)
+        return UserInfo(id, name, bool(is_allowed), remain_normal_uses, advanced_info)
+
+    def get(self, user_id, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        return default if row is None else self.from_row(row)
+
+    def items(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM users ORDER BY rowid").fetchall()
+        return [(row[0], self.from_row(row)) for row in rows]
+
+    def write(self, changes: dict[str, UserInfo]):
+        # Upserts users and deletes those mapped to None, all or nothing
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [self.to_row(user_info) for user_info in changes.values() if user_info is not None]
+            )
+            conn.executemany("DELETE FROM users WHERE id = ?", [(user_id,) for user_id, user_info in changes.items() if user_info is None])
+
+    def select(self, status=None, ids=None, name=None, offset=0, limit=-1):
+        conditions, params = [], []
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if ids is not None:
+            conditions.append(f"id IN ({', '.join('?' * len(ids))})")
+            params.extend(ids)
+        if name is not None:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            params.append(name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = "advanced_days DESC" if status == "advanced" else "rowid"
+        with self.lock:
+            rows = self.conn.execute(f"SELECT * FROM users {where} ORDER BY {order} LIMIT ? OFFSET ?", (*params, limit, offset)).fetchall()
+        return [self.from_row(row) for row in rows]
+
+    def count(self, status=None):
+        with self.lock:
+            if status is None: return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            return self.conn.execute("SELECT COUNT(*) FROM users WHERE status = ?", (status,)).fetchone()[0]
+
+    def get_next_revoke_at(self):
+        with self.lock:
+            return self.conn.execute("SELECT MIN(revoke_at) FROM users WHERE revoke_at IS NOT NULL").fetchone()[0]
+
+    def get_expired_ids(self, now):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT id FROM users WHERE revoke_at <= ?", (now,))]
+
+    def rename_users(self, old_name, new_name):
+        with self.transaction() as conn:
+            return conn.execute("UPDATE users SET name = ? WHERE name = ?", (new_name, old_name)).rowcount
+
+    def set_all_normal_uses(self, uses):
+        with self.transaction() as conn:
+            return conn.execute("UPDATE users SET remain_normal_uses = ?", (int(uses),)).rowcount
+
+    def delete_all(self):
+        with self.transaction() as conn:
+            return conn.execute("DELETE FROM users").rowcount
+
+class CachedUsers:
+    # Dict-like cache in front of the users table. Each user is read once (misses are remembered too), writes
+    # update the cache and are committed together every USERS_FLUSH_SECS and at exit. A batch is a single
+    # SQLite transaction, so a crash loses at most the last few seconds of changes, never part of a batch
+    def __init__(self, db: UserTable, flush_secs=USERS_FLUSH_SECS):
+        self.db = db
+        self.lock = threading.RLock()
+        self.flush_lock = threading.RLock()
+        self.cache: dict[str, UserInfo] = {}
+        self.missing: set[str] = set()
+        self.dirty: dict[str, UserInfo] = {} # None for deleted users
+        self.is_complete = False
+        self.stats = {"hits": 0, "misses": 0, "flushes": 0}
+        if flush_secs > 0:
+            threading.Thread(target=self.flush_loop, args=(flush_secs,), daemon=True).start()
+        atexit.register(self.flush)
+
+    def load(self, user_id: str):
+        with self.lock:
+            if user_id in self.cache: return self.cache[user_id]
+            if user_id in self.missing: return None
+            self.stats["misses"] += 1
+            if user_id in self.dirty: user_info = self.dirty[user_id]
+            else: user_info = self.db.get(user_id, None)
+            if user_info is None: self.missing.add(user_id)
+            else: self.cache[user_id] = user_info
+            return user_info
+
+    def get(self, user_id, default=None):
+        user_info = self.cache.get(user_id)
+        if user_info is None:
+            user_info = self.load(user_id)
+        else:
+            self.stats["hits"] += 1
+        if user_info is None:
+            return default
+        if user_info.advanced_info is not None and user_info.advanced_info.get_revoke_at() <= time.time():
+            # Revoked on read as well, so a late expiry thread is never visible
+            print(f"Advanced user {user_id} expired")
+            user_info.advanced_info = None
+            self[user_id] = user_info
+        return user_info
+
+    def __getitem__(self, user_id):
+        user_info = self.get(user_id)
+        if user_info is None: raise KeyError(user_id)
+        return user_info
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __setitem__(self, user_id, user_info: UserInfo):
+        with self.lock:
+            self.cache[user_id] = user_info
+            self.missing.discard(user_id)
+            self.dirty[user_id] = user_info
+
+    def __delitem__(self, user_id):
+        with self.lock:
+            if self.get(user_id) is None: raise KeyError(user_id)
+            self.cache.pop(user_id, None)
+            self.missing.add(user_id)
+            self.dirty[user_id] = None
+
+    def load_all(self):
+        with self.lock:
+            if self.is_complete: return
+            for user_id, user_info in self.db.items():
+                if user_id not in self.dirty: self.cache[user_id] = user_info
+            self.missing.clear()
+            self.is_complete = True
+
+    def keys(self):
+        self.load_all()
+        with self.lock: return list(self.cache.keys())
+
+    def values(self):
+        self.load_all()
+        with self.lock: return list(self.cache.values())
+
+    def items(self):
+        self.load_all()
+        with self.lock: return list(self.cache.items())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                dirty, self.dirty = self.dirty, {}
+            if not dirty: return
+            self.db.write(dirty)
+            self.stats["flushes"] += 1
+
+    def flush_loop(self, flush_secs):
+        while True:
+            time.sleep(flush_secs)
+            try: self.flush()
+            except Exception as e: print(f"Can't flush user changes: {e}")
+
+    def invalidate(self):
+        # Commits pending changes, then reloads users from the database on their next access
+        with self.flush_lock:
+            self.flush()
+            with self.lock:
+                self.cache.clear()
+                self.missing.clear()
+                self.is_complete = False
+
+    def select(self, **kwargs) -> list[UserInfo]:
+        self.flush()
+        return self.db.select(**kwargs)
+
+    def count(self, status=None):
+        self.flush()
+        return self.db.count(status)
+
+    def get_next_revoke_at(self):
+        self.flush()
+        return self.db.get_next_revoke_at()
+
+    def bulk(self, func, *args):
+        # Runs a single statement over the table, the cache reloads afterwards
+        with self.flush_lock:
+            self.flush()
+            try: return func(*args)
+            finally: self.invalidate()
+
+class AdvancedExpiry:
+    # A single thread sleeping until the earliest revoke time of the users table (indexed), woken up early when
+    # advanced users change. CachedUsers also revokes expired users when they are read
+    cond = threading.Condition()
+    changed = False
+    thread = None
+
+    @classmethod
+    def start(cls):
+        if cls.thread is not None: return
+        cls.thread = threading.Thread(target=cls.loop, daemon=True)
+        cls.thread.start()
+
     @classmethod
-    def cancel(cls, user_id):
-        if user_id in cls.jobs:
-            schedule.cancel_job(cls.jobs[user_id])
+    def reschedule(cls):
+        with cls.cond:
+            cls.changed = True
+            cls.cond.notify()
+
+    @classmethod
+    def revoke_expired(cls):
+        for user_id in AuthManager.allowed_users.db.get_expired_ids(time.time()):
+            AuthManager.allowed_users.get(user_id) # Revokes it
+        AuthManager.allowed_users.flush()
+
+    @classmethod
+    def loop(cls):
+        while True:
+            with cls.cond: cls.changed = False
+            try:
+                revoke_at = AuthManager.allowed_users.get_next_revoke_at()
+                if revoke_at is not None and revoke_at <= time.time():
+                    cls.revoke_expired()
+                    continue
+            except Exception as e:
+                print(f"Can't revoke expired advanced users: {e}")
+                revoke_at = time.time() + 60
+            with cls.cond:
+                if cls.changed: continue
+                cls.cond.wait(None if revoke_at is None else min(revoke_at - time.time(), 3600))
 
 class AuthManager:
-    allowed_users = get_sqldict_db("allowed_users")
+    allowed_users = CachedUsers(UserTable(get_auth_db_path()))
 
     @classmethod
     def update_user_info(cls, user_id, **kwargs):
@@ -86,17 +378,13 @@ class AuthManager:
     @classmethod
     def warmup(cls):
         allowed_users: dict[str, UserInfo] = cls.allowed_users
-        if not allowed_users:
+        if allowed_users.count() == 0:
             now = datetime.now()
             infinite_advanced_info = AdvancedInfo(now, 365*100)
             allowed_users[ADMIN_USER_ID] = UserInfo(ADMIN_USER_ID, "Admin", True, advanced_info=infinite_advanced_info)
 
-        for user_id in allowed_users:
-            AutoRevokeAdvanced.cancel(user_id)
-            AutoRevokeAdvanced.create_job(allowed_users, user_id)
-            AuthManager.update_user_info(user_id, remain_normal_uses=int(allowed_users[user_id].remain_normal_uses))
-            if allowed_users[user_id].name == "Unknown_Name":
-                AuthManager.update_user_info(user_id, name="Name_Unknown")
+        allowed_users.bulk(allowed_users.db.rename_users, "Unknown_Name", "Name_Unknown")
+        AdvancedExpiry.start()
     
     @classmethod
     def check_admin(cls, message, do_task):
@@ -106,60 +394,70 @@ class AuthManager:
         return True
     
     @classmethod
-    def serialize_allowed_users(cls, display=["advanced", "banned"], filer_ids=None, display_user_id=True):
+    def serialize_users(cls, status, users: list[UserInfo], display_user_id=True):
         def uid_bracket(user_info: UserInfo):
             return f"(`{user_info.id}`)" if display_user_id else ''
-        allowed_users: dict[str, UserInfo] = cls.allowed_users
-        normal, advanced, banned = [], [], []
-        normal: list[UserInfo]; advanced: list[UserInfo]; banned: list[UserInfo]
-        for user_info in allowed_users.values():
-            if filer_ids is not None:
-                if user_info.id not in filer_ids: continue
-            if not user_info.is_allowed:
-                banned.append(user_info)
-                continue
-            if user_info.advanced_info is not None:
-                advanced.append(user_info)
-            else:
-                normal.append(user_info)
-        normal_str = "---------- Normal users ----------\n"
-        normal_str += '\n'.join([
-            f"• _{user_info.name.replace('_', ' ')}_ {uid_bracket(user_info)}: Normal\n(`{user_info.remain_normal_uses}` free use(s) left)"
-            for user_info in normal[:50]
-        ])
-        advanced = sorted(advanced, key=lambda user_info: user_info.advanced_info.duration_days, reverse=True)
-        advanced_str = '---------- Advanced users ----------\n'
-        for user_info in advanced:
-            advanced_info = user_info.advanced_info
-            date_format = "%d/%m/%y %H:%M"
-            start = advanced_info.start_date
-            end = advanced_info.start_date + timedelta(days=advanced_info.duration_days)
-            advanced_str += f"• *{user_info.name} *{uid_bracket(user_info)}*: Advanced {(end-start).days} day(s) left*\n(`{start.strftime(date_format)} – {end.strftime(date_format)}`)\n"
-        advanced_str = advanced_str.strip()
-        banned_str = "---------- Banned users ----------\n"
-        banned_str += '\n'.join([
+        if status == "normal":
+            return "---------- Normal users ----------\n" + '\n'.join([
+                f"• _{user_info.name.replace('_', ' ')}_ {uid_bracket(user_info)}: Normal\n(`{user_info.remain_normal_uses}` free use(s) left)"
+                for user_info in users
+            ])
+        if status == "advanced":
+            advanced_str = '---------- Advanced users ----------\n'
+            for user_info in users:
+                advanced_info = user_info.advanced_info
+                date_format = "%d/%m/%y %H:%M"
+                start = advanced_info.start_date
+                end = advanced_info.start_date + timedelta(days=advanced_info.duration_days)
+                advanced_str += f"• *{user_info.name} *{uid_bracket(user_info)}*: Advanced {(end-start).days} day(s) left*\n(`{start.strftime(date_format)} – {end.strftime(date_format)}`)\n"
+            return advanced_str.strip()
+        return "---------- Banned users ----------\n" + '\n'.join([
             f"• _{user_info.name.replace('_', ' ')}_  {uid_bracket(user_info)}"
-            for user_info in banned
+            for user_info in users
         ])
-        output_str = ''
-        if filer_ids is not None:
-            if len(normal):
-                output_str += normal_str + '\n\n'
-            if len(advanced):
-                output_str += advanced_str + '\n\n'
-            if len(banned):
-                output_str += banned_str + '\n\n'
-            if len(output_str): return output_str.strip()
-            else: return "User not found"
-        for type in display:
-            if type == "normal":
-                output_str += normal_str + '\n\n'
-            elif type == "advanced":
-                output_str += advanced_str + '\n\n'
-            else:
-                output_str += banned_str + '\n\n'
-        return output_str.strip()
-    
+
+    @classmethod
+    def serialize_allowed_users(cls, display=["advanced", "banned"], filer_ids=None, display_user_id=True):
+        # Lists the users with the given ids, or the first page of each status in `display`
+        if filer_ids is None:
+            return '\n\n'.join(cls.get_page(status, 0, display_user_id)[0] for status in display)
+        users = cls.allowed_users.select(ids=list(filer_ids)[:USERS_PAGE_SIZE])
+        sections = [
+            cls.serialize_users(status, [user_info for user_info in users if UserTable.get_status(user_info) == status], display_user_id)
+            for status in USER_STATUSES
+            if any(UserTable.get_status(user_info) == status for user_info in users)
+        ]
+        return '\n\n'.join(sections) if len(sections) else "User not found"
+
+    @classmethod
+    def get_page(cls, status, page, display_user_id=True):
+        total = cls.allowed_users.count(status)
+        num_pages = max(1, math.ceil(total / USERS_PAGE_SIZE))
+        page = min(max(page, 0), num_pages - 1)
+        users = cls.allowed_users.select(status=status, offset=page * USERS_PAGE_SIZE, limit=USERS_PAGE_SIZE)
+        text = cls.serialize_users(status, users, display_user_id)
+        markup = None
+        if num_pages > 1:
+            text += f"\n_Page {page + 1}/{num_pages}, {total} users_"
+            markup = types.InlineKeyboardMarkup()
+            buttons = []
+            if page > 0: buttons.append(types.InlineKeyboardButton("◀ Previous", callback_data=f"users|{status}|{page - 1}"))
+            if page < num_pages - 1: buttons.append(types.InlineKeyboardButton("Next ▶", callback_data=f"users|{status}|{page + 1}"))
+            markup.row(*buttons)
+        return text, markup
+
+    @classmethod
+    def page_users(cls, bot: TeleBot, call: types.CallbackQuery):
+        # Callback of the paging buttons under get_allowed listings
+        if str(call.from_user.id) != ADMIN_USER_ID: return
+        _, status, page = call.data.split('|')
+        if status not in USER_STATUSES: return
+        text, markup = cls.get_page(status, int(page))
+        try:
+            bot.edit_message_text(text, call.message.chat.id, call.message.id, reply_markup=markup, parse_mode="Markdown")
+        except ApiTelegramException as e:
+            if "message is not modified" not in e.description: raise
+
     @classmethod
     def check_user_id(cls, user_id, allowed_users=None):
         if user_id == '*':
@@ -175,19 +473,21 @@ class AuthManager:
     @classmethod
     def get_allowed(cls, bot: TeleBot, message: types.Message, parsed_data: dict):
         if not cls.check_admin(message, "get allowed users"): return
-        allowed_users: dict[str, UserInfo] = cls.allowed_users
-        if not allowed_users:
+        if cls.allowed_users.count() == 0:
             bot.reply_to(message, "No user is allowed to use this bot yet")
             return
         
         inputs = [inp.strip() for inp in parsed_data["prompt"].split(',') if len(inp.strip())]
-        if "normal" in inputs or "advanced" in inputs or "banned" in inputs:
-            bot.reply_to(message, cls.serialize_allowed_users(inputs), parse_mode="Markdown")
-        elif len(inputs) == 0:
-            bot.reply_to(message, cls.serialize_allowed_users(["advanced", "banned"]), parse_mode="Markdown")
-        else:
-            display = ["normal", "advanced", "banned"]
-            bot.reply_to(message, cls.serialize_allowed_users(display, filer_ids=inputs), parse_mode="Markdown")
+        statuses = [inp for inp in inputs if inp in USER_STATUSES]
+        if len(statuses) or len(inputs) == 0:
+            for status in statuses or ["advanced", "banned"]:
+                text, markup = cls.get_page(status, 0)
+                bot.reply_to(message, text, reply_markup=markup, parse_mode="Markdown")
+            return
+        user_ids = [inp for inp in inputs if cls.check_user_id(inp)]
+        for name in [inp for inp in inputs if not cls.check_user_id(inp)]: # Name prefixes
+            user_ids.extend(user_info.id for user_info in cls.allowed_users.select(name=name, limit=USERS_PAGE_SIZE))
+        bot.reply_to(message, cls.serialize_allowed_users(filer_ids=user_ids), parse_mode="Markdown")
 
     @classmethod
     def add_allowed(cls, bot: TeleBot, message: types.Message, parsed_data: dict):
@@ -204,7 +504,6 @@ class AuthManager:
             user_id = user_id.strip() if is_allowed else user_id.strip()[1:]
             if not cls.check_user_id(user_id): continue
             user_name = user_name.replace('`', '').strip()
-            AutoRevokeAdvanced.cancel(user_id)
             allowed_users[user_id] = UserInfo(user_id, user_name, is_allowed)
             user_ids.append(user_id)
             
@@ -217,10 +516,11 @@ class AuthManager:
         allowed_users: dict[str, UserInfo] = cls.allowed_users
         user_ids = [s.strip() for s in parsed_data["prompt"].strip().split(',')]
         if "everyone" in user_ids:
-            user_ids = allowed_users.keys()
+            removed = cls.allowed_users.bulk(cls.allowed_users.db.delete_all)
+            bot.reply_to(message, f"{text}\n{removed} user(s) removed")
+            return
         for user_id in user_ids:
             if not cls.check_user_id(user_id, allowed_users): continue
-            AutoRevokeAdvanced.cancel(user_id)
             del allowed_users[user_id]
         text += '\n' + cls.serialize_allowed_users(filer_ids=user_ids)
         bot.reply_to(message, text, parse_mode="Markdown")
@@ -243,10 +543,9 @@ class AuthManager:
             if not allowed_users[user_id].is_allowed:
                 text += f"User `...{user_id[1:][-5:]}` is banned, therefore can't become an advanced user\n"
                 continue
-            AutoRevokeAdvanced.cancel(user_id)
             cls.update_user_info(user_id, advanced_info=AdvancedInfo(datetime.now(), days))
-            AutoRevokeAdvanced.create_job(allowed_users, user_id)
             user_ids.append(user_id)
+        AdvancedExpiry.reschedule()
         text += cls.serialize_allowed_users(filer_ids=user_ids)
         bot.reply_to(message, text, parse_mode="Markdown")
 
@@ -256,7 +555,6 @@ class AuthManager:
         text = "Removed successfully\n"
         user_ids = [s.strip() for s in parsed_data["prompt"].strip().split(',')]
         for user_id in user_ids:
-            AutoRevokeAdvanced.cancel(user_id)
             cls.update_user_info(user_id, advanced_info=None)
         text += cls.serialize_allowed_users(filer_ids=user_ids)
         bot.reply_to(message, text, parse_mode="Markdown") 
@@ -272,17 +570,15 @@ class AuthManager:
                 return
             _, uses = user_id_use
             DefaultNormalUses.set(int(uses))
-            default_normal_uses = DefaultNormalUses.get()
-            allowed_users: dict[str, UserInfo] = cls.allowed_users
-            user_id_uses = [(id.strip(), default_normal_uses) for id in allowed_users]
-        else:
-            default_normal_uses = DefaultNormalUses.get()
-            user_id_uses = [
-                str(s).split('/') if '/' in s else (s, default_normal_uses) 
-                for s in inputs
-            ]
-            user_id_uses = [(id.strip(), int(uses)) for id, uses in user_id_uses]
-        allowed_users: dict[str, UserInfo] = cls.allowed_users
+            updated = cls.allowed_users.bulk(cls.allowed_users.db.set_all_normal_uses, DefaultNormalUses.get())
+            bot.reply_to(message, f"Set `{DefaultNormalUses.get()}` free use(s) for {updated} user(s)", parse_mode="Markdown")
+            return
+        default_normal_uses = DefaultNormalUses.get()
+        user_id_uses = [
+            str(s).split('/') if '/' in s else (s, default_normal_uses) 
+            for s in inputs
+        ]
+        user_id_uses = [(id.strip(), int(uses)) for id, uses in user_id_uses]
         user_ids = []
         for user_id, uses in user_id_uses:
             if not cls.check_user_id(user_id): continue
@@ -295,10 +591,7 @@ class AuthManager:
         if not cls.check_admin(message, "notify advanced users"): return
         text = parsed_data["prompt"]
         if len(text.strip()) == 0: return
-        advanced_users: list[UserInfo] = [
-            user_info for user_info in cls.allowed_users.values()
-            if user_info.advanced_info is not None
-        ]
+        advanced_users: list[UserInfo] = cls.allowed_users.select(status="advanced")
         for advanced_user in advanced_users:
             try: bot.send_message(advanced_user.id, text)
             except Exception as e:
@@ -344,7 +637,12 @@ class ComfyCommandManager:
             cmds[command] = is_advanced
         bot.reply_to(message, cls.serialize(cmds), parse_mode="Markdown")
 
-def warmup():
+def warmup_users():
     DefaultNormalUses.warmup()
     AuthManager.warmup()
+
+CACHE_LOOKUPS.add(lambda: {("users", "hit"): AuthManager.allowed_users.stats["hits"], ("users", "miss"): AuthManager.allowed_users.stats["misses"]})
+
+def warmup():
+    warmup_users()
     ComfyCommandManager.warmup()
@@ -8,7 +8,9 @@ from contextlib import contextmanager
 import logging, unicodedata, threading, schedule, time
 from datetime import datetime, timezone, timedelta
 from typing import Optional
+from dataclasses import dataclass
 from sqlitedict import SqliteDict
+from media_codec import EncodedImage
 
 USERNAME_LENGTH_LIMIT = int(os.environ.get("USERNAME_LENGTH_LIMIT", "17"))
 TIMEZONE_DELTA = float(os.environ.get("TIMEZONE_DELTA", "7"))
@@ -41,7 +43,58 @@ def mention(user: types.User, display_user_id=False):
     else:
         return f"[@{get_username(user)}](tg://user?id={user.id})"
 
-def telegram_reply_to(bot: TeleBot, message: types.Message, text_or_photo: typing.Union[str, BytesIO]):
+def get_message_file(message: types.Message):
+    if message.content_type == "photo":
+        return max(message.photo, key=lambda p:p.width)
+    if message.content_type in ["video", "animation", "document"]:
+        return getattr(message, message.content_type)
+    return None
+
+@dataclass
+class TelegramFile:
+    # A file already uploaded to Telegram, which can be resent by id without uploading again
+    file_id: str
+    kind: str = "photo"
+
+    @classmethod
+    def from_message(cls, message: types.Message):
+        media = get_message_file(message) if message is not None else None
+        if media is None: return None
+        return cls(media.file_id, message.content_type)
+
+    def to_input_media(self):
+        if self.kind == "photo": return types.InputMediaPhoto(self.file_id)
+        return types.InputMediaVideo(self.file_id)
+
+def send_telegram_file(bot: TeleBot, chat_id, telegram_file: TelegramFile, **kwargs):
+    send_method = {
+        "photo": bot.send_photo, "video": bot.send_video,
+        "animation": bot.send_animation, "document": bot.send_document
+    }[telegram_file.kind]
+    return send_method(chat_id, telegram_file.file_id, **kwargs)
+
+def get_input_media(output: EncodedImage, **kwargs):
+    # Albums become one photo per frame, GIFs are sent as videos so they can be part of media groups
+    if output.media_type == "album":
+        return [types.InputMediaPhoto(BytesIO(data), **(kwargs if idx == 0 else {})) for idx, data in enumerate(output.data)]
+    if output.media_type == "photo":
+        return [types.InputMediaPhoto(output.to_bytes_io(), **kwargs)]
+    return [types.InputMediaVideo(output.to_bytes_io(), **kwargs)]
+
+def send_encoded_image(bot: TeleBot, chat_id, output: EncodedImage, **kwargs):
+    if output.media_type == "album":
+        reply_kwargs = {key: kwargs.pop(key) for key in ["reply_to_message_id"] if key in kwargs}
+        messages = []
+        input_media = get_input_media(output, **kwargs)
+        for idx in range(0, len(input_media), 10): # Telegram's media group limit
+            messages += bot.send_media_group(chat_id, input_media[idx:idx + 10], **reply_kwargs)
+        return messages
+    send_method = {
+        "photo": bot.send_photo, "video": bot.send_video, "animation": bot.send_animation
+    }[output.media_type]
+    return send_method(chat_id, output.to_bytes_io(), **kwargs)
+
+def telegram_reply_to(bot: TeleBot, message: types.Message, text_or_photo: typing.Union[str, BytesIO, TelegramFile, EncodedImage]):
     full_command = message.caption if message.content_type in ['photo', 'video', 'animation'] else message.text
     if full_command is None: full_command = ''
     if isinstance(text_or_photo, str):
@@ -57,11 +110,17 @@ def telegram_reply_to(bot: TeleBot, message: types.Message, text_or_photo: typin
         except: pass
     else:
         photo = text_or_photo
+        if isinstance(photo, TelegramFile):
+            send_photo = lambda chat_id, photo, **kwargs: send_telegram_file(bot, chat_id, photo, **kwargs)
+        elif isinstance(photo, EncodedImage):
+            send_photo = lambda chat_id, photo, **kwargs: send_encoded_image(bot, chat_id, photo, **kwargs)
+        else:
+            send_photo = bot.send_photo
         try:
-            return bot.send_photo(message.chat.id, photo, reply_to_message_id=message.id)
+            return send_photo(message.chat.id, photo, reply_to_message_id=message.id)
         except: pass
         try: 
-            return bot.send_photo(
+            return send_photo(
                 message.chat.id, 
                 photo, 
                 caption=mention(message.from_user), 
@@ -76,16 +135,17 @@ def telegram_reply_to(bot: TeleBot, message: types.Message, text_or_photo: typin
             )
         except: pass
 
-def handle_exception(bot: TeleBot, orig_message: Optional[types.Message] = None):
+def handle_exception(bot: TeleBot, orig_message: Optional[types.Message] = None, error_text: Optional[str] = None):
     utc_time = datetime.now(timezone.utc).astimezone(timezone(timedelta(hours=TIMEZONE_DELTA)))
     date_str = utc_time.strftime("%d-%m-%Y_%H.%M.%S")
     error_log_dir = Path(__file__, '..', 'error_logs').resolve()
     error_log_dir.mkdir(exist_ok=True)
     error_file_path = Path(error_log_dir, f"{date_str}.txt").resolve()
+    error_text = error_text or traceback.format_exc()
 
     if orig_message is None:
         error_file_path.write_text(
-            traceback.format_exc() \
+            error_text \
             + f"\n\nTeleBot's logging: \n{LOG_CAPTURE.getvalue()}",
             encoding="utf-8"
         )
@@ -93,7 +153,7 @@ def handle_exception(bot: TeleBot, orig_message: Optional[types.Message] = None)
     else:
         error_file_path.write_text(
                 f"In {orig_message.chat.type} chat {orig_message.chat.title or ''} ({orig_message.chat.id}), user @{get_username(orig_message.from_user)} ({orig_message.from_user.id}) got error:\n" \
-                + traceback.format_exc() \
+                + error_text \
                 + f"\n\nTeleBot's logging: \n{LOG_CAPTURE.getvalue()}",
                 encoding="utf-8"
             )
@@ -119,9 +179,11 @@ def get_dbm(db_name):
         dbm_dir.mkdir(exist_ok=True)
         return shelve.open(str(Path(dbm_dir / db_name).resolve()), 'c')
 
+def get_auth_db_path():
+    return str((Path(__file__).parent / "dbm_data" / "auth_manager.sqlite").resolve())
+
 def get_sqldict_db(db_name):
-    dbm_dir = Path(__file__).parent / "dbm_data" / "auth_manager.sqlite"
-    return SqliteDict(str(dbm_dir.resolve()), db_name, autocommit=True)
+    return SqliteDict(get_auth_db_path(), db_name, autocommit=True)
 
 def parse_command_string(command_string, command_name):
     textAndArgs = command_string[1+ len(command_name):].strip().split('--')
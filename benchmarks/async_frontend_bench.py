@@ -0,0 +1,114 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time, asyncio, threading, statistics
+from aiohttp import web
+from telebot import TeleBot, apihelper, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from middlewares import AntiFloodMiddleware
+from async_frontend import AsyncAntiFloodMiddleware
+
+# Thousands of chats send /get_ids at once to a local fake Bot API that answers every request after a network
+# delay. The TeleBot frontend answers them from its handler threads, the asyncio one from a single event loop
+NUM_CHATS = 5000
+API_DELAY_SECS = 0.1
+PORT = 8765
+TOKEN = "123456:bench"
+
+class FakeBotApi:
+    def __init__(self, num_chats):
+        self.updates = [self.make_update(idx) for idx in range(num_chats)]
+        self.received = {}
+        self.answered = {}
+        self.done = asyncio.Event()
+
+    def make_update(self, idx):
+        chat = {"id": 10000 + idx, "type": "private", "first_name": f"user{idx}"}
+        return {"update_id": idx + 1, "message": {
+            "message_id": 1, "date": int(time.time()) + 1, "chat": chat, "text": "/get_ids",
+            "from": {"id": 10000 + idx, "is_bot": False, "first_name": f"user{idx}"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": 8}]
+        }}
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.can_read_body: params.update(await request.post())
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}})
+        if method == "getUpdates":
+            offset = int(params.get("offset", 0))
+            updates = [update for update in self.updates if update["update_id"] >= offset][:100]
+            now = time.monotonic()
+            for update in updates: self.received.setdefault(update["message"]["chat"]["id"], now)
+            if not updates: await asyncio.sleep(0.5)
+            return web.json_response({"ok": True, "result": updates})
+        await asyncio.sleep(API_DELAY_SECS)
+        chat_id = int(params["chat_id"])
+        self.answered[chat_id] = time.monotonic()
+        if len(self.answered) == len(self.updates): self.done.set()
+        return web.json_response({"ok": True, "result": {
+            "message_id": 2, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", ''),
+            "from": {"id": 1, "is_bot": True, "first_name": "bench"}
+        }})
+
+    def latencies(self):
+        return sorted(self.answered[chat_id] - self.received[chat_id] for chat_id in self.answered)
+
+def anti_flood_kwargs():
+    return dict(commands=[], free_commands=["get_ids"], allowed_chat_ids='*', start_time=time.time(), window_limit_sec=5, temp_message_delay_sec=5)
+
+def run_sync_frontend(done: threading.Event):
+    bot = TeleBot(TOKEN, use_class_middlewares=True)
+    bot.setup_middleware(AntiFloodMiddleware(bot=bot, **anti_flood_kwargs()))
+    @bot.message_handler(["get_ids"])
+    def get_ids(message):
+        bot.reply_to(message, f"Chat ID: {message.chat.id}, User ID: {message.from_user.id}")
+    bot.get_me()
+    thread = threading.Thread(target=bot.polling, kwargs={"non_stop": True, "timeout": 1}, daemon=True)
+    thread.start()
+    done.wait()
+    bot.stop_polling()
+
+async def run_async_frontend(done: asyncio.Event):
+    bot = AsyncTeleBot(TOKEN)
+    anti_flood = AsyncAntiFloodMiddleware(bot=bot, **anti_flood_kwargs())
+    anti_flood.bot_id = (await bot.get_me()).id
+    bot.setup_middleware(anti_flood)
+    @bot.message_handler(["get_ids"])
+    async def get_ids(message):
+        await bot.reply_to(message, f"Chat ID: {message.chat.id}, User ID: {message.from_user.id}")
+    polling = asyncio.create_task(bot.polling(non_stop=True, timeout=1))
+    await done.wait()
+    polling.cancel()
+    await bot.close_session()
+
+async def run(frontend_name):
+    api = FakeBotApi(NUM_CHATS)
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    start, cpu_start = time.monotonic(), time.process_time()
+    if frontend_name == "async":
+        await run_async_frontend(api.done)
+    else:
+        sync_done = threading.Event()
+        sync_thread = threading.Thread(target=run_sync_frontend, args=(sync_done,), daemon=True)
+        sync_thread.start()
+        await api.done.wait()
+        sync_done.set()
+    elapsed, cpu = time.monotonic() - start, time.process_time() - cpu_start
+    await runner.cleanup()
+    return elapsed, cpu, api.latencies()
+
+if __name__ == "__main__":
+    apihelper.API_URL = f"http://127.0.0.1:{PORT}/bot{{0}}/{{1}}"
+    asyncio_helper.API_URL = f"http://127.0.0.1:{PORT}/bot{{0}}/{{1}}"
+    for frontend_name in ["sync", "async"]:
+        elapsed, cpu, latencies = asyncio.run(run(frontend_name))
+        print(
+            f"{frontend_name:>5}: {NUM_CHATS} chats answered in {elapsed:6.2f}s ({NUM_CHATS / elapsed:7.1f}/s, cpu {cpu:5.2f}s), "
+            f"latency p50 {statistics.median(latencies):6.2f}s, p99 {latencies[int(len(latencies) * 0.99)]:6.2f}s"
+        )
@@ -0,0 +1,56 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time, random, tempfile
+from sqlitedict import SqliteDict
+from telebot import types
+from auth_manager import AuthManager, CachedUsers, UserTable, UserInfo, AdvancedInfo
+from middlewares import AntiFloodMiddleware
+from datetime import datetime
+
+# Per-message auth cost with 100k users: authenticate() plus the free use decrement of the image menu,
+# straight on the autocommitting pickled SqliteDict against the cached users table (migrated from it)
+NUM_USERS = 100_000
+NUM_MESSAGES = 5000
+ACTIVE_USERS = 2000 # Messages come from a working set of users
+
+def populate(path):
+    with SqliteDict(path, "allowed_users", autocommit=False) as db:
+        for idx in range(NUM_USERS):
+            user_id = str(1000 + idx)
+            advanced_info = AdvancedInfo(datetime.now(), 30) if idx % 10 == 0 else None
+            db[user_id] = UserInfo(user_id, f"user{idx}", idx % 50 != 0, 5, advanced_info)
+        db.commit()
+
+def make_message(user_id):
+    return types.Message.de_json({
+        "message_id": 1, "date": int(time.time()), "text": "/image_menu",
+        "chat": {"id": int(user_id), "type": "private"},
+        "from": {"id": int(user_id), "is_bot": False, "first_name": "user", "username": f"user{user_id}"}
+    })
+
+def run(allowed_users):
+    AuthManager.allowed_users = allowed_users
+    anti_flood = AntiFloodMiddleware(None, [], [], '*', 0, 5, 5)
+    rng = random.Random(0)
+    messages = [make_message(str(1000 + rng.randrange(ACTIVE_USERS))) for _ in range(NUM_MESSAGES)]
+    start = time.perf_counter()
+    for message in messages:
+        user_id = str(message.from_user.id)
+        if anti_flood.authenticate(message) and allowed_users[user_id].advanced_info is None:
+            AuthManager.update_user_info(user_id, remain_normal_uses=allowed_users[user_id].remain_normal_uses - 1)
+    return (time.perf_counter() - start) / NUM_MESSAGES
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "users.sqlite")
+        populate(path)
+        db = SqliteDict(path, "allowed_users", autocommit=True)
+        direct = run(db)
+        db.close()
+        cached_users = CachedUsers(UserTable(path))
+        cached = run(cached_users)
+        cached_users.flush()
+        print(f"{NUM_USERS} users, {NUM_MESSAGES} messages from {ACTIVE_USERS} users")
+        print(f"SqliteDict: {direct * 1e6:8.1f} us/message")
+        print(f"    Cached: {cached * 1e6:8.1f} us/message ({cached_users.stats['hits']} hits, {cached_users.stats['misses']} misses)")
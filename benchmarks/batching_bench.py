@@ -0,0 +1,36 @@
+import time
+import torch
+
+# Stand-in for an image workflow: a fixed amount of per-execution setup (graph/node dispatch) plus a conv stack
+# whose cost scales with the batch. Compares images/minute of one-at-a-time execution against batched execution.
+NUM_IMAGES = 32
+IMAGE_SIZE = 512
+SETUP_SECS = 0.05
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+model = torch.nn.Sequential(*[
+    layer for _ in range(4) for layer in (torch.nn.Conv2d(3, 3, 3, padding=1), torch.nn.ReLU())
+]).to(DEVICE).eval()
+
+def run_workflow(images: torch.Tensor):
+    time.sleep(SETUP_SECS)
+    with torch.inference_mode():
+        output = model(images.to(DEVICE).movedim(-1, 1)).movedim(1, -1)
+    if DEVICE == "cuda": torch.cuda.synchronize()
+    return output.cpu()
+
+def images_per_minute(batch_size):
+    images = [torch.rand(1, IMAGE_SIZE, IMAGE_SIZE, 3) for _ in range(NUM_IMAGES)]
+    start = time.perf_counter()
+    for i in range(0, NUM_IMAGES, batch_size):
+        output = run_workflow(torch.cat(images[i:i+batch_size], dim=0))
+        torch.chunk(output, output.shape[0], dim=0)
+    return NUM_IMAGES / (time.perf_counter() - start) * 60
+
+if __name__ == "__main__":
+    run_workflow(torch.rand(1, IMAGE_SIZE, IMAGE_SIZE, 3))
+    baseline = images_per_minute(1)
+    print(f"One at a time: {baseline:8.1f} images/min")
+    for batch_size in [2, 4, 8]:
+        throughput = images_per_minute(batch_size)
+        print(f"Batch size {batch_size}:  {throughput:8.1f} images/min ({throughput / baseline:.2f}x)")
@@ -0,0 +1,37 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time
+import torch
+import media_codec
+from media_codec import CodecPool
+
+# Executor-thread busy time (CPU time of the calling thread) for encoding workflow outputs,
+# encoding inline versus handing the frames to the codec process pool through shared memory
+NUM_RUNS = 5
+OUTPUTS = {
+    "1x 1024x1024 PNG": (torch.rand(1, 1024, 1024, 3), "PNG"),
+    "4x 768x768 PNG": (torch.rand(4, 768, 768, 3), "PNG"),
+    "24x 512x512 GIF": (torch.rand(24, 512, 512, 3), "PNG"),
+}
+
+def measure(image, image_format):
+    busy, total = 0., 0.
+    for _ in range(NUM_RUNS):
+        start_busy, start = time.thread_time(), time.perf_counter()
+        future = CodecPool.encode(image, image_format)
+        busy += time.thread_time() - start_busy
+        future.result()
+        total += time.perf_counter() - start
+    return busy / NUM_RUNS, total / NUM_RUNS
+
+if __name__ == "__main__":
+    for name, (image, image_format) in OUTPUTS.items():
+        media_codec.CODEC_WORKERS = 0
+        inline_busy, inline_total = measure(image, image_format)
+        media_codec.CODEC_WORKERS = 2
+        pool_busy, pool_total = measure(image, image_format)
+        print(
+            f"{name:>18}: inline busy {inline_busy*1000:7.1f}ms (total {inline_total*1000:7.1f}ms) | "
+            f"pool busy {pool_busy*1000:7.1f}ms (total {pool_total*1000:7.1f}ms)"
+        )
@@ -0,0 +1,65 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time, tempfile, schedule
+from datetime import datetime, timedelta
+from sqlitedict import SqliteDict
+from auth_manager import AuthManager, CachedUsers, UserTable, UserInfo, AdvancedInfo
+
+# Startup cost of advanced user expiry against the number of users (a tenth of them advanced). The old warmup made
+# one schedule job per advanced user and rewrote every record; the expiry index only asks for the next revoke time
+USER_COUNTS = [1000, 10_000, 100_000]
+OLD_MAX_USERS = 10_000 # The old warmup commits once per user, too slow beyond that
+
+def make_users(num_users):
+    now = datetime.now()
+    for idx in range(num_users):
+        user_id = str(1000 + idx)
+        advanced_info = AdvancedInfo(now - timedelta(days=idx % 30), 30 + idx % 7) if idx % 10 == 0 else None
+        yield UserInfo(user_id, f"user{idx}", True, 5, advanced_info)
+
+def old_warmup(allowed_users: SqliteDict):
+    jobs = {}
+    for user_id in allowed_users:
+        user_info = allowed_users[user_id]
+        if user_info.advanced_info is not None:
+            revoke_date = user_info.advanced_info.start_date + timedelta(days=user_info.advanced_info.duration_days)
+            jobs[user_id] = schedule.every((revoke_date - datetime.now()).total_seconds()).seconds.do(lambda: None)
+        allowed_users[user_id] = user_info
+    return jobs
+
+def run_old(path, num_users):
+    with SqliteDict(path, "allowed_users", autocommit=False) as db:
+        for user_info in make_users(num_users): db[user_info.id] = user_info
+        db.commit()
+    db = SqliteDict(path, "allowed_users", autocommit=True)
+    start = time.perf_counter()
+    jobs = old_warmup(db)
+    startup = time.perf_counter() - start
+    start = time.perf_counter()
+    schedule.run_pending() # What the 1 second schedule loop pays
+    tick = time.perf_counter() - start
+    schedule.clear()
+    db.close()
+    return startup, tick, len(jobs)
+
+def run_new(path, num_users):
+    table = UserTable(path)
+    table.write({user_info.id: user_info for user_info in make_users(num_users)})
+    AuthManager.allowed_users = CachedUsers(table, flush_secs=0)
+    start = time.perf_counter()
+    AuthManager.warmup()
+    table.get_next_revoke_at()
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    for num_users in USER_COUNTS:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            line = f"{num_users:7d} users:"
+            if num_users <= OLD_MAX_USERS:
+                startup, tick, num_jobs = run_old(os.path.join(temp_dir, "old.sqlite"), num_users)
+                line += f" schedule jobs {startup * 1000:9.1f} ms startup, {num_jobs} jobs, {tick * 1000:6.2f} ms per loop tick |"
+            else:
+                line += f" schedule jobs {'skipped':>9}                                        |"
+            line += f" expiry index {run_new(os.path.join(temp_dir, 'new.sqlite'), num_users) * 1000:7.2f} ms startup"
+            print(line)
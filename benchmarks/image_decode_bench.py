@@ -0,0 +1,53 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time
+import numpy as np
+import torch
+from io import BytesIO
+from PIL import Image
+from media_codec import decode_image, frames_to_tensor
+
+# Decode + conversion time of the AppIO image inputs at typical Telegram photo sizes (the largest
+# photo size Telegram keeps is 1280px, documents keep the original), old float64 path against the float32 one
+NUM_RUNS = 20
+PHOTOS = {
+    "1280x960 JPEG": ((960, 1280), "JPEG", "RGB"),
+    "1280x1280 JPEG": ((1280, 1280), "JPEG", "RGB"),
+    "2560x1920 JPEG": ((1920, 2560), "JPEG", "RGB"),
+    "1024x1024 PNG RGBA": ((1024, 1024), "PNG", "RGBA"),
+    "1024x1024 PNG L": ((1024, 1024), "PNG", "L"),
+}
+
+def make_photo(shape, image_format, mode):
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (*shape, 4), dtype=np.uint8)
+    image_bytes = BytesIO()
+    Image.fromarray(pixels, "RGBA").convert(mode).save(image_bytes, format=image_format)
+    return image_bytes.getvalue()
+
+def old_decode(content):
+    img = Image.open(BytesIO(content))
+    return torch.from_numpy(np.array(img)[:, :, :3] / 255.)[None]
+
+def new_decode(content):
+    return frames_to_tensor(decode_image(content))
+
+def measure(decode, content):
+    decode(content)
+    start = time.perf_counter()
+    for _ in range(NUM_RUNS):
+        tensor = decode(content)
+    return (time.perf_counter() - start) / NUM_RUNS, tensor
+
+if __name__ == "__main__":
+    for photo_name, (shape, image_format, mode) in PHOTOS.items():
+        content = make_photo(shape, image_format, mode)
+        line = f"{photo_name:>20}:"
+        for decode_name, decode in [("old", old_decode), ("new", new_decode)]:
+            try:
+                elapsed, tensor = measure(decode, content)
+                line += f" {decode_name} {elapsed * 1000:7.2f} ms {str(tensor.dtype):>13} {tuple(tensor.shape)} |"
+            except Exception as e:
+                line += f" {decode_name} failed ({type(e).__name__}) |"
+        print(line)
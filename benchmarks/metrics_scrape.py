@@ -0,0 +1,77 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import re, time, urllib.request, urllib.error
+import metrics
+from metrics import MetricsServer, QUEUE_DEPTH, QUEUE_WAIT, COMMAND_DURATION, AUTH_DECISIONS, FLOOD_REJECTIONS, \
+    TELEGRAM_REQUEST_DURATION, TELEGRAM_RATE_LIMITED, CACHE_LOOKUPS
+
+# Records a few samples, scrapes /metrics from a server on an ephemeral port and checks the text format, then
+# times the scrape itself
+SCRAPES = 200
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? \S+$')
+
+def record_samples():
+    QUEUE_DEPTH.add(lambda: {(): 3})
+    QUEUE_WAIT.observe(0.3, "txt2img")
+    QUEUE_WAIT.observe(42, "txt2img")
+    COMMAND_DURATION.observe(7.5, "txt2img", "ok")
+    COMMAND_DURATION.observe(0.2, "restyle", "error")
+    AUTH_DECISIONS.inc("allowed")
+    AUTH_DECISIONS.inc("banned")
+    FLOOD_REJECTIONS.inc()
+    TELEGRAM_REQUEST_DURATION.observe(0.08, "sendPhoto")
+    TELEGRAM_RATE_LIMITED.inc("sendPhoto")
+    CACHE_LOOKUPS.add(lambda: {("result", "hit"): 5, ("result", "miss"): 2})
+    CACHE_LOOKUPS.add(lambda: 1 / 0) # A failing source is skipped, not the whole scrape
+
+def scrape(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return response.headers["Content-Type"], response.read().decode("utf-8")
+
+def check(text):
+    lines = text.strip().split('\n')
+    for line in lines:
+        assert line.startswith("# HELP ") or line.startswith("# TYPE ") or SAMPLE.match(line), f"Bad line: {line}"
+    expected = [
+        'comfy_queue_depth 3',
+        'comfy_queue_wait_seconds_bucket{command="txt2img",le="0.5"} 1',
+        'comfy_queue_wait_seconds_bucket{command="txt2img",le="+Inf"} 2',
+        'comfy_queue_wait_seconds_count{command="txt2img"} 2',
+        'comfy_command_duration_seconds_count{command="restyle",status="error"} 1',
+        'telegram_auth_decisions_total{decision="banned"} 1',
+        'telegram_flood_rejections_total 1',
+        'telegram_api_request_seconds_bucket{method="sendPhoto",le="0.1"} 1',
+        'telegram_api_rate_limited_total{method="sendPhoto"} 1',
+        'comfy_cache_lookups_total{cache="result",result="hit"} 5',
+        '# TYPE comfy_command_duration_seconds histogram',
+    ]
+    for line in expected:
+        assert line in lines, f"Missing: {line}"
+    rss = [line for line in lines if line.startswith("process_resident_memory_bytes ")]
+    assert len(rss) == 1 and int(rss[0].split()[1]) > 0, rss
+    return len(lines)
+
+if __name__ == "__main__":
+    record_samples()
+    server = MetricsServer("127.0.0.1", 0).start()
+    host, port = server.server.server_address
+    url = f"http://{host}:{port}/metrics"
+    try:
+        content_type, text = scrape(url)
+        assert content_type.startswith("text/plain; version=0.0.4"), content_type
+        print(f"Scraped {check(text)} lines, format ok")
+        try:
+            scrape(f"http://{host}:{port}/")
+            raise AssertionError("Expected a 404 outside /metrics")
+        except urllib.error.HTTPError as e:
+            assert e.code == 404, e.code
+        start = time.perf_counter()
+        for _ in range(SCRAPES): scrape(url)
+        print(f"{SCRAPES} scrapes: {(time.perf_counter() - start) / SCRAPES * 1000:.2f}ms per scrape")
+        start = time.perf_counter()
+        for _ in range(100000): COMMAND_DURATION.observe(1.5, "txt2img", "ok")
+        print(f"Histogram observe: {(time.perf_counter() - start) / 100000 * 1e6:.2f}us")
+    finally:
+        server.stop()
+    print(f"{len(metrics.registry)} metrics registered")
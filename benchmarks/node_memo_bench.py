@@ -0,0 +1,120 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time, tempfile, importlib.util
+from pathlib import Path
+from types import SimpleNamespace
+import torch
+import preprocess, node_cache
+from node_cache import NodeOutputCache
+from worker import HOOKED_NODES
+
+# A user sends the same photo several times with a new prompt each time. The nodes sleep for what they'd take on
+# a GPU. Every node runs again without hoisting nor memo, hoisting keeps the checkpoint loaded, and the memo
+# also keeps the image encodes so only the text encode and what comes after it run again
+PROMPTS = ["a cat", "a dog", "a fox", "an owl", "a horse", "a lion"]
+NODE_SECONDS = {"checkpoint": 2.0, "encode_image": 0.4, "depth": 0.6, "encode_text": 0.05, "sample": 1.0, "decode": 0.2}
+IMAGE_SIZE = 768
+
+WORKFLOW = '''
+import os, random, sys
+import torch
+
+def get_value_at_index(obj, index):
+    return obj[index]
+
+def find_path(name, path=None):
+    return None
+
+def import_custom_nodes():
+    pass
+
+from nodes import NODE_CLASS_MAPPINGS
+
+def main():
+    import_custom_nodes()
+    with torch.inference_mode():
+        appio_imageinput = NODE_CLASS_MAPPINGS["AppIO_ImageInput"]()
+        appio_imageinput_1 = appio_imageinput.execute(argument_name="image")
+        appio_stringinput = NODE_CLASS_MAPPINGS["AppIO_StringInput"]()
+        appio_stringinput_2 = appio_stringinput.execute(string="", argument_name="prompt", required=True)
+        checkpointloadersimple = NODE_CLASS_MAPPINGS["CheckpointLoaderSimple"]()
+        checkpointloadersimple_3 = checkpointloadersimple.load_checkpoint(ckpt_name="model.safetensors")
+        vaeencode = NODE_CLASS_MAPPINGS["VAEEncode"]()
+        vaeencode_4 = vaeencode.encode(pixels=get_value_at_index(appio_imageinput_1, 0), vae=get_value_at_index(checkpointloadersimple_3, 2))
+        depthpreprocessor = NODE_CLASS_MAPPINGS["DepthPreprocessor"]()
+        depthpreprocessor_5 = depthpreprocessor.execute(image=get_value_at_index(appio_imageinput_1, 0), resolution=512)
+        cliptextencode = NODE_CLASS_MAPPINGS["CLIPTextEncode"]()
+        cliptextencode_6 = cliptextencode.encode(text=get_value_at_index(appio_stringinput_2, 0), clip=get_value_at_index(checkpointloadersimple_3, 1))
+        ksampler = NODE_CLASS_MAPPINGS["KSampler"]()
+        ksampler_7 = ksampler.sample(seed=42, steps=20, model=get_value_at_index(checkpointloadersimple_3, 0), positive=get_value_at_index(cliptextencode_6, 0), latent_image=get_value_at_index(vaeencode_4, 0), control=get_value_at_index(depthpreprocessor_5, 0))
+        vaedecode = NODE_CLASS_MAPPINGS["VAEDecode"]()
+        vaedecode_8 = vaedecode.decode(samples=get_value_at_index(ksampler_7, 0), vae=get_value_at_index(checkpointloadersimple_3, 2))
+        appio_imageoutput = NODE_CLASS_MAPPINGS["AppIO_ImageOutput"]()
+        appio_imageoutput_9 = appio_imageoutput.execute(images=get_value_at_index(vaedecode_8, 0))
+'''
+
+class SimulatedNode:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def run(self, **kwargs):
+        time.sleep(NODE_SECONDS[self.stage])
+        if self.stage == "checkpoint": return (object(), object(), object())
+        if self.stage == "encode_text": return ([[torch.randn(1, 77, 768), {}]],)
+        if self.stage in ["encode_image", "sample"]: return ({"samples": torch.randn(1, 4, IMAGE_SIZE // 8, IMAGE_SIZE // 8)},)
+        return (torch.rand(1, IMAGE_SIZE, IMAGE_SIZE, 3),)
+
+def simulated_node(stage, method):
+    return lambda: SimpleNamespace(**{method: SimulatedNode(stage).run})
+
+NODE_CLASS_MAPPINGS = {
+    "CheckpointLoaderSimple": simulated_node("checkpoint", "load_checkpoint"),
+    "VAEEncode": simulated_node("encode_image", "encode"),
+    "DepthPreprocessor": simulated_node("depth", "execute"),
+    "CLIPTextEncode": simulated_node("encode_text", "encode"),
+    "KSampler": simulated_node("sample", "sample"),
+    "VAEDecode": simulated_node("decode", "decode"),
+}
+
+def load_workflow(temp_dir):
+    preprocess.py_workflows_dir = Path(temp_dir, "python_workflows")
+    preprocess.preprocessed_dir = Path(temp_dir, "preprocessed")
+    preprocess.py_workflows_dir.mkdir()
+    (preprocess.py_workflows_dir / "restyle.py").write_text(WORKFLOW, encoding="utf-8")
+    preprocess.preprocess(HOOKED_NODES)
+    spec = importlib.util.spec_from_file_location("appio_restyle", preprocess.preprocessed_dir / "appio_restyle.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.main
+
+def run_directly(key, class_name, func, /, **kwargs):
+    return func(**kwargs)
+
+def run_sequence(main, hoisting, memo):
+    node_cache.NODE_MEMO = memo
+    NodeOutputCache.flush(keep_pinned=False)
+    image = torch.rand(1, IMAGE_SIZE, IMAGE_SIZE, 3) # The same decoded photo, as the media cache returns it
+    timings = []
+    for prompt in PROMPTS:
+        hooks = {
+            "AppIO_ImageInput": SimpleNamespace(execute=lambda **kwargs: (image,)),
+            "AppIO_StringInput": SimpleNamespace(execute=lambda **kwargs: (prompt,)),
+            "AppIO_ImageOutput": SimpleNamespace(execute=lambda images: None),
+            "run_node": NodeOutputCache.run_node,
+            "run_hoisted_node": NodeOutputCache.run_hoisted_node if hoisting else run_directly,
+        }
+        start = time.perf_counter()
+        main(NODE_CLASS_MAPPINGS, hooks)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as temp_dir:
+        main = load_workflow(temp_dir)
+        print(f"{len(PROMPTS)} prompts on the same {IMAGE_SIZE}x{IMAGE_SIZE} photo")
+        for name, hoisting, memo in [("plain", False, 0), ("hoisting", True, 0), ("hoisting + memo", True, 1)]:
+            timings = run_sequence(main, hoisting, memo)
+            print(f"{name:>15}: first {timings[0]:.2f}s, next ones {sum(timings[1:]) / len(timings[1:]):.2f}s on average, "
+                  f"total {sum(timings):.2f}s")
+        print(f"Node cache hits: {NodeOutputCache.stats['hits']}, misses: {NodeOutputCache.stats['misses']}")
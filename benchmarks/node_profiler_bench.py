@@ -0,0 +1,43 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time
+from types import SimpleNamespace
+from node_profiler import NodeProfiler
+from node_cache import NodeOutputCache
+
+# Cost of the profiler per node call on a workflow of cheap nodes, turned off (the hooks are passed through) and on
+NUM_NODES = 50
+NUM_RUNS = 200
+
+def workflow(hooks):
+    text = hooks["AppIO_StringInput"].execute(required=True, string="a photo", argument_name="prompt")
+    for idx in range(NUM_NODES):
+        text = hooks["run_node"](f"node_{idx}", "Concat", concat, a=text[0], b=str(idx))
+    hooks["AppIO_StringOutput"].execute(text[0][:10])
+
+def concat(a, b):
+    return (a + b,)
+
+def run_direct(node_id, class_name, func, /, **kwargs):
+    return func(**kwargs)
+
+def run(enabled):
+    NodeProfiler.set_enabled(enabled)
+    hooks = {
+        "AppIO_StringInput": SimpleNamespace(execute=lambda required, string, argument_name: (string,)),
+        "AppIO_StringOutput": SimpleNamespace(execute=lambda string: None),
+        "run_node": run_direct,
+        "run_hoisted_node": NodeOutputCache.run_hoisted_node,
+    }
+    start = time.perf_counter()
+    for _ in range(NUM_RUNS):
+        with NodeProfiler.profile("bench", hooks) as profiled_hooks:
+            workflow(profiled_hooks)
+    return (time.perf_counter() - start) / NUM_RUNS / (NUM_NODES + 2)
+
+if __name__ == "__main__":
+    off, on = run(False), run(True)
+    print(f"Profiling off: {off * 1e6:6.2f} us per node call")
+    print(f"Profiling  on: {on * 1e6:6.2f} us per node call (+{(on - off) * 1e6:.2f} us)")
+    print(NodeProfiler.serialize("bench").splitlines()[3])
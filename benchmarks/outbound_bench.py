@@ -0,0 +1,83 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time, threading, statistics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from telebot.apihelper import ApiTelegramException
+import telegram_outbound
+from telegram_outbound import TelegramOutbound, PRIORITY_OUTPUT, PRIORITY_STATUS
+
+# A fake Bot API enforcing Telegram's limits (30 requests/s overall, 1/s per private chat, 20/min per group)
+# is flooded with queue-status edits while outputs are being sent. Without the limiter every request is sent
+# right away, like the old call sites; with it, requests wait for their tokens in priority order
+DURATION_SECS = 10
+PRIVATE_CHATS = [str(1000 + idx) for idx in range(40)]
+GROUP_CHATS = ["-100200", "-100300"]
+
+class FakeBotApi:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = deque()
+        self.chat_sent: dict[str, deque] = {}
+        self.rejected = 0
+
+    def make_request(self, token, method_name, method='get', params=None, files=None):
+        chat_id, now = str(params["chat_id"]), time.monotonic()
+        with self.lock:
+            chat_window, chat_limit = (60, 20) if chat_id.startswith('-') else (1, 1)
+            chat_sent = self.chat_sent.setdefault(chat_id, deque())
+            while self.sent and self.sent[0] <= now - 1: self.sent.popleft()
+            while chat_sent and chat_sent[0] <= now - chat_window: chat_sent.popleft()
+            if len(self.sent) >= 30 or len(chat_sent) >= chat_limit:
+                self.rejected += 1
+                retry_after = 1 if len(chat_sent) < chat_limit else int(chat_sent[0] + chat_window - now) + 1
+                raise ApiTelegramException(method_name, None, {
+                    "ok": False, "error_code": 429, "description": "Too Many Requests",
+                    "parameters": {"retry_after": retry_after}
+                })
+            self.sent.append(now)
+            chat_sent.append(now)
+        time.sleep(0.02) # Network round trip
+        return {"ok": True}
+
+def run(use_limiter):
+    api = FakeBotApi()
+    outbound = TelegramOutbound() if use_limiter else None
+    pool = ThreadPoolExecutor(64)
+    output_latencies, failed_outputs = [], 0
+    def send(chat_id, priority):
+        start = time.monotonic()
+        params = {"chat_id": chat_id}
+        if outbound is None:
+            api.make_request("token", "sendMessage", "post", params)
+        else:
+            outbound.submit(chat_id, api.make_request, "token", "sendMessage", "post", params, priority=priority).result()
+        return time.monotonic() - start
+    output_futures = []
+    deadline = time.monotonic() + DURATION_SECS
+    tick = 0
+    while time.monotonic() < deadline:
+        for chat_id in PRIVATE_CHATS + GROUP_CHATS: # Queue position edits every 2.5s, like the old per-request jobs
+            if tick % 25 == 0: pool.submit(send, chat_id, PRIORITY_STATUS)
+        if tick % 5 == 0: # An output every 0.5s
+            output_futures.append(pool.submit(send, PRIVATE_CHATS[tick % len(PRIVATE_CHATS)], PRIORITY_OUTPUT))
+        tick += 1
+        time.sleep(0.1)
+    for future in output_futures:
+        try: output_latencies.append(future.result())
+        except ApiTelegramException: failed_outputs += 1
+    pool.shutdown(wait=False, cancel_futures=True)
+    return api.rejected, failed_outputs, output_latencies
+
+if __name__ == "__main__":
+    telegram_outbound.TELEGRAM_MAX_RETRIES = 10
+    for use_limiter in [False, True]:
+        rejected, failed_outputs, latencies = run(use_limiter)
+        latencies.sort()
+        p50 = statistics.median(latencies) if latencies else float("nan")
+        p99 = latencies[int(len(latencies) * 0.99)] if latencies else float("nan")
+        print(
+            f"{'Rate limiter' if use_limiter else 'Direct calls':>12}: {rejected:4d} requests answered 429, "
+            f"{failed_outputs:3d} outputs failed, output latency p50 {p50 * 1000:7.1f} ms, p99 {p99 * 1000:7.1f} ms"
+        )
@@ -0,0 +1,125 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import re, ast, time, random, shutil, tempfile
+from pathlib import Path
+import preprocess
+from worker import HOOKED_NODES
+
+# Startup preprocessing of many large workflows in the ComfyUI script export format: the old full rebuild with the
+# regex plus one AST walk per input node analysis, against the manifest when cold, when nothing changed and
+# when one workflow was edited
+NUM_WORKFLOWS = 300
+NUM_NODES = 300 # Sampler calls per workflow
+NUM_INPUTS = 30 # Input node calls per workflow
+NUM_RUNS = 3
+
+INPUT_KINDS = [
+    ("AppIO_StringInput", "appio_stringinput", 'string="a photo", argument_name="prompt{}", required=True'),
+    ("AppIO_IntegerInput", "appio_integerinput", 'integer=20, integer_min=1, integer_max=50, argument_name="steps{}", required=False'),
+    ("AppIO_ImageInput", "appio_imageinput", 'argument_name="image{}"'),
+]
+
+def make_workflow(seed):
+    rng = random.Random(seed)
+    lines = [
+        "import os, random, sys", "from typing import Sequence, Mapping, Any, Union", "import torch", "",
+        "def get_value_at_index(obj, index):", "    return obj[index]", "",
+        "def find_path(name, path=None):", "    return None", "",
+        "def import_custom_nodes():", "    pass", "",
+        "from nodes import NODE_CLASS_MAPPINGS", "",
+        "def main():", "    import_custom_nodes()", "    with torch.inference_mode():",
+    ]
+    for class_name, variable, _ in INPUT_KINDS:
+        lines.append(f'        {variable} = NODE_CLASS_MAPPINGS["{class_name}"]()')
+    for idx in range(NUM_INPUTS):
+        _, variable, arguments = INPUT_KINDS[idx % len(INPUT_KINDS)]
+        lines.append(f"        {variable}_{idx} = {variable}.execute({arguments.format(idx)})")
+    lines.append('        ksampler = NODE_CLASS_MAPPINGS["KSampler"]()')
+    for idx in range(NUM_NODES):
+        lines.append(f"        ksampler_{idx} = ksampler.sample(seed={rng.randrange(1 << 30)}, steps=20, cfg=7.5, "
+                     f"model=get_value_at_index(ksampler_{max(idx - 1, 0)}, 0))")
+    lines.append('        appio_imageoutput = NODE_CLASS_MAPPINGS["AppIO_ImageOutput"]()')
+    lines.append(f"        appio_imageoutput_0 = appio_imageoutput.execute(images=get_value_at_index(ksampler_{NUM_NODES - 1}, 0))")
+    lines += ["", 'if __name__ == "__main__":', "    main()", ""]
+    return "\n".join(lines)
+
+def old_extract_execute_arguments(tree, node_id):
+    call_node = None
+    does_break = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == node_id:
+            does_break = True
+            continue
+        if does_break:
+            if isinstance(node, ast.Call) and getattr(node.func, 'attr', '') == 'execute':
+                call_node = node
+                break
+    return {kw.arg: ast.unparse(kw.value) for kw in call_node.keywords}
+
+def old_get_input_nodes(preprocessed_code):
+    appio_nodes = {}
+    node_def_pattern = r"(appio_[a-zA-Z0-9]+input.*) = hooks\[(\"AppIO_[a-zA-Z0-9]+\")\]"
+    tree = ast.parse(preprocessed_code)
+    for node_def_match in re.finditer(node_def_pattern, preprocessed_code):
+        node_def_name, node_class = node_def_match.groups()
+        for node_id_match in re.finditer(fr"(appio_[a-z0-9_]+) = {node_def_name}\.execute", preprocessed_code):
+            node_id = node_id_match.group(1)
+            appio_nodes[node_id] = preprocess.InputNode(node_class, old_extract_execute_arguments(tree, node_id))
+    return appio_nodes
+
+def old_preprocess(hooks):
+    # What startup did before: rebuild every workflow, then parse all of them again for their input nodes
+    shutil.rmtree(preprocess.preprocessed_dir, ignore_errors=True)
+    preprocess.preprocessed_dir.mkdir(exist_ok=True)
+    commands = []
+    for workflow_py in preprocess.py_workflows_dir.iterdir():
+        if workflow_py.suffix != '.py': continue
+        code = preprocess.preprocess_workflow(workflow_py.read_text(encoding="utf-8"), hooks)
+        (preprocess.preprocessed_dir / f"appio_{workflow_py.name}").write_text(code)
+        commands.append(workflow_py.stem)
+    init_code = preprocess.preprocessed_init_code + "\n\n" + '\n'.join([f"from .appio_{command} import main as {command}" for command in commands])
+    (preprocess.preprocessed_dir / "__init__.py").write_text(init_code, encoding="utf-8")
+    return {workflow_py.stem.replace("appio_", ''): old_get_input_nodes(workflow_py.read_text(encoding="utf-8"))
+            for workflow_py in preprocess.preprocessed_dir.glob("appio_*.py")}
+
+def new_preprocess(hooks):
+    preprocess.command_input_nodes = None
+    preprocess.preprocess(hooks)
+    return preprocess.analyze_argument_from_preprocessed()
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as temp_dir:
+        preprocess.py_workflows_dir = Path(temp_dir, "python_workflows")
+        preprocess.preprocessed_dir = Path(temp_dir, "preprocessed")
+        preprocess.py_workflows_dir.mkdir()
+        for idx in range(NUM_WORKFLOWS):
+            (preprocess.py_workflows_dir / f"workflow{idx}.py").write_text(make_workflow(idx), encoding="utf-8")
+        print(f"{NUM_WORKFLOWS} workflows, {NUM_NODES} nodes and {NUM_INPUTS} inputs each")
+
+        old = min(timed(old_preprocess, HOOKED_NODES)[0] for _ in range(NUM_RUNS))
+        _, old_nodes = timed(old_preprocess, HOOKED_NODES)
+        print(f"   old full rebuild: {old * 1000:9.1f} ms")
+
+        cold = []
+        for _ in range(NUM_RUNS):
+            shutil.rmtree(preprocess.preprocessed_dir, ignore_errors=True)
+            elapsed, new_nodes = timed(new_preprocess, HOOKED_NODES)
+            cold.append(elapsed)
+        print(f"      manifest cold: {min(cold) * 1000:9.1f} ms")
+        assert {command: {node_id: (node.class_name, node.arguments) for node_id, node in nodes.items()} for command, nodes in old_nodes.items()} == \
+               {command: {node_id: (node.class_name, node.arguments) for node_id, node in nodes.items()} for command, nodes in new_nodes.items()}
+
+        warm = min(timed(new_preprocess, HOOKED_NODES)[0] for _ in range(NUM_RUNS))
+        print(f" manifest unchanged: {warm * 1000:9.1f} ms")
+
+        edited = []
+        for run in range(NUM_RUNS):
+            (preprocess.py_workflows_dir / "workflow0.py").write_text(make_workflow(NUM_WORKFLOWS + run), encoding="utf-8")
+            edited.append(timed(preprocess.update_preprocessed, HOOKED_NODES)[0])
+        print(f"manifest one edited: {min(edited) * 1000:9.1f} ms")
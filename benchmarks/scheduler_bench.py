@@ -0,0 +1,85 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import threading, time, random
+from collections import deque
+from types import SimpleNamespace
+from scheduler import RequestScheduler, SchedulingPolicy, LANE_ADMIN, LANE_ADVANCED, LANE_NORMAL
+
+IDLE_SECS = 2.
+LOAD_SECS = 6.
+SERVICE_SECS = 0.005
+
+class SyntheticPolicy(SchedulingPolicy):
+    def get_lane(self, request):
+        return request.lane
+
+def percentile(values, p):
+    if not values: return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def busy_spin_idle_cpu():
+    queue, stop = deque(), threading.Event()
+    def consumer():
+        while not stop.is_set():
+            if not queue: continue
+    thread = threading.Thread(target=consumer)
+    start_cpu = time.process_time()
+    thread.start()
+    time.sleep(IDLE_SECS)
+    stop.set()
+    thread.join()
+    return (time.process_time() - start_cpu) / IDLE_SECS
+
+def scheduler_idle_cpu():
+    scheduler = RequestScheduler(SyntheticPolicy())
+    def consumer():
+        scheduler.get(timeout=IDLE_SECS)
+    thread = threading.Thread(target=consumer)
+    start_cpu = time.process_time()
+    thread.start()
+    thread.join()
+    return (time.process_time() - start_cpu) / IDLE_SECS
+
+def mixed_load(policy):
+    # One group floods the queue, a few other groups and privileged users submit occasionally
+    scheduler = RequestScheduler(policy)
+    waits = {}
+    stop = threading.Event()
+    def producer(chat_id, num_users, lane, interval):
+        rng = random.Random(chat_id)
+        while not stop.is_set():
+            user_id = f"{chat_id}:{rng.randrange(num_users)}"
+            scheduler.put(SimpleNamespace(chat_id=chat_id, user_id=user_id, lane=lane, enqueue_time=time.perf_counter()))
+            time.sleep(interval * rng.uniform(0.5, 1.5))
+    def consumer():
+        while not stop.is_set():
+            request = scheduler.get(timeout=0.1)
+            if request is None: continue
+            waits.setdefault((request.chat_id, request.lane), []).append(time.perf_counter() - request.enqueue_time)
+            time.sleep(SERVICE_SECS)
+    producers = [
+        ("flooding_group", 200, LANE_NORMAL, 0.004),
+        ("group_a", 20, LANE_NORMAL, 0.05),
+        ("group_b", 20, LANE_NORMAL, 0.05),
+        ("advanced", 5, LANE_ADVANCED, 0.1),
+        ("admin", 1, LANE_ADMIN, 0.5),
+    ]
+    threads = [threading.Thread(target=producer, args=args) for args in producers]
+    for thread in threads: thread.start()
+    consumer_thread = threading.Thread(target=consumer)
+    consumer_thread.start()
+    time.sleep(LOAD_SECS)
+    stop.set()
+    for thread in threads: thread.join()
+    consumer_thread.join()
+    return waits
+
+if __name__ == "__main__":
+    print(f"Idle CPU (busy spin deque): {busy_spin_idle_cpu()*100:.1f}%")
+    print(f"Idle CPU (RequestScheduler): {scheduler_idle_cpu()*100:.1f}%")
+    for name, policy in [("Fair share only (single lane)", SchedulingPolicy()), ("Priority + fair share", SyntheticPolicy())]:
+        print(f"\n{name}: queue wait per source")
+        for (chat_id, lane), waits in sorted(mixed_load(policy).items()):
+            print(f"  {chat_id:>15} lane={lane} served={len(waits):5d} p50={percentile(waits, .5)*1000:8.1f}ms p99={percentile(waits, .99)*1000:8.1f}ms")
@@ -0,0 +1,53 @@
+import sys, os
+ROOT = os.path.realpath(os.path.join(__file__, '..', '..'))
+sys.path.insert(0, ROOT)
+
+import json, time, subprocess
+
+# Cold start: time to import each frontend module in a fresh interpreter and which heavy modules it drags in,
+# then the warmup phases of main.py run one after the other against in parallel
+FRONTEND_MODULES = ["telegram_outbound", "auth_manager", "preprocess", "media_codec", "worker", "image_menu", "special_commands"]
+HEAVY_MODULES = ["torch", "cv2", "numpy", "PIL", "tqdm", "comfy"]
+NUM_RUNS = 3
+
+IMPORT_SCRIPT = """
+import sys, time, json
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - start, [name for name in {heavy!r} if name in sys.modules]]))
+"""
+
+WARMUP_SCRIPT = """
+import sys, time
+sys.path.insert(0, {root!r})
+from startup import Startup
+from preprocess import preprocess
+from worker import HOOKED_NODES
+from auth_manager import warmup_users, ComfyCommandManager
+from result_cache import ResultCache
+def preprocess_commands():
+    preprocess(HOOKED_NODES)
+    ComfyCommandManager.warmup()
+phases = {{"preprocess": preprocess_commands, "users": warmup_users, "result cache": ResultCache.warmup}}
+start = time.perf_counter()
+if {parallel}: Startup.run_parallel(phases)
+else:
+    for name, func in phases.items(): Startup.run_phase(name, func)
+print(time.perf_counter() - start)
+"""
+
+def run_python(script):
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return output.strip().splitlines()[-1]
+
+if __name__ == "__main__":
+    for module in FRONTEND_MODULES:
+        timings = []
+        for _ in range(NUM_RUNS):
+            elapsed, heavy = json.loads(run_python(IMPORT_SCRIPT.format(root=ROOT, module=module, heavy=HEAVY_MODULES)))
+            timings.append(elapsed)
+        print(f"import {module:>17}: {min(timings) * 1000:8.1f} ms, heavy modules loaded: {', '.join(heavy) or 'none'}")
+    for parallel in [False, True]:
+        timings = [float(run_python(WARMUP_SCRIPT.format(root=ROOT, parallel=parallel))) for _ in range(NUM_RUNS)]
+        print(f"{'parallel' if parallel else 'serial':>8} warmup: {min(timings) * 1000:8.1f} ms")
@@ -0,0 +1,72 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time, tempfile, tracemalloc
+import numpy as np
+import cv2
+from media_codec import decode_frames, VideoOptions
+
+# Peak memory and time of decoding a synthetic clip into a float32 tensor-ready array:
+# the old read_video (list of frames, np.stack, float64 division) against the chunked streaming decoder
+CLIPS = {"720p 5s": (720, 1280, 150), "1080p 10s": (1080, 1920, 300)}
+FPS = 30.
+
+def make_clip(height, width, num_frames):
+    fd, path = tempfile.mkstemp(suffix=".mp4")
+    os.close(fd)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), FPS, (width, height))
+    y, x = np.mgrid[0:height, 0:width]
+    for idx in range(num_frames):
+        frame = np.stack([(x + idx * 4) % 256, (y + idx * 2) % 256, (x + y) % 256], axis=-1).astype(np.uint8)
+        writer.write(frame)
+    writer.release()
+    with open(path, "rb") as f:
+        content = f.read()
+    os.remove(path)
+    return content
+
+def old_read_video(content):
+    fd, path = tempfile.mkstemp(suffix=".mp4")
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while cap.isOpened():
+        ret, frame = cap.read()
+        if not ret: break
+        frames.append(frame)
+    cap.release()
+    os.remove(path)
+    return np.stack(frames, axis=0) / 255.
+
+def new_read_video(content, options):
+    chunks, fps = decode_frames(content, ".mp4", options)
+    frames = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+    return np.divide(frames, 255., dtype=np.float32)
+
+def measure(decode):
+    tracemalloc.start()
+    start = time.perf_counter()
+    frames = decode()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return frames, elapsed, peak
+
+if __name__ == "__main__":
+    for clip_name, (height, width, num_frames) in CLIPS.items():
+        content = make_clip(height, width, num_frames)
+        print(f"{clip_name} ({num_frames} frames, {len(content) / 1024 / 1024:.1f} MB file)")
+        runs = {
+            "old read_video": lambda: old_read_video(content),
+            "streaming": lambda: new_read_video(content, VideoOptions()),
+            "streaming, 12 fps, 768px": lambda: new_read_video(content, VideoOptions(target_fps=12, max_resolution=768)),
+            "streaming, 48 frames": lambda: new_read_video(content, VideoOptions(max_frames=48)),
+        }
+        for run_name, decode in runs.items():
+            frames, elapsed, peak = measure(decode)
+            print(
+                f"{run_name:>26}: {elapsed * 1000:8.1f} ms, peak {peak / 1024 / 1024:8.1f} MB, "
+                f"output {frames.nbytes / 1024 / 1024:8.1f} MB {frames.dtype} {tuple(frames.shape)}"
+            )
+            del frames
@@ -0,0 +1,37 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time
+import numpy as np
+import media_codec
+
+# Size and encode time of multi-frame outputs: the GIF path against the VideoWriter formats, on a synthetic clip
+NUM_FRAMES = 48
+FPS = 24.
+CLIPS = {"512x512": (512, 512), "768x1344": (768, 1344)}
+
+def make_clip(height, width):
+    # A moving gradient with some noise, closer to generated video than flat colors
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    rng = np.random.default_rng(0)
+    frames = np.empty((NUM_FRAMES, height, width, 3), dtype=np.uint8)
+    for idx in range(NUM_FRAMES):
+        phase = idx / NUM_FRAMES * 2 * np.pi
+        frames[idx, ..., 0] = 127 + 127 * np.sin(x / 40 + phase)
+        frames[idx, ..., 1] = 127 + 127 * np.cos(y / 55 - phase)
+        frames[idx, ..., 2] = np.clip((x + y) / (height + width) * 255 + rng.normal(0, 8, (height, width)), 0, 255)
+    return frames
+
+if __name__ == "__main__":
+    for clip_name, (height, width) in CLIPS.items():
+        frames = make_clip(height, width)
+        print(f"{clip_name}, {NUM_FRAMES} frames at {FPS:.0f} fps (CRF {media_codec.VIDEO_CRF})")
+        for video_format in ["gif", "mp4", "webm"]:
+            media_codec.VIDEO_FORMAT = video_format
+            start = time.perf_counter()
+            encoded = media_codec.encode_frames(frames, "PNG", FPS)
+            elapsed = time.perf_counter() - start
+            if encoded.image_format.lower() != video_format:
+                print(f"{video_format:>6}: no codec available, fell back to {encoded.image_format}")
+                continue
+            print(f"{video_format:>6}: {len(encoded.data) / 1024:9.1f} KB in {elapsed * 1000:8.1f} ms")
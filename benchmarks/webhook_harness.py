@@ -0,0 +1,70 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..', '..')))
+
+import time, json, threading, urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from telebot import TeleBot, types
+from webhook import WebhookServer
+
+# Stands in for Telegram: POSTs updates to a local WebhookServer the way the Bot API does, retrying the ones
+# answered with an error. Checks the secret token, then measures delivery with a fast and with a slow bot
+# (the slow one fills the bounded queue, so part of the updates are refused and redelivered)
+PORT = 8766
+SECRET_TOKEN = "harness-secret"
+NUM_UPDATES = 2000
+NUM_CONNECTIONS = 40
+
+def make_update(idx):
+    return {"update_id": idx + 1, "message": {
+        "message_id": idx + 1, "date": int(time.time()), "text": "/get_ids",
+        "chat": {"id": 10000 + idx % 500, "type": "private"},
+        "from": {"id": 10000 + idx % 500, "is_bot": False, "first_name": "user"}
+    }}
+
+def post(update, secret_token=SECRET_TOKEN):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{PORT}/", data=json.dumps(update).encode(), method="POST",
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret_token}
+    )
+    try:
+        with urllib.request.urlopen(request) as response: return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def deliver(update):
+    # Like Telegram, redeliver until the update is accepted
+    attempts = 1
+    while post(update) != 200:
+        attempts += 1
+        time.sleep(0.05)
+    return attempts
+
+def run(handler_secs, queue_size):
+    bot = TeleBot("123456:harness", threaded=False)
+    handled, lock = set(), threading.Lock()
+    @bot.message_handler(["get_ids"])
+    def get_ids(message: types.Message):
+        time.sleep(handler_secs)
+        with lock: handled.add(message.id)
+    server = WebhookServer(bot.process_new_updates, secret_token=SECRET_TOKEN, listen="127.0.0.1", port=PORT, queue_size=queue_size, certfile='')
+    server.start()
+    try:
+        assert post(make_update(-1), secret_token="wrong") == 401
+        assert post(make_update(-1), secret_token='') == 401
+        start = time.monotonic()
+        with ThreadPoolExecutor(NUM_CONNECTIONS) as pool:
+            attempts = list(pool.map(deliver, [make_update(idx) for idx in range(NUM_UPDATES)]))
+        while len(handled) < NUM_UPDATES: time.sleep(0.01)
+        elapsed = time.monotonic() - start
+    finally:
+        server.stop()
+    return elapsed, server.stats, sum(attempts) - NUM_UPDATES, server.queue.maxsize
+
+if __name__ == "__main__":
+    for handler_secs, queue_size in [(0., 1024), (0.002, 64)]:
+        elapsed, stats, redelivered, maxsize = run(handler_secs, queue_size)
+        print(
+            f"handler {handler_secs * 1000:4.1f} ms, queue {maxsize:5d}: {NUM_UPDATES} updates handled in {elapsed:5.2f}s "
+            f"({NUM_UPDATES / elapsed:7.1f}/s), {stats['unauthorized']} unauthorized refused, "
+            f"{stats['rejected']} answered 503 and {redelivered} redelivered"
+        )
@@ -0,0 +1,146 @@
+import os, time, sqlite3, threading
+from pathlib import Path
+from multiprocessing.managers import BaseManager
+
+BROKER_DB = os.environ.get("BROKER_DB", str(Path(__file__).parent / "dbm_data" / "broker.sqlite"))
+BROKER_ADDRESS = os.environ.get("BROKER_ADDRESS", '') # "host:port", share the broker with executors on other hosts
+BROKER_AUTHKEY = os.environ.get("BROKER_AUTHKEY", "comfyui-backed-bot").encode()
+BROKER_MAX_ATTEMPTS = int(os.environ.get("BROKER_MAX_ATTEMPTS", "3"))
+
+QUEUED, LEASED, DONE, FAILED = "queued", "leased", "done", "failed"
+
+class SqliteBroker:
+    def __init__(self, db_path=BROKER_DB, max_attempts=BROKER_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        Path(db_path).parent.mkdir(exist_ok=True, parents=True)
+        with self.connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                command TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                status TEXT NOT NULL,
+                worker_id TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result BLOB,
+                error TEXT,
+                created REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created)")
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def transaction(self):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def submit(self, job_id, command, payload: bytes):
+        self.connect().execute(
+            "INSERT INTO jobs (id, command, payload, status, created) VALUES (?, ?, ?, ?, ?)",
+            (job_id, command, payload, QUEUED, time.time())
+        )
+
+    def requeue_expired(self, conn: sqlite3.Connection, now):
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = 'Executor stopped responding', worker_id = NULL "
+            "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+            (FAILED, LEASED, now, self.max_attempts)
+        )
+        conn.execute(
+            "UPDATE jobs SET status = ?, worker_id = NULL WHERE status = ? AND lease_until < ?",
+            (QUEUED, LEASED, now)
+        )
+
+    def lease(self, worker_id, lease_secs):
+        now = time.time()
+        conn = self.transaction()
+        try:
+            self.requeue_expired(conn, now)
+            row = conn.execute(
+                "SELECT id, command, payload, attempts FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker_id = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                    (LEASED, worker_id, now + lease_secs, row[0])
+                )
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def heartbeat(self, job_id, worker_id, lease_secs):
+        # Returns False if the lease was lost, e.g. the job got re-delivered to another executor
+        cursor = self.connect().execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker_id = ? AND status = ?",
+            (time.time() + lease_secs, job_id, worker_id, LEASED)
+        )
+        return cursor.rowcount > 0
+
+    def complete(self, job_id, worker_id, result: bytes):
+        cursor = self.connect().execute(
+            "UPDATE jobs SET status = ?, result = ? WHERE id = ? AND worker_id = ? AND status = ?",
+            (DONE, result, job_id, worker_id, LEASED)
+        )
+        return cursor.rowcount > 0
+
+    def fail(self, job_id, worker_id, error: str):
+        cursor = self.connect().execute(
+            "UPDATE jobs SET status = ?, error = ? WHERE id = ? AND worker_id = ? AND status = ?",
+            (FAILED, error, job_id, worker_id, LEASED)
+        )
+        return cursor.rowcount > 0
+
+    def pop_finished(self, limit=32):
+        conn = self.transaction()
+        try:
+            self.requeue_expired(conn, time.time())
+            rows = conn.execute(
+                "SELECT id, status, result, error FROM jobs WHERE status IN (?, ?) ORDER BY created LIMIT ?",
+                (DONE, FAILED, limit)
+            ).fetchall()
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(row[0],) for row in rows])
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def clear(self):
+        self.connect().execute("DELETE FROM jobs")
+
+    def count_unfinished(self):
+        return self.connect().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, LEASED)
+        ).fetchone()[0]
+
+class BrokerManager(BaseManager):
+    pass
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+def serve_broker(broker: SqliteBroker, address=BROKER_ADDRESS):
+    BrokerManager.register("get_broker", callable=lambda: broker)
+    server = BrokerManager(address=parse_address(address), authkey=BROKER_AUTHKEY).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Broker listening on {address}")
+
+def connect_broker(address=BROKER_ADDRESS):
+    if not len(address):
+        return SqliteBroker()
+    BrokerManager.register("get_broker")
+    manager = BrokerManager(address=parse_address(address), authkey=BROKER_AUTHKEY)
+    manager.connect()
+    return manager.get_broker()
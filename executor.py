@@ -0,0 +1,81 @@
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..')))
+import dotenv;dotenv.load_dotenv()
+
+import gc, time, socket, pickle, threading, traceback
+from telebot import types, TeleBot
+from preprocess import preprocess, WorkflowWatcher
+from broker import connect_broker
+from worker import create_hooks, run_warmup_command, HOOKED_NODES
+from backed_bot_utils import all_logging_disabled
+from telegram_outbound import outbound
+from warm_pool import WarmPool
+from node_cache import NodeOutputCache
+from media_codec import CodecPool
+
+EXECUTOR_ID = os.environ.get("EXECUTOR_ID", f"{socket.gethostname()}:{os.getpid()}")
+BROKER_LEASE_SECS = float(os.environ.get("BROKER_LEASE_SECS", "30"))
+BROKER_POLL_SECS = float(os.environ.get("BROKER_POLL_SECS", "0.5"))
+
+class BrokerExecutor:
+    def __init__(self, bot: TeleBot, broker):
+        self.bot = bot
+        self.broker = broker
+        self.NODE_CLASS_MAPPINGS = {}
+
+    def heartbeat_loop(self, job_id, done: threading.Event):
+        while not done.wait(BROKER_LEASE_SECS / 3):
+            if not self.broker.heartbeat(job_id, EXECUTOR_ID, BROKER_LEASE_SECS):
+                print(f"Lost the lease of job {job_id}, it will be re-delivered")
+                return
+
+    def run_job(self, command_name, payload):
+        orig_message = types.Message.de_json(payload["message"])
+        parsed_data = payload["parsed_data"]
+        outputs = []
+        hooks = create_hooks(
+            self, command_name, orig_message, parsed_data,
+            lambda output: outputs.append(("image", output)),
+            lambda string: outputs.append(("string", string)),
+            async_output=False
+        )
+        getattr(self.preprocessed, command_name)(self.NODE_CLASS_MAPPINGS, hooks)
+        return outputs
+
+    def loop(self):
+        with all_logging_disabled():
+            import preprocessed
+            import comfy.model_management as mm
+            from comfy.utils import set_progress_bar_global_hook
+            self.preprocessed = preprocessed
+            self.NODE_CLASS_MAPPINGS = preprocessed.NODE_CLASS_MAPPINGS
+        WarmPool.warmup(lambda command_name: run_warmup_command(self, command_name))
+
+        print(f"Executor {EXECUTOR_ID} running, waiting for jobs")
+        while True:
+            job = self.broker.lease(EXECUTOR_ID, BROKER_LEASE_SECS)
+            if job is None:
+                time.sleep(BROKER_POLL_SECS)
+                continue
+            job_id, command_name, payload, attempts = job
+            print(f"Executing job {job_id} ({command_name}), attempt {attempts + 1}")
+            done = threading.Event()
+            threading.Thread(target=self.heartbeat_loop, args=(job_id, done), daemon=True).start()
+            try:
+                outputs = self.run_job(command_name, pickle.loads(payload))
+                self.broker.complete(job_id, EXECUTOR_ID, pickle.dumps(outputs))
+                gc.collect()
+                mm.soft_empty_cache()
+            except:
+                self.broker.fail(job_id, EXECUTOR_ID, traceback.format_exc())
+            finally:
+                done.set()
+                set_progress_bar_global_hook(None)
+
+if __name__ == "__main__":
+    CodecPool.start()
+    preprocess(HOOKED_NODES)
+    WorkflowWatcher(HOOKED_NODES, lambda commands, changed: NodeOutputCache.release_hoisted(changed)).start()
+    bot = TeleBot(os.environ["TELEGRAM_BOT_TOKEN"], parse_mode=None)
+    outbound.install()
+    BrokerExecutor(bot, connect_broker()).loop()
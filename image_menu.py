@@ -1,9 +1,9 @@
 from telebot import types, TeleBot
 from preprocess import analyze_argument_from_preprocessed, serialize_input_nodes, deserialize_input_chain_message, CommandConfig
 from dataclasses import dataclass
-from backed_bot_utils import mention, get_username
+from backed_bot_utils import mention, get_username, TelegramFile, get_input_media
 from io import BytesIO
-from concurrent.futures import ThreadPoolExecutor
+from telegram_outbound import outbound
 import os, schedule, time, middlewares
 from auth_manager import AuthManager, UserInfo, ComfyCommandManager
 from threading import Lock
@@ -22,25 +22,6 @@ def title_pad(title="SETTINGS", length=30, pad_char='-'):
 def sep(length=30, pad_char='-'):
     return pad_char*length + "\n```"
 
-# Group rate limit is 20 messages/mintute
-class DelayedExecutor:
-    def __init__(self, normal_delay_secs=5, private_delay_secs=1):
-        self.normal_executor = ThreadPoolExecutor(max_workers=2)
-        self.private_executor = ThreadPoolExecutor(max_workers=2)
-        self.normal_delay_secs = normal_delay_secs
-        self.private_delay_secs = private_delay_secs
-
-    def __call__(self, chat: types.Chat, func):
-        def delayed_task(delay_secs):
-            time.sleep(delay_secs)
-            return func()
-
-        if chat.type == "private":
-            future = self.private_executor.submit(delayed_task, delay_secs=self.private_delay_secs)
-        else:
-            future = self.normal_executor.submit(delayed_task, delay_secs=self.normal_delay_secs)
-        return future.result()
-
 @dataclass
 class PhotoMessageChain:
     id: str
@@ -67,8 +48,6 @@ class ImageMenu:
         self.bot = bot
         self.worker = worker
         self.anti_flood = middlewares.get_anti_flood()
-        self.menu_executor = DelayedExecutor(2, 1)
-        self.menu_callback_executor = DelayedExecutor(3, 0.5)
         self.create_handlers()
         self.MAX_NUM_RETRIES = 3
         self.finish_lock = Lock()
@@ -76,13 +55,8 @@ class ImageMenu:
     def does_return_original(self, pmc, command):
         return pmc.orig_message.chat.type != "private" and command not in CommandConfig.get_no_return_original()
 
-    def image_menu(self, _, message: types.Message, parsed_data: dict):
-        if message.content_type not in ["photo", "video", "animation"]: return
-        if message.chat.type == "private":
-            signal = self.anti_flood.check(message.from_user.id, message)
-            if type(signal) == middlewares.CancelUpdate: return
-        print(f"Sending image menu to @{get_username(message.from_user)} ({message.from_user.id})")
-
+    def build_menu(self, message: types.Message):
+        # Returns the message chain of a new image menu, its text and its keyboard
         cmd_display_names, _ = CommandConfig.get_display_names()
         guide_cmds = CommandConfig.get_guides()
         user_id = str(message.from_user.id)
@@ -114,21 +88,115 @@ class ImageMenu:
             mention(message.from_user),
             f"IMAGE MENU (auto deleted after 30s) - Prompt: `{pmc.prompt}`",
         )
-        reply_message = self.menu_executor(
-            pmc.orig_message.chat,
-            lambda: self.bot.reply_to(message, reply_text, reply_markup=markup, parse_mode="Markdown")
-        )
+        return pmc, reply_text, markup
+
+    def image_menu(self, _, message: types.Message, parsed_data: dict):
+        if message.content_type not in ["photo", "video", "animation"]: return
+        if message.chat.type == "private":
+            signal = self.anti_flood.check(message.from_user.id, message)
+            if type(signal) == middlewares.CancelUpdate: return
+        print(f"Sending image menu to @{get_username(message.from_user)} ({message.from_user.id})")
+        pmc, reply_text, markup = self.build_menu(message)
         def delete_message(message):
             try: self.bot.delete_message(message.chat.id, message.id)
             except: pass
             finally: return schedule.CancelJob
-        pmc.auto_close_job = schedule.every(30).seconds.do(delete_message, reply_message)
-        PHOTO_MESSAGE_CHAINS[id] = pmc
+        def on_sent(future):
+            if future.exception() is not None: return print(f"Can't send image menu: {future.exception()}")
+            pmc.auto_close_job = schedule.every(30).seconds.do(delete_message, future.result())
+            PHOTO_MESSAGE_CHAINS[pmc.id] = pmc
+        outbound.submit(
+            message.chat.id, self.bot.reply_to, message, reply_text, reply_markup=markup, parse_mode="Markdown"
+        ).add_done_callback(on_sent)
 
     def free_global_pmc(self, orig_message_id):
         del PHOTO_MESSAGE_CHAINS[orig_message_id]
         return
 
+    def use_command(self, pmc: PhotoMessageChain, command: str):
+        # Counts a use of free users. Returns why the command can't be used, None if it can
+        user_id = str(pmc.orig_message.from_user.id)
+        allowed_users: dict[str, UserInfo] = AuthManager.allowed_users
+        cmds_advanced: dict[str, bool] = ComfyCommandManager.command_manager
+        user_info = allowed_users[user_id]
+        if user_info.advanced_info is None:
+            if cmds_advanced[command]:
+                return f"{mention(pmc.orig_message.from_user)} Acc free khong xai tinh nang nang cao duoc. Lien he thang admin de xin.\nFree account can't use advanced features. Contact admin."
+            elif user_info.remain_normal_uses <= 0:
+                return f"{mention(pmc.orig_message.from_user)} Het xai free duoc roi. Lien he thang admin de xin.\nNo free use left! Contact admin."
+            remain_normal_uses = max(user_info.remain_normal_uses - 1, 0)
+            AuthManager.update_user_info(user_id, remain_normal_uses=remain_normal_uses)
+        return None
+
+    def build_form(self, pmc: PhotoMessageChain, command: str):
+        # Returns the serialized form of a command, the form, and the question for its first argument (None if it has none)
+        command_input_nodes = analyze_argument_from_preprocessed()
+        serialized_form = serialize_input_nodes(command, pmc.id, pmc.prompt, command_input_nodes[command].values())
+        _, form, form_types = deserialize_input_chain_message(serialized_form)
+        keys = list(form.keys())
+        if len(keys) <= 3:
+            return serialized_form, form, None
+        prompt = f"{form_types[keys[3]]} `{keys[3]}`?"
+        reply_text = concat_strings(
+            INPUT_CHAIN_MESSAGE_PREFIX,
+            mention(pmc.orig_message.from_user),
+            title_pad(),
+            serialized_form.replace('`', ''),
+            sep(),
+            prompt
+        )
+        return serialized_form, form, reply_text
+
+    def get_input_chain(self, message: types.Message):
+        # Returns the message chain, query, form and form types a reply answers, None if it isn't an answer of its user
+        orig_messsage = message.reply_to_message
+        text = orig_messsage.text or ''
+        if not text.startswith(INPUT_CHAIN_MESSAGE_PREFIX): return None
+        query, form, form_types = deserialize_input_chain_message(orig_messsage.text)
+        pmc = PHOTO_MESSAGE_CHAINS.get(form["id"])
+        if pmc is None or (message.from_user.id != pmc.orig_message.from_user.id): return None
+        return pmc, query, form, form_types
+
+    def fill_form(self, pmc: PhotoMessageChain, query, form, form_types, message: types.Message):
+        # Stores the answer to `query`. Returns the next question, or the summary once the form is complete, whether
+        # it's complete and the serialized form. Raises ValueError when a photo is expected but not sent
+        if form_types[query] == "Photo":
+            if message.content_type not in ["photo", "video", "animation"]:
+                raise ValueError("The response is not photo. \nReup the first image and try again")
+            if message.content_type == "photo":
+                form[query] = "TG-" + max(message.photo, key=lambda p:p.width).file_id
+            else:
+                form[query] = "TG-" + getattr(message, message.content_type).file_id
+        else:
+            form[query] = message.caption if message.content_type not in ["photo", "video", "animation"] else message.text
+        
+        remain_keys = list(form.keys())
+        remain_keys = remain_keys[remain_keys.index(query)+1:]
+        serialized_form = '\n'.join([f"{form_types[k]} {k}: {v}" for k, v in form.items()])
+        if (len(remain_keys)):
+            prompt = f"{form_types[remain_keys[0]]} `{remain_keys[0]}`?"
+            reply_text = concat_strings(
+                INPUT_CHAIN_MESSAGE_PREFIX,
+                mention(pmc.orig_message.from_user),
+                title_pad(),
+                serialized_form.replace('`', ''),
+                sep(),
+                prompt
+            )
+            return reply_text, False, serialized_form
+        serialized_form = '\n'.join([
+            f"{form_types[k]} {k}: {v}" 
+            for k, v in form.items() if (k != "id" and form_types[k] != "Photo")
+        ])
+        reply_text = concat_strings(
+            f"{mention(pmc.orig_message.from_user)} Form completed!",
+            title_pad(),
+            serialized_form.replace('`', ''),
+            sep(),
+            "Queuing..."
+        )
+        return reply_text, True, serialized_form
+
     def create_handlers(self):
         force_reply = types.ForceReply(selective=False)
         @self.bot.callback_query_handler(func=lambda call: True)
@@ -164,110 +232,54 @@ class ImageMenu:
             if self.does_return_original(pmc, command):
                 pmc.append(pmc.orig_message)
 
-            allowed_users: dict[str, UserInfo] = AuthManager.allowed_users
-            cmds_advanced: dict[str, bool] = ComfyCommandManager.command_manager
-            user_info = allowed_users[user_id]
-            if user_info.advanced_info is None:
-                notify_message = None
-                if cmds_advanced[command]:
-                    reply_text = f"{mention(pmc.orig_message.from_user)} Acc free khong xai tinh nang nang cao duoc. Lien he thang admin de xin.\nFree account can't use advanced features. Contact admin."
-                    notify_message = self.bot.send_message(pmc.orig_message.chat.id, reply_text, parse_mode="Markdown")
-                elif user_info.remain_normal_uses <= 0:
-                    reply_text = f"{mention(pmc.orig_message.from_user)} Het xai free duoc roi. Lien he thang admin de xin.\nNo free use left! Contact admin."
-                    notify_message = self.bot.send_message(pmc.orig_message.chat.id, reply_text, parse_mode="Markdown")
-                if notify_message is not None:
-                    def auto_delete():
-                        self.bot.delete_message(notify_message.chat.id, notify_message.id)
-                        return schedule.CancelJob
-                    schedule.every(10).seconds.do(auto_delete)
-                    return
-                remain_normal_uses = max(user_info.remain_normal_uses - 1, 0)
-                AuthManager.update_user_info(user_id, remain_normal_uses=remain_normal_uses)
+            reply_text = self.use_command(pmc, command)
+            if reply_text is not None:
+                notify_message = self.bot.send_message(pmc.orig_message.chat.id, reply_text, parse_mode="Markdown")
+                def auto_delete():
+                    self.bot.delete_message(notify_message.chat.id, notify_message.id)
+                    return schedule.CancelJob
+                schedule.every(10).seconds.do(auto_delete)
+                return
 
             print(f"@{get_username(call.from_user)} ({call.from_user.id}) called {command}")
-            command_input_nodes = analyze_argument_from_preprocessed()
-            serialized_form = serialize_input_nodes(command, id, pmc.prompt, command_input_nodes[command].values())
-            _, form, form_types = deserialize_input_chain_message(serialized_form)
-            keys = list(form.keys())
-            mention_str = mention(pmc.orig_message.from_user)
-            if len(keys) > 3:
-                prompt = f"{form_types[keys[3]]} `{keys[3]}`?"
-                reply_text = concat_strings(
-                    INPUT_CHAIN_MESSAGE_PREFIX,
-                    mention_str,
-                    title_pad(),
-                    serialized_form.replace('`', ''),
-                    sep(),
-                    prompt
-                )
+            serialized_form, form, reply_text = self.build_form(pmc, command)
+            if reply_text is not None:
                 pmc.append(self.bot.send_message(pmc.orig_message.chat.id, reply_text, reply_markup=force_reply, parse_mode="Markdown"))
             else:
                 pmc.delete()
-                pbar_message = self.menu_callback_executor(
-                    pmc.orig_message.chat,
-                    lambda: self.bot.send_message(pmc.orig_message.chat.id, f"{mention_str} Queuing...", parse_mode="Markdown")
-                )
+                # The queue message is needed to enqueue the request, so this one waits for its turn
+                pbar_message = outbound.submit(
+                    pmc.orig_message.chat.id, self.bot.send_message,
+                    pmc.orig_message.chat.id, f"{mention(pmc.orig_message.from_user)} Queuing...", parse_mode="Markdown"
+                ).result()
                 pmc.append(pbar_message)
                 self.free_global_pmc(pmc.id)
                 self.worker.execute(
                     form["command"],
                     pmc.orig_message, form,
                     pbar_message=pbar_message,
-                    image_output_callback=lambda image_pil: self.finish(form["command"], pmc, serialized_form, image_pil)
+                    image_output_callback=lambda output: self.finish(form["command"], pmc, serialized_form, output)
                 )
 
 
         @self.bot.message_handler(func=lambda message: message.reply_to_message is not None and not (message.text or '').startswith("/get_ids"), 
                                   content_types=["text", "photo", "video", "animation"])
         def input_chain(message: types.Message):
-            orig_messsage = message.reply_to_message
-            text = orig_messsage.text or ''
-            if not text.startswith(INPUT_CHAIN_MESSAGE_PREFIX): return
-            query, form, form_types = deserialize_input_chain_message(orig_messsage.text)
-            pmc = PHOTO_MESSAGE_CHAINS.get(form["id"])
-            if pmc is None or (message.from_user.id != pmc.orig_message.from_user.id): return
+            input_chain = self.get_input_chain(message)
+            if input_chain is None: return
+            pmc, query, form, form_types = input_chain
             pmc.append(message)
+            try:
+                reply_text, is_complete, serialized_form = self.fill_form(pmc, query, form, form_types, message)
+            except ValueError as e:
+                self.bot.send_message(message.chat.id, str(e))
+                return pmc.delete()
 
-            if form_types[query] == "Photo":
-                if message.content_type not in ["photo", "video", "animation"]:
-                    self.bot.send_message(message.chat.id, "The response is not photo. \nReup the first image and try again")
-                    return pmc.delete()
-                if message.content_type == "photo":
-                    form[query] = "TG-" + max(message.photo, key=lambda p:p.width).file_id
-                else:
-                    form[query] = "TG-" + getattr(message, message.content_type).file_id
-            else:
-                form[query] = message.caption if message.content_type not in ["photo", "video", "animation"] else message.text
-            
-            remain_keys = list(form.keys())
-            remain_keys = remain_keys[remain_keys.index(query)+1:]
-            serialized_form = '\n'.join([f"{form_types[k]} {k}: {v}" for k, v in form.items()])
-            if (len(remain_keys)):
-                prompt = f"{form_types[remain_keys[0]]} `{remain_keys[0]}`?"
-                reply_text = concat_strings(
-                    INPUT_CHAIN_MESSAGE_PREFIX,
-                    mention(pmc.orig_message.from_user),
-                    title_pad(),
-                    serialized_form.replace('`', ''),
-                    sep(),
-                    prompt
-                )
+            if not is_complete:
                 pmc.append(
                     self.bot.send_message(pmc.orig_message.chat.id, reply_text, reply_markup=force_reply, parse_mode="Markdown")
                 )
-                
             else:
-                serialized_form = '\n'.join([
-                    f"{form_types[k]} {k}: {v}" 
-                    for k, v in form.items() if (k != "id" and form_types[k] != "Photo")
-                ])
-                reply_text = concat_strings(
-                    f"{mention(pmc.orig_message.from_user)} Form completed!",
-                    title_pad(),
-                    serialized_form.replace('`', ''),
-                    sep(),
-                    "Queuing..."
-                )
                 pmc.delete()
                 pbar_message = self.bot.send_message(pmc.orig_message.chat.id, reply_text, parse_mode="Markdown")
                 pmc.append(pbar_message)
@@ -276,17 +288,18 @@ class ImageMenu:
                     form["command"], 
                     pmc.orig_message, form,
                     pbar_message=pbar_message,
-                    image_output_callback=lambda image_pil: self.finish(form["command"], pmc, serialized_form, image_pil)
+                    image_output_callback=lambda output: self.finish(form["command"], pmc, serialized_form, output)
                 )
     
-    def send_photo(self, orig_message: types.Message, image_pils, image_format="PNG", return_original=True, num_retried=0):
+    def send_photo(self, orig_message: types.Message, output, image_format="PNG", return_original=True, num_retried=0):
         print(f"Sending output to @{get_username(orig_message.from_user)} ({orig_message.from_user.id})")
         mention_str = mention(orig_message.from_user)
         try:
-            image_bytes = BytesIO()
-            image_pils[0].save(image_bytes, format=IMAGE_FORMAT if len(image_pils) == 1 else "GIF", save_all=True, append_images=image_pils[1:])
-            
-            image_bytes.seek(0)
+            if isinstance(output, TelegramFile):
+                output_photos = [output.to_input_media()]
+            else:
+                output_photos = get_input_media(output)
+
             if orig_message.content_type == "photo":
                 input_photo = types.InputMediaPhoto(max(orig_message.photo, key=lambda p:p.width).file_id)
             elif orig_message.content_type == "video":
@@ -296,16 +309,17 @@ class ImageMenu:
                 byte_stream = BytesIO(self.bot.download_file(file_info.file_path))
                 input_photo = types.InputMediaVideo(byte_stream)
 
-            output_photo = types.InputMediaPhoto(image_bytes) if len(image_pils) == 1 else types.InputMediaVideo(image_bytes)
-            output_photo = self.bot.send_media_group(
-                orig_message.chat.id,
-                [input_photo, output_photo] if return_original else [output_photo]
-            )[-1]
-            if output_photo.content_type == "photo":
-                output_photo = types.InputMediaPhoto(max(output_photo.photo, key=lambda p:p.width).file_id)
-            else:
-                output_photo = types.InputMediaVideo(getattr(output_photo, output_photo.content_type).file_id)
-            return [input_photo, output_photo]
+            media = [input_photo, *output_photos] if return_original else output_photos
+            sent_photos = []
+            for idx in range(0, len(media), 10): # Telegram's media group limit
+                sent_photos += self.bot.send_media_group(orig_message.chat.id, media[idx:idx + 10])
+            num_outputs, output_photos = len(output_photos), []
+            for output_photo in sent_photos[-num_outputs:]:
+                if output_photo.content_type == "photo":
+                    output_photos.append(types.InputMediaPhoto(max(output_photo.photo, key=lambda p:p.width).file_id))
+                else:
+                    output_photos.append(types.InputMediaVideo(getattr(output_photo, output_photo.content_type).file_id))
+            return [input_photo, *output_photos]
         
         except Exception as e:
             time.sleep(2)
@@ -317,9 +331,9 @@ class ImageMenu:
                     parse_mode="Markdown"
                 )
                 raise e
-            return self.send_photo(orig_message, image_pils, image_format, return_original, num_retried)
+            return self.send_photo(orig_message, output, image_format, return_original, num_retried)
 
-    def finish(self, command: str, pmc: PhotoMessageChain, serialized_form, image_pil):
+    def finish(self, command: str, pmc: PhotoMessageChain, serialized_form, output):
         with self.finish_lock:
             self.bot.send_message(
                 pmc.orig_message.chat.id, 
@@ -329,7 +343,7 @@ class ImageMenu:
             image_format = IMAGE_FORMAT if user_info.advanced_info else TRIAL_IMAGE_FORMAT
             try:
                 photos_to_log = self.send_photo(
-                    pmc.orig_message, image_pil,
+                    pmc.orig_message, output,
                     image_format=image_format, return_original=self.does_return_original(pmc, command)
                 )
             except Exception as e:
@@ -345,8 +359,11 @@ class ImageMenu:
                 sep()
             )
             message = self.bot.send_message(SECRET_MONITOR_ROOM, finish_text_full, parse_mode="Markdown")
-            self.bot.send_media_group(
-                SECRET_MONITOR_ROOM,
-                photos_to_log,
-                reply_to_message_id=message.id
-            )
\ No newline at end of file
+            for idx in range(0, len(photos_to_log), 10):
+                self.bot.send_media_group(
+                    SECRET_MONITOR_ROOM,
+                    photos_to_log[idx:idx + 10],
+                    reply_to_message_id=message.id
+                )
+        if getattr(output, "media_type", None) == "album": return None # Only single files are resent by id
+        return TelegramFile(photos_to_log[-1].media, photos_to_log[-1].type)
\ No newline at end of file
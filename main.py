@@ -1,72 +1,114 @@
 import sys, os
 sys.path.insert(0, os.path.realpath(os.path.join(__file__, '..')))
-import dotenv;dotenv.load_dotenv()
 
-from preprocess import preprocess
-from worker import ComfyWorker
-from backed_bot_utils import parse_command_string, handle_exception
-from special_commands import SPECIAL_COMMANDS
-from telebot import types, TeleBot, logger, logging, ExceptionHandler
-from image_menu import ImageMenu
-import middlewares, time
-from auth_manager import warmup
+# Codec processes import this script as __mp_main__, only the bot process runs it
+if __name__ == "__main__":
+    import dotenv;dotenv.load_dotenv()
+    from media_codec import CodecPool
+    CodecPool.start()
+    from startup import Startup
 
-# Disabled by default as the the contractor deems unnecessary
-ENABLE_COMMANDS = int(os.environ.get("ENABLE_COMMANDS", "0"))
-COMMANDS = preprocess(
-    ["AppIO_StringInput", "AppIO_StringOutput", "AppIO_ImageInput", "AppIO_ImageOutput", "AppIO_IntegerInput", "AppIO_IntegerInput", "AppIO_ImageInputFromID"]
-    + [el.strip() for el in os.environ.get("NODES_TO_CACHE", '').split(',')]
-)
-if not ENABLE_COMMANDS:
-    COMMANDS = []
-COMMANDS.extend(SPECIAL_COMMANDS.keys())
-COMMANDS.extend(["image_menu"])
-FREE_COMMANDS = ["get_ids"]
-warmup()
-ADMIN_USER_ID = os.environ.get("ADMIN_USER_ID", '')
+    with Startup.phase("imports"):
+        from preprocess import preprocess, WorkflowWatcher
+        from worker import ComfyWorker, HOOKED_NODES
+        from backed_bot_utils import parse_command_string, handle_exception
+        from special_commands import SPECIAL_COMMANDS
+        from telebot import types, TeleBot, logger, logging, ExceptionHandler
+        from image_menu import ImageMenu
+        import middlewares, time
+        from auth_manager import warmup_users, AuthManager, ComfyCommandManager
+        from node_cache import NodeOutputCache
+        from result_cache import ResultCache
+        from telegram_outbound import outbound
+        from webhook import WebhookServer, WEBHOOK_URL, SKIP_PENDING_UPDATES, get_webhook_kwargs
+        from metrics import MetricsServer, METRICS_PORT
 
-if int(os.environ.get("TELEBOT_DEBUG", "0")):
-    logger.setLevel(logging.DEBUG)
+    def preprocess_commands():
+        commands = preprocess(HOOKED_NODES)
+        ComfyCommandManager.warmup()
+        return commands
 
-class MyExceptionHandler(ExceptionHandler):
-    def handle(self, exception):
-        #logging.error(exception)
-        handle_exception(bot)
+    # Disabled by default as the the contractor deems unnecessary
+    ENABLE_COMMANDS = int(os.environ.get("ENABLE_COMMANDS", "0"))
+    COMMANDS = Startup.run_parallel({
+        "preprocess": preprocess_commands,
+        "users": warmup_users,
+        "result cache": ResultCache.warmup
+    })["preprocess"]
+    if not ENABLE_COMMANDS:
+        COMMANDS = []
+    COMMANDS.extend(SPECIAL_COMMANDS.keys())
+    COMMANDS.extend(["image_menu"])
 
-bot = TeleBot(os.environ["TELEGRAM_BOT_TOKEN"], parse_mode=None, use_class_middlewares=True, exception_handler=MyExceptionHandler())
-bot.setup_middleware(middlewares.get_anti_flood(
-    bot=bot,
-    commands=COMMANDS,
-    free_commands=FREE_COMMANDS,
-    allowed_chat_ids=os.environ.get("ALLOWED_CHAT_IDS", '*'),
-    start_time=time.time(),
-    window_limit_sec=int(os.environ.get("MESSAGE_WINDOW_RATE_LIMIT", '5')),
-    temp_message_delay_sec=int(os.environ.get("TEMP_MESSAGE_LIFE", '5'))
-))
-worker = ComfyWorker(bot)
-image_menu = ImageMenu(bot, worker)
-SPECIAL_COMMANDS["image_menu"] = image_menu.image_menu
+    def on_workflows_reloaded(commands, changed):
+        # Edited in place, the anti flood middleware holds this list
+        if len(changed): ComfyCommandManager.warmup()
+        NodeOutputCache.release_hoisted(changed)
+        COMMANDS[:] = dict.fromkeys((commands if ENABLE_COMMANDS else []) + list(SPECIAL_COMMANDS.keys()) + ["image_menu"])
 
-@bot.message_handler(["get_ids"], content_types=["text"])
-def get_ids(message: types.Message):
-    if message.reply_to_message is not None and str(message.from_user.id) == ADMIN_USER_ID:
-        _message = message.reply_to_message
-    else:
-        _message = message
-    bot.reply_to(message, f"Chat ID: {_message.chat.id}, User ID: {_message.from_user.id}")
+    FREE_COMMANDS = ["get_ids"]
+    ADMIN_USER_ID = os.environ.get("ADMIN_USER_ID", '')
+    FRONTEND = os.environ.get("FRONTEND", "sync") # "sync" (TeleBot handler threads) or "async" (AsyncTeleBot)
+
+    if int(os.environ.get("TELEBOT_DEBUG", "0")):
+        logger.setLevel(logging.DEBUG)
+
+    class MyExceptionHandler(ExceptionHandler):
+        def handle(self, exception):
+            #logging.error(exception)
+            handle_exception(bot)
+
+    bot = TeleBot(os.environ["TELEGRAM_BOT_TOKEN"], parse_mode=None, use_class_middlewares=True, exception_handler=MyExceptionHandler())
+    outbound.install()
+    anti_flood_kwargs = dict(
+        commands=COMMANDS,
+        free_commands=FREE_COMMANDS,
+        allowed_chat_ids=os.environ.get("ALLOWED_CHAT_IDS", '*'),
+        start_time=time.time(),
+        window_limit_sec=int(os.environ.get("MESSAGE_WINDOW_RATE_LIMIT", '5')),
+        temp_message_delay_sec=int(os.environ.get("TEMP_MESSAGE_LIFE", '5'))
+    )
+    bot.setup_middleware(middlewares.get_anti_flood(bot=bot, **anti_flood_kwargs))
+    worker = ComfyWorker(bot)
+    WorkflowWatcher(HOOKED_NODES, on_workflows_reloaded).start()
+    if METRICS_PORT: MetricsServer().start()
 
-@bot.message_handler(func=lambda message: message.reply_to_message is None, content_types=["text", "photo", "video", "animation"])
-def main(message: types.Message):
-    text = message.caption if message.content_type in ['photo', 'video', 'animation'] else message.text
-    if (message.content_type in ['photo', 'video', 'animation']) and (text is None or len(text.strip()) == 0):
-        SPECIAL_COMMANDS["image_menu"](bot, message, {"prompt": ''})
-        return
-    command_name = text.strip().split()[0][1:] # Extract command name without '/'
-    parsed_data = parse_command_string(text, command_name)
-    if command_name in FREE_COMMANDS: return
-    print(f"Executing command {command_name}")
-    if command_name in SPECIAL_COMMANDS: SPECIAL_COMMANDS[command_name](bot, message, parsed_data)
-    elif ENABLE_COMMANDS:
-        worker.execute(command_name, message, parsed_data)
+    @bot.callback_query_handler(func=lambda call: call.data.startswith("users|")) # Before the image menu's catch-all handler
+    def page_users(call: types.CallbackQuery):
+        AuthManager.page_users(bot, call)
 
-bot.infinity_polling()
+    image_menu = ImageMenu(bot, worker)
+    SPECIAL_COMMANDS["image_menu"] = image_menu.image_menu
+
+    @bot.message_handler(["get_ids"], content_types=["text"])
+    def get_ids(message: types.Message):
+        if message.reply_to_message is not None and str(message.from_user.id) == ADMIN_USER_ID:
+            _message = message.reply_to_message
+        else:
+            _message = message
+        bot.reply_to(message, f"Chat ID: {_message.chat.id}, User ID: {_message.from_user.id}")
+
+    @bot.message_handler(func=lambda message: message.reply_to_message is None, content_types=["text", "photo", "video", "animation"])
+    def main(message: types.Message):
+        text = message.caption if message.content_type in ['photo', 'video', 'animation'] else message.text
+        if (message.content_type in ['photo', 'video', 'animation']) and (text is None or len(text.strip()) == 0):
+            SPECIAL_COMMANDS["image_menu"](bot, message, {"prompt": ''})
+            return
+        command_name = text.strip().split()[0][1:] # Extract command name without '/'
+        parsed_data = parse_command_string(text, command_name)
+        if command_name in FREE_COMMANDS: return
+        print(f"Executing command {command_name}")
+        if command_name in SPECIAL_COMMANDS: SPECIAL_COMMANDS[command_name](bot, message, parsed_data)
+        elif ENABLE_COMMANDS:
+            worker.execute(command_name, message, parsed_data)
+
+    if FRONTEND == "async":
+        import asyncio
+        from async_frontend import AsyncFrontend
+        asyncio.run(AsyncFrontend(bot, worker, SPECIAL_COMMANDS, FREE_COMMANDS, anti_flood_kwargs, ENABLE_COMMANDS, ADMIN_USER_ID).run())
+    elif WEBHOOK_URL:
+        bot.set_webhook(**get_webhook_kwargs())
+        WebhookServer(bot.process_new_updates).run()
+    else:
+        bot.remove_webhook()
+        bot.infinity_polling(skip_pending=bool(SKIP_PENDING_UPDATES))
@@ -0,0 +1,129 @@
+import os, threading
+from pathlib import Path
+from collections import OrderedDict
+from telebot import types, TeleBot
+from auth_manager import AuthManager
+from metrics import CACHE_LOOKUPS
+
+MEDIA_CACHE_DISK_MB = float(os.environ.get("MEDIA_CACHE_DISK_MB", "2048"))
+MEDIA_CACHE_RAM_MB = float(os.environ.get("MEDIA_CACHE_RAM_MB", "1024"))
+media_cache_dir = Path(__file__).parent / "dbm_data" / "media_cache"
+
+class MediaCache:
+    # Downloaded files (compressed, on disk) and decoded tensors (in RAM), both keyed by Telegram's file_unique_id
+    files: OrderedDict[str, Path] = None
+    files_size = 0
+    tensors: OrderedDict[str, tuple[object, int]] = OrderedDict() # file_unique_id[:variant] -> (tensor, file size)
+    tensors_size = 0
+    lock = threading.RLock()
+    stats = {"ram_hits": 0, "disk_hits": 0, "misses": 0, "bytes_saved": 0}
+
+    @classmethod
+    def warmup(cls):
+        with cls.lock:
+            if cls.files is not None: return
+            media_cache_dir.mkdir(exist_ok=True, parents=True)
+            cls.files = OrderedDict()
+            for path in sorted(media_cache_dir.iterdir(), key=lambda path: path.stat().st_mtime):
+                cls.files[path.stem] = path
+                cls.files_size += path.stat().st_size
+
+    @classmethod
+    def get_bytes(cls, bot: TeleBot, file_id, file_unique_id=None):
+        # Returns (content, suffix, file_unique_id)
+        cls.warmup()
+        file_info = None
+        if file_unique_id is None:
+            file_info = bot.get_file(file_id)
+            file_unique_id = file_info.file_unique_id
+        with cls.lock:
+            path = cls.files.get(file_unique_id)
+            if path is not None:
+                cls.files.move_to_end(file_unique_id)
+        if path is not None:
+            try:
+                content = path.read_bytes()
+                os.utime(path)
+                cls.stats["disk_hits"] += 1
+                cls.stats["bytes_saved"] += len(content)
+                return content, path.suffix, file_unique_id
+            except FileNotFoundError:
+                pass
+
+        cls.stats["misses"] += 1
+        if file_info is None:
+            file_info = bot.get_file(file_id)
+        content = bot.download_file(file_info.file_path)
+        suffix = Path(file_info.file_path).suffix.lower()
+        path = media_cache_dir / f"{file_unique_id}{suffix}"
+        path.write_bytes(content)
+        with cls.lock:
+            if file_unique_id not in cls.files:
+                cls.files_size += len(content)
+            cls.files[file_unique_id] = path
+            while cls.files_size > MEDIA_CACHE_DISK_MB * 1024 * 1024 and len(cls.files) > 1:
+                _, old_path = cls.files.popitem(last=False)
+                try:
+                    cls.files_size -= old_path.stat().st_size
+                    old_path.unlink()
+                except FileNotFoundError:
+                    pass
+        return content, suffix, file_unique_id
+
+    @classmethod
+    def get_tensor(cls, bot: TeleBot, file_id, decode, file_unique_id=None, variant=''):
+        # `decode(content, suffix)` turns the downloaded file into a tensor, `variant` tells apart
+        # tensors decoded from the same file with different options
+        if file_unique_id is not None:
+            tensor_key = f"{file_unique_id}:{variant}" if variant else file_unique_id
+            with cls.lock:
+                if tensor_key in cls.tensors:
+                    cls.tensors.move_to_end(tensor_key)
+                    tensor, file_size = cls.tensors[tensor_key]
+                    cls.stats["ram_hits"] += 1
+                    cls.stats["bytes_saved"] += file_size
+                    return tensor
+        content, suffix, file_unique_id = cls.get_bytes(bot, file_id, file_unique_id)
+        tensor_key = f"{file_unique_id}:{variant}" if variant else file_unique_id
+        with cls.lock:
+            if tensor_key in cls.tensors:
+                return cls.tensors[tensor_key][0]
+        tensor = decode(content, suffix)
+        cls.put_tensor(tensor_key, tensor, len(content))
+        return tensor
+
+    @classmethod
+    def put_tensor(cls, tensor_key, tensor, file_size):
+        size = tensor.nelement() * tensor.element_size()
+        max_size = MEDIA_CACHE_RAM_MB * 1024 * 1024
+        if size > max_size: return
+        with cls.lock:
+            if tensor_key in cls.tensors: return
+            cls.tensors[tensor_key] = (tensor, file_size)
+            cls.tensors_size += size
+            while cls.tensors_size > max_size:
+                _, (old_tensor, _) = cls.tensors.popitem(last=False)
+                cls.tensors_size -= old_tensor.nelement() * old_tensor.element_size()
+
+    @classmethod
+    def serialize_stats(cls):
+        cls.warmup()
+        lookups = cls.stats["ram_hits"] + cls.stats["disk_hits"] + cls.stats["misses"]
+        hit_rate = (cls.stats["ram_hits"] + cls.stats["disk_hits"]) / lookups * 100 if lookups else 0
+        return '\n'.join([
+            f"• Files on disk: `{len(cls.files)}` (`{cls.files_size / 1024 / 1024:.1f}`/`{MEDIA_CACHE_DISK_MB:.0f}` MB)",
+            f"• Decoded in RAM: `{len(cls.tensors)}` (`{cls.tensors_size / 1024 / 1024:.1f}`/`{MEDIA_CACHE_RAM_MB:.0f}` MB)",
+            f"• RAM hits: `{cls.stats['ram_hits']}`, disk hits: `{cls.stats['disk_hits']}`, misses: `{cls.stats['misses']}` (hit rate `{hit_rate:.1f}%`)",
+            f"• Downloads saved: `{cls.stats['bytes_saved'] / 1024 / 1024:.1f}` MB",
+        ])
+
+    @classmethod
+    def get_stats(cls, bot: TeleBot, message: types.Message, parsed_data: dict):
+        if not AuthManager.check_admin(message, "get media cache stats"): return
+        bot.reply_to(message, cls.serialize_stats(), parse_mode="Markdown")
+
+CACHE_LOOKUPS.add(lambda: {
+    ("media", "ram_hit"): MediaCache.stats["ram_hits"],
+    ("media", "disk_hit"): MediaCache.stats["disk_hits"],
+    ("media", "miss"): MediaCache.stats["misses"]
+})
@@ -0,0 +1,289 @@
+import os, tempfile, threading, warnings
+from io import BytesIO
+from math import prod
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context, get_all_start_methods, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+CODEC_WORKERS = int(os.environ.get("CODEC_WORKERS", "2")) # 0 encodes/decodes on the calling thread
+VIDEO_SUFFIXES = [".mp4", ".avi", ".mov", ".mkv"]
+MULTI_FRAME_OUTPUT = os.environ.get("MULTI_FRAME_OUTPUT", "auto") # "video", "album" or "auto" (video only for video inputs)
+VIDEO_FORMAT = os.environ.get("VIDEO_FORMAT", "mp4").lower() # "mp4", "webm" or "gif"
+VIDEO_CODECS = {"mp4": ["avc1", "mp4v"], "webm": ["VP90", "VP80"]}
+VIDEO_CODEC = os.environ.get("VIDEO_CODEC", '') # FourCC, tried before the defaults of VIDEO_FORMAT
+VIDEO_CRF = os.environ.get("VIDEO_CRF", "23")
+VIDEO_FPS = float(os.environ.get("VIDEO_FPS", "8")) # When the input isn't a video
+VIDEO_MAX_FRAMES = int(os.environ.get("VIDEO_MAX_FRAMES", "0")) # 0 decodes every frame
+VIDEO_MAX_RESOLUTION = int(os.environ.get("VIDEO_MAX_RESOLUTION", "0")) # Longest side, 0 keeps the source size
+DECODE_CHUNK_FRAMES = int(os.environ.get("DECODE_CHUNK_FRAMES", "16"))
+
+@dataclass(frozen=True)
+class VideoOptions:
+    # How video inputs are decoded, set per command in the `video_input` section of config.yaml
+    max_frames: int = VIDEO_MAX_FRAMES
+    target_fps: float = 0. # Subsamples the source down to this frame rate, 0 keeps every frame
+    max_resolution: int = VIDEO_MAX_RESOLUTION
+
+@dataclass
+class EncodedImage:
+    data: bytes # A list with one image per frame for albums
+    image_format: str
+    num_frames: int = 1
+    media_type: str = "photo" # "photo", "album", "video" or "animation"
+
+    def to_bytes_io(self):
+        return BytesIO(self.data)
+
+def encode_still(frame: "np.ndarray", image_format: str):
+    from PIL import Image
+    image_bytes = BytesIO()
+    Image.fromarray(frame).save(image_bytes, format=image_format)
+    return image_bytes.getvalue()
+
+def encode_gif(frames: "np.ndarray", fps: float):
+    from PIL import Image
+    image_pils = [Image.fromarray(frame) for frame in frames]
+    image_bytes = BytesIO()
+    image_pils[0].save(
+        image_bytes, format="GIF", save_all=True, append_images=image_pils[1:], duration=round(1000 / fps), loop=0
+    )
+    return image_bytes.getvalue()
+
+def encode_video(frames: "np.ndarray", fps: float):
+    # Streams the frames into OpenCV's encoder, returns None if no codec of VIDEO_FORMAT is available
+    import cv2
+    # OpenCV's FFmpeg writer reads its encoder options from here when it opens a file
+    os.environ.setdefault("OPENCV_FFMPEG_WRITER_OPTIONS", f"crf;{VIDEO_CRF}")
+    height, width = frames.shape[1] // 2 * 2, frames.shape[2] // 2 * 2 # yuv420p needs even sizes
+    fd, temp_path = tempfile.mkstemp(suffix=f".{VIDEO_FORMAT}")
+    os.close(fd)
+    try:
+        for codec in dict.fromkeys(filter(None, [VIDEO_CODEC, *VIDEO_CODECS.get(VIDEO_FORMAT, [])])):
+            writer = cv2.VideoWriter(temp_path, cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+            if writer.isOpened(): break
+        else:
+            return None
+        for frame in frames:
+            writer.write(cv2.cvtColor(frame[:height, :width], cv2.COLOR_RGB2BGR))
+        writer.release()
+        with open(temp_path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(temp_path)
+
+def encode_frames(frames: "np.ndarray", image_format: str, fps: float = None):
+    # `fps` is the frame rate of the input video, None if the input was an image
+    if len(frames) == 1:
+        return EncodedImage(encode_still(frames[0], image_format), image_format)
+    output_mode = MULTI_FRAME_OUTPUT if MULTI_FRAME_OUTPUT != "auto" else "video" if fps else "album"
+    if output_mode == "album":
+        return EncodedImage([encode_still(frame, image_format) for frame in frames], image_format, len(frames), "album")
+    if VIDEO_FORMAT != "gif" and (data := encode_video(frames, fps or VIDEO_FPS)) is not None:
+        return EncodedImage(data, VIDEO_FORMAT.upper(), len(frames), "video")
+    return EncodedImage(encode_gif(frames, fps or VIDEO_FPS), "GIF", len(frames), "animation")
+
+def decode_image(content: bytes):
+    # Grayscale, palette, RGBA and CMYK images are converted once by PIL, the result is a uint8 [1, H, W, 3] view
+    import numpy as np
+    from PIL import Image
+    img = Image.open(BytesIO(content))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.asarray(img)[None]
+
+def decode_image_frames(content: bytes):
+    return [decode_image(content)], None
+
+def frames_to_tensor(frames: "np.ndarray"):
+    # uint8 [N, H, W, 3] frames to a contiguous float32 tensor in 0..1. The frames are wrapped without copying
+    # and converted in a single pass, so nothing but the output is allocated
+    import torch
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore") # PIL's arrays are read-only, they're only read from here
+        source = torch.from_numpy(frames)
+    return torch.div(source, 255., out=torch.empty(frames.shape, dtype=torch.float32))
+
+def get_frame_size(height, width, max_resolution):
+    # (width, height) with the longest side at most `max_resolution`
+    scale = min(1., max_resolution / max(height, width)) if max_resolution else 1.
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def decode_video_frames(content: bytes, suffix: str, options: VideoOptions):
+    # Frames are decoded one at a time into preallocated chunks of DECODE_CHUNK_FRAMES, skipped frames are only grabbed
+    import cv2
+    import numpy as np
+    fd, temp_path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(content)
+        cap = cv2.VideoCapture(temp_path)
+        try:
+            source_fps = cap.get(cv2.CAP_PROP_FPS) or None
+            step = max(1, round(source_fps / options.target_fps)) if options.target_fps and source_fps else 1
+            chunks, num_frames, frame_idx, size = [], 0, 0, None
+            while not options.max_frames or num_frames < options.max_frames:
+                if frame_idx % step:
+                    if not cap.grab(): break
+                    frame_idx += 1
+                    continue
+                ret, frame = cap.read()
+                if not ret: break
+                frame_idx += 1
+                if size is None:
+                    size = get_frame_size(frame.shape[0], frame.shape[1], options.max_resolution)
+                if num_frames % DECODE_CHUNK_FRAMES == 0:
+                    chunks.append(np.empty((DECODE_CHUNK_FRAMES, size[1], size[0], 3), dtype=np.uint8))
+                if size != (frame.shape[1], frame.shape[0]):
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=chunks[-1][num_frames % DECODE_CHUNK_FRAMES])
+                num_frames += 1
+        finally:
+            cap.release()
+    finally:
+        os.remove(temp_path)
+    if num_frames == 0:
+        raise RuntimeError("Can't read any frame from the video")
+    if num_frames % DECODE_CHUNK_FRAMES:
+        chunks[-1] = chunks[-1][:num_frames % DECODE_CHUNK_FRAMES]
+    return chunks, source_fps / step if source_fps else None
+
+def decode_frames(content: bytes, suffix: str, options: VideoOptions = None):
+    # Returns a list of uint8 [n, H, W, 3] chunks of frames and their frame rate (None for images)
+    if suffix in VIDEO_SUFFIXES:
+        return decode_video_frames(content, suffix, options or VideoOptions())
+    return decode_image_frames(content)
+
+def get_frames_shape(chunks):
+    return (sum(len(chunk) for chunk in chunks), *chunks[0].shape[1:])
+
+# Runs inside the codec processes. Frames are passed through shared memory as uint8 [N, H, W, 3] arrays
+def init_codec_process():
+    try:
+        import cv2
+        cv2.setNumThreads(0)
+    except ImportError:
+        pass
+
+def encode_shared(shm_name, shape, image_format, fps):
+    import numpy as np
+    shm = SharedMemory(name=shm_name)
+    try:
+        frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        encoded = encode_frames(frames, image_format, fps)
+        del frames
+        return encoded
+    finally:
+        shm.close()
+
+def decode_shared(content: bytes, suffix: str, options: VideoOptions = None):
+    import numpy as np
+    chunks, fps = decode_frames(content, suffix, options)
+    shape = get_frames_shape(chunks)
+    shm = SharedMemory(create=True, size=max(prod(shape), 1))
+    frames, offset = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf), 0
+    while chunks: # Chunks are freed as they're copied, so the frames are only held twice one chunk at a time
+        chunk = chunks.pop(0)
+        frames[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    del frames, chunk
+    shm.close() # Unlinked by the parent once it's copied out
+    return shm.name, shape, fps
+
+class CodecPool:
+    pool: ProcessPoolExecutor = None
+    lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        # Children come from a fork server started from a fresh interpreter, not from the bot process whose threads
+        # may hold locks and which may have initialized CUDA. They import the entry script as __mp_main__, which only
+        # starts the bot under `if __name__ == "__main__"`. Children share the parent's resource tracker, so shared
+        # memory created on either side is only unlinked once
+        if CODEC_WORKERS <= 0: return None
+        with cls.lock:
+            if cls.pool is None:
+                resource_tracker.ensure_running()
+                if "forkserver" in get_all_start_methods():
+                    context = get_context("forkserver")
+                    context.set_forkserver_preload(["media_codec"])
+                else:
+                    context = get_context("spawn")
+                cls.pool = ProcessPoolExecutor(CODEC_WORKERS, mp_context=context, initializer=init_codec_process)
+        return cls.pool
+
+    @classmethod
+    def start(cls):
+        # Called by the entry points before anything else runs, so the fork server starts from a clean process
+        if cls.get_pool() is None: return
+        if "forkserver" in get_all_start_methods():
+            from multiprocessing import forkserver
+            forkserver.ensure_running()
+
+    @classmethod
+    def reset(cls, pool: ProcessPoolExecutor):
+        # A dead child (e.g. killed for OOM on a large video) breaks the whole pool, the next call forks a new one
+        with cls.lock:
+            if cls.pool is not pool: return
+            cls.pool = None
+        print("A codec process died, restarting the codec pool")
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    def encode(cls, image, image_format, fps=None) -> Future:
+        # `image` is a float [N, H, W, C] tensor in 0..1. It's written once as uint8 into shared memory
+        import torch
+        import numpy as np
+        shape = (*image.shape[:-1], 3)
+        pool = cls.get_pool()
+        if pool is not None:
+            shm = SharedMemory(create=True, size=max(prod(shape), 1))
+            def cleanup(future: Future = None):
+                shm.close()
+                shm.unlink()
+                if future is not None and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+                    cls.reset(pool)
+            try:
+                torch.from_numpy(np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)).copy_(image[..., :3].mul(255))
+                future = pool.submit(encode_shared, shm.name, shape, image_format, fps)
+            except BrokenProcessPool:
+                cleanup()
+                cls.reset(pool)
+            except:
+                cleanup()
+                raise
+            else:
+                future.add_done_callback(cleanup)
+                return future
+        future = Future()
+        future.set_result(encode_frames(image[..., :3].mul(255).to(torch.uint8).cpu().numpy(), image_format, fps))
+        return future
+
+    @classmethod
+    def decode(cls, content: bytes, suffix: str, convert, options: VideoOptions = None):
+        # `convert(frames, fps)` must copy the uint8 [N, H, W, 3] frames out, since the shared memory is freed afterwards
+        import numpy as np
+        pool = cls.get_pool()
+        if pool is not None:
+            try: future = pool.submit(decode_shared, content, suffix, options)
+            except BrokenProcessPool: # Broken by an earlier job, this one runs here
+                cls.reset(pool)
+                pool = None
+        if pool is not None:
+            try: shm_name, shape, fps = future.result()
+            except BrokenProcessPool: # The media killed its codec process, it would take the bot down here
+                cls.reset(pool)
+                raise
+        if pool is None:
+            chunks, fps = decode_frames(content, suffix, options)
+            return convert(chunks[0] if len(chunks) == 1 else np.concatenate(chunks), fps)
+        shm = SharedMemory(name=shm_name)
+        try:
+            frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            result = convert(frames, fps)
+            del frames
+            return result
+        finally:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,152 @@
+import os, bisect, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0")) # Prometheus endpoint at /metrics, 0 disables it
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+API_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+registry = []
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def format_labels(label_names, labels, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(label_names, labels)] + ([extra] if extra else [])
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+    # Values by label values, updated under a lock held only for a dict update. Rendering copies them first
+    type = "untyped"
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        with self.lock: values = dict(self.values)
+        return [(self.name, self.label_names, labels, value) for labels, value in values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, label_names, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(label_names, labels)} {value}")
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock: self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock: self.values[labels] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None: counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.]
+            counts[idx] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock: values = {labels: list(counts) for labels, counts in self.values.items()}
+        samples = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", self.label_names + ("le",), labels + (bound,), cumulative))
+            samples.append((f"{self.name}_sum", self.label_names, labels, counts[-1]))
+            samples.append((f"{self.name}_count", self.label_names, labels, cumulative))
+        return samples
+
+class CallbackMetric(Metric):
+    # Read when scraped from state the bot keeps anyway (queue lengths, cache stats), nothing to record
+    def __init__(self, name, help, type, label_names=()):
+        super().__init__(name, help, label_names)
+        self.type = type
+        self.callbacks = []
+
+    def add(self, callback):
+        # `callback()` returns the values by label values
+        self.callbacks.append(callback)
+
+    def samples(self):
+        samples = []
+        for callback in self.callbacks:
+            try: values = callback()
+            except Exception: continue
+            samples += [(self.name, self.label_names, labels, value) for labels, value in values.items()]
+        return samples
+
+def get_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Peak, where /proc isn't available
+
+QUEUE_DEPTH = CallbackMetric("comfy_queue_depth", "Requests waiting for the worker", "gauge")
+QUEUE_WAIT = Histogram("comfy_queue_wait_seconds", "Time requests waited in the queue", ["command"])
+COMMAND_DURATION = Histogram("comfy_command_duration_seconds", "Execution time of commands", ["command", "status"])
+AUTH_DECISIONS = Counter("telegram_auth_decisions_total", "Outcomes of user authentication", ["decision"])
+MIDDLEWARE_DECISIONS = Counter("telegram_middleware_decisions_total", "Outcomes of the anti flood middleware screening", ["decision"])
+FLOOD_REJECTIONS = Counter("telegram_flood_rejections_total", "Messages dropped for coming too soon after the previous one")
+TELEGRAM_REQUEST_DURATION = Histogram("telegram_api_request_seconds", "Latency of Bot API requests", ["method"], API_BUCKETS)
+TELEGRAM_RATE_LIMITED = Counter("telegram_api_rate_limited_total", "Bot API requests answered with 429", ["method"])
+CACHE_LOOKUPS = CallbackMetric("comfy_cache_lookups_total", "Cache lookups by cache and result", "counter", ["cache", "result"])
+RSS = CallbackMetric("process_resident_memory_bytes", "Resident memory of the bot process", "gauge")
+RSS.add(lambda: {(): get_rss()})
+
+def render_metrics():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+class MetricsServer:
+    # Serves the metrics in the Prometheus text format on a daemon thread
+    def __init__(self, listen=METRICS_LISTEN, port=METRICS_PORT):
+        self.server = ThreadingHTTPServer((listen, port), self.make_handler())
+        self.server.daemon_threads = True
+
+    def make_handler(self):
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = render_metrics().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return MetricsHandler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Metrics served on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
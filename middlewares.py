@@ -4,6 +4,7 @@ from backed_bot_utils import get_username
 import schedule
 import os
 from auth_manager import AuthManager, UserInfo
+from metrics import AUTH_DECISIONS, MIDDLEWARE_DECISIONS, FLOOD_REJECTIONS
 
 class AntiFloodMiddleware(BaseMiddleware):
     def __init__(self, bot, commands, free_commands, allowed_chat_ids, start_time, window_limit_sec, temp_message_delay_sec) -> None:
@@ -37,48 +38,66 @@ class AntiFloodMiddleware(BaseMiddleware):
         if not is_allowed:
             if user_info is None: print(f"{user_str} is not in allowed list")
             else: print(f"{user_str} is banned. Skipping message")
+            AUTH_DECISIONS.inc("not_allowed" if user_info is None else "banned")
             return False
         
         if advanced_info is not None:
             print(f"{user_str} is advanced")
+            AUTH_DECISIONS.inc("advanced")
             return True
                     
         if '*' not in self.allowed_chat_ids and chat_id not in self.allowed_chat_ids:
             print(f"Allowed chatids are: {self.allowed_chat_ids}, but got message from {user_str.lower()}, chatid: {chat_id}! Skipping message")
+            AUTH_DECISIONS.inc("chat_not_allowed")
             return False
         
         if user_id not in allowed_users:
             if '*' in allowed_users:
                 allowed_users[user_id] = UserInfo(user_id, user_name)
                 print(f"Everyone is allowed. Auto create user info for {user_str.lower()}")
+                AUTH_DECISIONS.inc("auto_created")
                 return True
             else:
                 print(f"Allowed userids are: {list(allowed_users.keys())}, but got message from {user_str.lower()}, chatid: {chat_id}! Skipping message.")
+                AUTH_DECISIONS.inc("not_allowed")
                 return False
+        AUTH_DECISIONS.inc("allowed")
         return True
     
-    def check(self, user_id, message):
+    def is_flooding(self, user_id, message):
+        # Returns whether the message comes too soon after the previous one, and whether the user should be told
         if not user_id in self.last_time:
             self.last_time[user_id] = (message.date, None)
-            return ContinueHandling()
+            return False, False
         
         last_message_date, notify_message_date = self.last_time[user_id]
-        if message.date - last_message_date < self.limit:
-            if (notify_message_date is None) or (message.date - notify_message_date > self.temp_message_delay_sec):
-                print(f"User {user_id} are spamming")
-                notify_message = self.bot.send_message(message.chat.id, f"You are spamming commands. Wait for {self.limit} seconds")
-                def delete_message():
-                    try: self.bot.delete_message(notify_message.chat.id, notify_message.id)
-                    except: pass
-                    return schedule.CancelJob
-                notify_message_date = notify_message.date
-                schedule.every(self.temp_message_delay_sec).seconds.do(delete_message)
-            self.last_time[user_id] = (message.date, notify_message_date)
-            return CancelUpdate()
-        else:
-            self.last_time[user_id] = (message.date, notify_message_date)
+        self.last_time[user_id] = (message.date, notify_message_date)
+        if message.date - last_message_date >= self.limit:
+            return False, False
+        print(f"User {user_id} are spamming")
+        FLOOD_REJECTIONS.inc()
+        return True, (notify_message_date is None) or (message.date - notify_message_date > self.temp_message_delay_sec)
+
+    def set_notified(self, user_id, notify_message: types.Message):
+        self.last_time[user_id] = (self.last_time[user_id][0], notify_message.date)
+
+    def check(self, user_id, message):
+        is_flooding, should_notify = self.is_flooding(user_id, message)
+        if not is_flooding:
             return ContinueHandling()
+        if should_notify:
+            notify_message = self.bot.send_message(message.chat.id, f"You are spamming commands. Wait for {self.limit} seconds")
+            def delete_message():
+                try: self.bot.delete_message(notify_message.chat.id, notify_message.id)
+                except: pass
+                return schedule.CancelJob
+            self.set_notified(user_id, notify_message)
+            schedule.every(self.temp_message_delay_sec).seconds.do(delete_message)
+        return CancelUpdate()
     
+    def get_bot_id(self):
+        return self.bot.user.id
+
     def get_command(self, text):
         if text is None or type(text) != str or len(text.strip()) == 0:
             return None
@@ -86,7 +105,13 @@ class AntiFloodMiddleware(BaseMiddleware):
             return None
         return text.strip().split()[0][1:] # Extract command name without '/'
 
-    def pre_process(self, message: types.Message, data):
+    def screen(self, message: types.Message):
+        # Returns whether the message is handled, and whether it still has to pass the flood check
+        decision, is_handled, check_flood = self.decide(message)
+        MIDDLEWARE_DECISIONS.inc(decision)
+        return is_handled, check_flood
+
+    def decide(self, message: types.Message):
         user_id = str(message.from_user.id)
         user_name = get_username(message.from_user)
         text = message.caption if message.content_type in ['photo', 'video', 'animation'] else message.text
@@ -94,30 +119,36 @@ class AntiFloodMiddleware(BaseMiddleware):
 
         if message.date < self.start_time:
             print(f"Skip message {message.id} from {user_name} ({user_id}) for being sended before starting-up")
-            return CancelUpdate()
+            return "stale", False, False
         
         if message.content_type in ['photo', 'video', 'animation']:
-            if self.authenticate(message):
-                return ContinueHandling()
-            else:
-                return CancelUpdate()
+            is_allowed = self.authenticate(message)
+            return "media" if is_allowed else "unauthorized", is_allowed, False
         
         if command is None:
-            if message.reply_to_message is not None and message.reply_to_message.from_user.id == self.bot.user.id:
-                return ContinueHandling()
+            if message.reply_to_message is not None and message.reply_to_message.from_user.id == self.get_bot_id():
+                return "reply", True, False
             else:
-                return CancelUpdate()
+                return "ignored", False, False
         
         print(f"Received command from chat_id {message.chat.id}, user {user_name} ({user_id}): {text}")
         if command in self.free_commands:
-            return ContinueHandling()
+            return "free_command", True, False
 
         if command not in self.commands:
             print(f"Command {command} not defined. Current available commands: {', '.join(self.commands)}")
-            return CancelUpdate()
+            return "unknown_command", False, False
         if not self.authenticate(message):
+            return "unauthorized", False, False
+        return "command", True, True
+
+    def pre_process(self, message: types.Message, data):
+        is_handled, check_flood = self.screen(message)
+        if not is_handled:
             return CancelUpdate()
-        return self.check(user_id, message)
+        if check_flood:
+            return self.check(str(message.from_user.id), message)
+        return ContinueHandling()
         
     def post_process(self, message, data, exception):
         pass
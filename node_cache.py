@@ -0,0 +1,255 @@
+import os, gc, time, hashlib, itertools, threading
+from dataclasses import dataclass, field
+from telebot import types, TeleBot
+from auth_manager import AuthManager
+from metrics import CACHE_LOOKUPS
+
+NODE_CACHE_MAX_MB = float(os.environ.get("NODE_CACHE_MAX_MB", "8192"))
+NODE_CACHE_POLICY = os.environ.get("NODE_CACHE_POLICY", "lru").lower() # "lru" or "lfu"
+# Reuse the outputs of any node called again with the same inputs. Off by default: every tensor input is copied to
+# the CPU and hashed at each call, and the outputs are kept up to NODE_CACHE_MAX_MB
+NODE_MEMO = int(os.environ.get("NODE_MEMO", "0"))
+output_ids = itertools.count()
+
+def hash_value(hasher, value, refs: list):
+    # Digest over the content of tensors/arrays (bytes, shape and dtype) and the repr of plain values.
+    # Other objects (models, clips, ...) are identified by id, so they're kept alive in `refs` to avoid id reuse.
+    # Tensors output by a cached node are identified by the number they were given instead of hashing them again
+    import torch, numpy as np
+    if isinstance(value, torch.Tensor) and getattr(value, "output_id", None) is not None:
+        hasher.update(f"output{value.output_id};".encode())
+    elif isinstance(value, torch.Tensor):
+        hasher.update(f"tensor{tuple(value.shape)}{value.dtype}".encode())
+        hasher.update(value.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().data)
+    elif isinstance(value, np.ndarray):
+        hasher.update(f"ndarray{value.shape}{value.dtype}".encode())
+        hasher.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, dict):
+        hasher.update(b"{")
+        for k in sorted(value, key=repr):
+            hash_value(hasher, k, refs)
+            hash_value(hasher, value[k], refs)
+        hasher.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"(" if isinstance(value, tuple) else b"[")
+        for v in value:
+            hash_value(hasher, v, refs)
+        hasher.update(b")")
+    elif value is None or isinstance(value, (str, int, float, bool, bytes)):
+        hasher.update(f"{type(value).__name__}:{value!r};".encode())
+    else:
+        refs.append(value)
+        hasher.update(f"{type(value).__qualname__}@{id(value)};".encode())
+
+def hash_call(class_name, kwargs):
+    hasher = hashlib.blake2b(digest_size=16)
+    refs = []
+    hasher.update(class_name.encode())
+    hash_value(hasher, kwargs, refs)
+    return hasher.hexdigest(), refs
+
+def number_outputs(value):
+    import torch
+    if isinstance(value, torch.Tensor):
+        if getattr(value, "output_id", None) is None: value.output_id = next(output_ids)
+    elif isinstance(value, dict):
+        for v in value.values(): number_outputs(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value: number_outputs(v)
+
+def iter_objects(value):
+    # The objects `hash_value` identifies by id
+    import torch, numpy as np
+    if isinstance(value, (torch.Tensor, np.ndarray)) or value is None or isinstance(value, (str, int, float, bool, bytes)):
+        return
+    if isinstance(value, dict):
+        for v in value.values(): yield from iter_objects(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value: yield from iter_objects(v)
+    else:
+        yield value
+
+def measure_size(value, seen=None):
+    import torch, numpy as np
+    seen = set() if seen is None else seen
+    if id(value) in seen: return 0
+    seen.add(id(value))
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, torch.nn.Module):
+        return sum(t.nelement() * t.element_size() for t in (*value.parameters(), *value.buffers()))
+    if callable(getattr(value, "model_size", None)): # ComfyUI's ModelPatcher
+        try: return int(value.model_size())
+        except: return 0
+    if isinstance(value, dict):
+        return sum(measure_size(v, seen) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(measure_size(v, seen) for v in value)
+    if hasattr(value, "__dict__") and not isinstance(value, type):
+        # E.g. CLIP/VAE wrappers holding a patcher or a torch module
+        return sum(
+            measure_size(v, seen) for v in vars(value).values()
+            if isinstance(v, (torch.Tensor, torch.nn.Module)) or callable(getattr(v, "model_size", None))
+        )
+    return 0
+
+@dataclass
+class NodeCacheEntry:
+    class_name: str
+    value: object
+    size: int
+    refs: list
+    pinned: bool = False
+    hits: int = 0
+    last_access: float = field(default_factory=time.monotonic)
+
+class NodeOutputCache:
+    # Objects in the value of an entry (models, clips, ...) are owned by it. Entries keyed on an object by id
+    # (`refs`) are dropped with its last owner: the node will output a new object, with a new id
+    entries: dict[str, NodeCacheEntry] = {}
+    owners: dict[int, int] = {} # id -> number of entries holding the object in their value
+    total_size = 0
+    lock = threading.RLock()
+    stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @classmethod
+    def get_or_compute(cls, class_name, kwargs, compute, pinned=False, verbose=True, owned_refs_only=False):
+        # Pinned entries (PINNED_NODES) are never evicted nor flushed, only `node_cache flush all` drops them.
+        # With `owned_refs_only`, calls taking an object no entry owns run without caching, the entry would keep it
+        # alive. Otherwise the size of such objects is counted in the entry's
+        key, refs = hash_call(class_name, kwargs)
+        with cls.lock:
+            entry = cls.entries.get(key)
+            if entry is not None:
+                entry.hits += 1
+                entry.last_access = time.monotonic()
+                cls.stats["hits"] += 1
+                return entry.value
+            unowned_refs = [ref for ref in refs if id(ref) not in cls.owners]
+            if owned_refs_only and len(unowned_refs): return compute()
+            cls.stats["misses"] += 1
+        if verbose: print(f"Caching node {class_name}...")
+        value = compute()
+        number_outputs(value)
+        entry = NodeCacheEntry(class_name, value, measure_size(value) + measure_size(unowned_refs), refs, pinned)
+        with cls.lock:
+            if key not in cls.entries:
+                cls.add_entry(key, entry)
+            cls.evict(keep=key)
+        return value
+
+    @classmethod
+    def add_entry(cls, key, entry: NodeCacheEntry):
+        with cls.lock:
+            cls.entries[key] = entry
+            cls.total_size += entry.size
+            for obj in iter_objects(entry.value):
+                cls.owners[id(obj)] = cls.owners.get(id(obj), 0) + 1
+
+    @classmethod
+    def remove_entry(cls, key):
+        with cls.lock:
+            entry = cls.entries.pop(key)
+            cls.total_size -= entry.size
+            released = set()
+            for obj in iter_objects(entry.value):
+                cls.owners[id(obj)] -= 1
+                if cls.owners[id(obj)] == 0:
+                    del cls.owners[id(obj)]
+                    released.add(id(obj))
+            if len(released):
+                for other_key in [k for k, e in cls.entries.items() if not e.pinned and any(id(ref) in released for ref in e.refs)]:
+                    if other_key in cls.entries: cls.remove_entry(other_key)
+            return entry
+
+    @classmethod
+    def run_node(cls, node_id, class_name, func, /, **kwargs):
+        # `hooks["run_node"]` of the preprocessed workflows. Outputs are reused across requests when the inputs hash
+        # the same, so e.g. only the nodes after the prompt run again for a new prompt on the same photo.
+        # Output nodes and nodes with IS_CHANGED (their result doesn't only depend on the inputs) always run
+        node = getattr(func, "__self__", None)
+        if not NODE_MEMO or getattr(node, "OUTPUT_NODE", False) or hasattr(node, "IS_CHANGED"):
+            return func(**kwargs)
+        return cls.get_or_compute(f"{class_name}.{func.__name__}", kwargs, lambda: func(**kwargs), verbose=False, owned_refs_only=True)
+
+    @classmethod
+    def run_hoisted_node(cls, hoist_key, class_name, func, /, **kwargs):
+        # `hooks["run_hoisted_node"]`: nodes whose inputs are the same for every request (see preprocess.iter_node_calls)
+        # are computed once per process and kept as pinned entries under their `command:workflow hash:node id` key
+        node = getattr(func, "__self__", None)
+        if getattr(node, "OUTPUT_NODE", False) or hasattr(node, "IS_CHANGED"):
+            return func(**kwargs)
+        with cls.lock:
+            entry = cls.entries.get(hoist_key)
+            if entry is not None:
+                entry.hits += 1
+                entry.last_access = time.monotonic()
+                cls.stats["hits"] += 1
+                return entry.value
+            cls.stats["misses"] += 1
+        print(f"Hoisting node {class_name} ({hoist_key})...")
+        value = func(**kwargs)
+        number_outputs(value)
+        with cls.lock:
+            if hoist_key not in cls.entries:
+                cls.add_entry(hoist_key, NodeCacheEntry(class_name, value, measure_size(value), [], pinned=True))
+            cls.evict()
+        return value
+
+    @classmethod
+    def release_hoisted(cls, commands):
+        # Outputs hoisted from older versions of the given workflows
+        with cls.lock:
+            for key in [key for key in cls.entries if key.split(':')[0] in commands]:
+                if key in cls.entries: cls.remove_entry(key)
+
+    @classmethod
+    def evict(cls, keep=None):
+        max_size = NODE_CACHE_MAX_MB * 1024 * 1024
+        with cls.lock:
+            while cls.total_size > max_size and len(cls.entries) > 1:
+                candidates = [(key, entry) for key, entry in cls.entries.items() if key != keep and not entry.pinned]
+                if len(candidates) == 0: break
+                if NODE_CACHE_POLICY == "lfu":
+                    key, entry = min(candidates, key=lambda item: (item[1].hits, item[1].last_access))
+                else:
+                    key, entry = min(candidates, key=lambda item: item[1].last_access)
+                print(f"Evicting cached node {entry.class_name} ({entry.size / 1024 / 1024:.1f} MB)")
+                cls.remove_entry(key)
+                cls.stats["evictions"] += 1
+
+    @classmethod
+    def flush(cls, keep_pinned=True):
+        with cls.lock:
+            for key, entry in list(cls.entries.items()):
+                if keep_pinned and entry.pinned or key not in cls.entries: continue
+                cls.remove_entry(key)
+        gc.collect()
+
+    @classmethod
+    def serialize(cls):
+        with cls.lock:
+            entries = sorted(cls.entries.values(), key=lambda entry: entry.size, reverse=True)
+            text = f"Node cache ({NODE_CACHE_POLICY.upper()}): `{len(entries)}` entries, `{cls.total_size / 1024 / 1024:.1f}`/`{NODE_CACHE_MAX_MB:.0f}` MB\n"
+            text += f"Hits: `{cls.stats['hits']}`, misses: `{cls.stats['misses']}`, evictions: `{cls.stats['evictions']}`\n"
+            for entry in entries[:30]:
+                text += f"• `{entry.class_name}`{' (pinned)' if entry.pinned else ''}: {entry.size / 1024 / 1024:.1f} MB, {entry.hits} hit(s)\n"
+        return text.strip()
+
+    @classmethod
+    def admin(cls, bot: TeleBot, message: types.Message, parsed_data: dict):
+        if not AuthManager.check_admin(message, "manage the node cache"): return
+        if parsed_data["prompt"].strip() == "hoisted":
+            from preprocess import get_hoisting_report
+            bot.reply_to(message, get_hoisting_report())
+            return
+        if parsed_data["prompt"].strip() in ["flush", "flush all"]:
+            keep_pinned = parsed_data["prompt"].strip() == "flush"
+            cls.flush(keep_pinned)
+            bot.reply_to(message, "Node cache flushed, pinned nodes kept" if keep_pinned else "Node cache flushed")
+            return
+        bot.reply_to(message, cls.serialize(), parse_mode="Markdown")
+
+CACHE_LOOKUPS.add(lambda: {("node", "hit"): NodeOutputCache.stats["hits"], ("node", "miss"): NodeOutputCache.stats["misses"]})
@@ -0,0 +1,125 @@
+import os, sys, time, threading, functools, tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from types import SimpleNamespace
+from telebot import types, TeleBot
+from auth_manager import AuthManager
+
+NODE_PROFILE = int(os.environ.get("NODE_PROFILE", "0")) # Can also be turned on and off with /node_profile on|off
+NODE_PROFILE_RUNS = int(os.environ.get("NODE_PROFILE_RUNS", "100")) # Runs kept per node
+NODE_PROFILE_TOP = int(os.environ.get("NODE_PROFILE_TOP", "10"))
+
+@functools.cache
+def has_cuda(torch):
+    return torch.cuda.is_available()
+
+def get_tensor_memory():
+    # Workflows run after ComfyUI imported torch, the profiler doesn't import it itself
+    torch = sys.modules.get("torch")
+    return torch.cuda.memory_allocated() if torch is not None and has_cuda(torch) else 0
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+class NodeProfiler:
+    # Wall time, CPU time, peak Python allocations and CUDA memory delta of every node of a workflow run, summed per
+    # run and kept for the last NODE_PROFILE_RUNS runs. When disabled the hooks are passed through untouched
+    enabled = False
+    samples: dict[str, dict[str, deque]] = {} # command -> node key -> (wall, cpu, allocated, tensor delta) per run
+    class_names: dict[tuple[str, str], str] = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def set_enabled(cls, enabled):
+        cls.enabled = enabled
+        if enabled and not tracemalloc.is_tracing(): tracemalloc.start()
+        elif not enabled and tracemalloc.is_tracing(): tracemalloc.stop()
+
+    @classmethod
+    @contextmanager
+    def profile(cls, command_name, hooks: dict):
+        # Yields the hooks to run the workflow with
+        if not cls.enabled:
+            yield hooks
+            return
+        run = {}
+        try: yield cls.wrap_hooks(command_name, hooks, run)
+        finally:
+            with cls.lock:
+                nodes = cls.samples.setdefault(command_name, {})
+                for node_key, sample in run.items():
+                    nodes.setdefault(node_key, deque(maxlen=NODE_PROFILE_RUNS)).append(tuple(sample))
+
+    @classmethod
+    def wrap_hooks(cls, command_name, hooks: dict, run: dict):
+        def measure(node_key, class_name, func, *args, **kwargs):
+            cls.class_names[(command_name, node_key)] = class_name
+            tensor_memory = get_tensor_memory()
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+            wall_time, cpu_time = time.perf_counter(), time.thread_time()
+            try: return func(*args, **kwargs)
+            finally:
+                sample = run.setdefault(node_key, [0.0, 0.0, 0, 0])
+                sample[0] += time.perf_counter() - wall_time
+                sample[1] += time.thread_time() - cpu_time
+                sample[2] = max(sample[2], tracemalloc.get_traced_memory()[1] - allocated)
+                sample[3] += get_tensor_memory() - tensor_memory
+
+        def run_node(node_id, class_name, func, /, **kwargs):
+            return measure(node_id, class_name, hooks["run_node"], node_id, class_name, func, **kwargs)
+
+        def run_hoisted_node(hoist_key, class_name, func, /, **kwargs):
+            node_id = hoist_key.rsplit(':', 1)[-1]
+            return measure(node_id, class_name, hooks["run_hoisted_node"], hoist_key, class_name, func, **kwargs)
+
+        def wrap_hook(class_name, hook):
+            # AppIO and NODES_TO_CACHE hooks, profiled under their class name
+            return SimpleNamespace(**{
+                name: functools.partial(measure, class_name, class_name, method) if callable(method) else method
+                for name, method in vars(hook).items()
+            })
+
+        return {
+            **{key: wrap_hook(key, hook) if isinstance(hook, SimpleNamespace) else hook for key, hook in hooks.items()},
+            "run_node": run_node,
+            "run_hoisted_node": run_hoisted_node
+        }
+
+    @classmethod
+    def serialize(cls, command_name=None):
+        with cls.lock:
+            samples = {command: {node_key: list(runs) for node_key, runs in nodes.items()} for command, nodes in cls.samples.items()}
+        if command_name: samples = {command_name: samples.get(command_name, {})}
+        text = f"Node profiling is {'on' if cls.enabled else 'off'}\n"
+        for command, nodes in samples.items():
+            text += f"\nCommand `{command}`:\n"
+            if len(nodes) == 0: text += "No runs recorded\n"
+            top = sorted(nodes.items(), key=lambda item: percentile([run[0] for run in item[1]], 0.5), reverse=True)
+            for node_key, runs in top[:NODE_PROFILE_TOP]:
+                walls = [run[0] for run in runs]
+                class_name = cls.class_names.get((command, node_key), node_key)
+                text += (
+                    f"• `{node_key}`{f' (`{class_name}`)' if class_name != node_key else ''}: "
+                    f"p50 {percentile(walls, 0.5):.3f}s, p90 {percentile(walls, 0.9):.3f}s, p99 {percentile(walls, 0.99):.3f}s, "
+                    f"cpu {sum(run[1] for run in runs) / len(runs):.3f}s, "
+                    f"py alloc {max(run[2] for run in runs) / 1024 / 1024:.1f} MB, "
+                    f"tensors {sum(run[3] for run in runs) / len(runs) / 1024 / 1024:+.1f} MB ({len(runs)} runs)\n"
+                )
+        return text.strip()
+
+    @classmethod
+    def admin(cls, bot: TeleBot, message: types.Message, parsed_data: dict):
+        # /node_profile [on|off|clear|command]
+        if not AuthManager.check_admin(message, "profile nodes"): return
+        argument = parsed_data["prompt"].strip()
+        if argument in ["on", "off"]:
+            cls.set_enabled(argument == "on")
+            return bot.reply_to(message, f"Node profiling turned {argument}")
+        if argument == "clear":
+            with cls.lock: cls.samples.clear()
+            return bot.reply_to(message, "Node profiles cleared")
+        bot.reply_to(message, cls.serialize(argument or None), parse_mode="Markdown")
+
+NodeProfiler.set_enabled(bool(NODE_PROFILE))
@@ -0,0 +1,91 @@
+import os, threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", "3"))
+PREFETCH_MAX_MB = float(os.environ.get("PREFETCH_MAX_MB", "512"))
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "2"))
+
+class Prefetcher:
+    # Downloads and decodes the inputs of the next PREFETCH_DEPTH queued requests in the background.
+    # `get_request_media(request)` lists (file_id, file_unique_id, *decode_args) of a queued request,
+    # `load(file_id, file_unique_id, *decode_args)` returns a tensor and `get_request_key(request)` identifies
+    # a request until it's released by the executor. Prefetched tensors are keyed by (file_id, *decode_args).
+    # Loads in flight count toward PREFETCH_MAX_MB with the size of the largest tensor loaded so far
+    def __init__(self, load, get_request_media, get_request_key):
+        self.load = load
+        self.get_request_media = get_request_media
+        self.get_request_key = get_request_key
+        self.executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        self.futures: dict[tuple, Future] = {}
+        self.owners: dict[tuple, set] = {}
+        self.request_files: dict[object, list[tuple]] = {}
+        self.claimed = set()
+        self.sizes: dict[tuple, int] = {}
+        self.size = 0
+        self.largest = 0
+
+    def update(self, queued_requests):
+        wanted = {self.get_request_key(request): request for request in queued_requests[:PREFETCH_DEPTH]}
+        submitted = []
+        max_size = PREFETCH_MAX_MB * 1024 * 1024
+        with self.lock:
+            estimate = max(self.largest, int(max_size / max(PREFETCH_DEPTH, 1)))
+            for request_key in list(self.request_files):
+                if request_key not in wanted and request_key not in self.claimed:
+                    self.drop(request_key)
+            for request_key, request in wanted.items():
+                if request_key in self.request_files: continue
+                try: media = self.get_request_media(request)
+                except: continue
+                new_media = {(file_id, *decode_args) for file_id, _, *decode_args in media} - self.futures.keys()
+                if self.size + estimate * len(new_media) > max_size: break
+                self.request_files[request_key] = [(file_id, *decode_args) for file_id, _, *decode_args in media]
+                for file_id, file_unique_id, *decode_args in media:
+                    media_key = (file_id, *decode_args)
+                    self.owners.setdefault(media_key, set()).add(request_key)
+                    if media_key not in self.futures:
+                        self.futures[media_key] = self.executor.submit(self.load, file_id, file_unique_id, *decode_args)
+                        self.sizes[media_key] = estimate
+                        self.size += self.sizes[media_key]
+                        submitted.append((media_key, self.futures[media_key]))
+        # A load that's already done runs its callback right away, which takes the lock
+        for media_key, future in submitted:
+            future.add_done_callback(lambda future, media_key=media_key: self.on_done(media_key, future))
+
+    def on_done(self, media_key, future: Future):
+        failed = future.cancelled() or future.exception() is not None
+        size = 0 if failed else future.result().nelement() * future.result().element_size()
+        with self.lock:
+            if self.futures.get(media_key) is not future: return
+            self.size += size - self.sizes.get(media_key, 0)
+            self.sizes[media_key] = size
+            self.largest = max(self.largest, size)
+
+    def drop(self, request_key):
+        for media_key in self.request_files.pop(request_key, []):
+            owners = self.owners.get(media_key, set())
+            owners.discard(request_key)
+            if owners: continue
+            self.owners.pop(media_key, None)
+            future = self.futures.pop(media_key, None)
+            if future is not None: future.cancel()
+            self.size -= self.sizes.pop(media_key, 0)
+
+    def claim(self, request_key):
+        # The request left the queue for the executor, keep its inputs until it's released
+        with self.lock:
+            self.claimed.add(request_key)
+
+    def release(self, request_key):
+        with self.lock:
+            self.claimed.discard(request_key)
+            self.drop(request_key)
+
+    def take(self, file_id, *decode_args):
+        # Returns the prefetched tensor, waiting for it if it's still loading, or None if it wasn't prefetched
+        with self.lock:
+            future = self.futures.get((file_id, *decode_args))
+        if future is None: return None
+        try: return future.result()
+        except: return None
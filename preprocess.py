@@ -1,10 +1,11 @@
 from pathlib import Path
-import shutil
-import re, ast
-from dataclasses import dataclass
+import re, ast, os, sys, json, time, hashlib, itertools, importlib, importlib.util, threading
+from dataclasses import dataclass, asdict
 import yaml
 from PIL import Image
 
+PREPROCESS_VERSION = 4 # Bump when the generated code or the manifest layout changes
+WORKFLOW_WATCH_SECS = float(os.environ.get("WORKFLOW_WATCH_SECS", "0")) # Hot reload of workflows and config.yaml, 0 disables it
 py_workflows_dir = Path(__file__, '..' , 'python_workflows').resolve()
 py_workflows_dir.mkdir(exist_ok=True)
 preprocessed_dir = Path(__file__, '..', 'preprocessed').resolve()
@@ -83,75 +84,281 @@ from nodes import NODE_CLASS_MAPPINGS
 import_custom_nodes()
 """.strip()
 
-def preprocess(hooks):
-    shutil.rmtree(preprocessed_dir, ignore_errors=True)
-    preprocessed_dir.mkdir(exist_ok=True)
-    commands = []
-    for workflow_py in py_workflows_dir.iterdir():
-        if workflow_py.name.startswith('.'): continue #E.g. .ipynb_checkpoints
-        if workflow_py.suffix != '.py': continue
-        code = workflow_py.read_text(encoding="utf-8")
-        start_duplicated, end_duplicated = code.index("def find_path"), code.index("def main")
-        code = code[:start_duplicated] + code[end_duplicated:]
-        code = code.replace("def main():", f"def main(NODE_CLASS_MAPPINGS, hooks):") \
-                    .replace("    import_custom_nodes()", '')
-        for hooker in hooks:
-            _hooker = hooker.replace('(', '\(').replace(')', '\)')
-            code = re.sub(rf"NODE_CLASS_MAPPINGS\[\s*\"{_hooker}\"\s*\]\(\)", f'hooks["{hooker}"]', code)
-        temp_file = preprocessed_dir / f"appio_{workflow_py.name}"
-        temp_file.write_text(code)
-        commands.append(workflow_py.stem)
-    
-    init_code = preprocessed_init_code + "\n\n" + '\n'.join([f"from .appio_{command} import main as {command}" for command in commands])
-    init_file = preprocessed_dir / "__init__.py"
-    init_file.write_text(init_code, encoding="utf-8")
-    return commands
-
-def extract_execute_arguments(tree, node_id):
-    call_node = None
-    does_break = False
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Name) and node.id == node_id:
-            does_break = True
-            continue
-        if does_break:
-            if isinstance(node, ast.Call) and getattr(node.func, 'attr', '') == 'execute':
-                call_node = node
-                break
-    kwargs = {kw.arg: ast.unparse(kw.value) for kw in call_node.keywords}  # Keyword arguments
-    return kwargs
-
 @dataclass
 class InputNode:
     class_name: str
     arguments: dict
 
+@dataclass
+class GraphNode:
+    class_name: str
+    method: str
+    inputs: list[str] # Ids of the nodes whose outputs are passed to this one
+    hooked: bool # Called through `hooks` (AppIO nodes, NODES_TO_CACHE), not through `hooks["run_node"]`
+    hoisted: bool = False # Doesn't depend on the request, computed once per process
+
+def preprocess_workflow(code, hooks):
+    start_duplicated, end_duplicated = code.index("def find_path"), code.index("def main")
+    code = code[:start_duplicated] + code[end_duplicated:]
+    code = code.replace("def main():", f"def main(NODE_CLASS_MAPPINGS, hooks):") \
+                .replace("    import_custom_nodes()", '')
+    for hooker in hooks:
+        _hooker = hooker.replace('(', '\(').replace(')', '\)')
+        code = re.sub(rf"NODE_CLASS_MAPPINGS\[\s*\"{_hooker}\"\s*\]\(\)", f'hooks["{hooker}"]', code)
+    return code
+
+def iter_statements(statements):
+    # Assignments are statements, nested blocks (`with`, `if`, ...) are followed but expressions are not walked
+    for statement in statements:
+        yield statement
+        for field in ["body", "orelse", "finalbody", "handlers"]:
+            yield from iter_statements(getattr(statement, field, []))
+
 def get_input_nodes(preprocessed_code):
+    # A single pass over the statements collects the hooked input node definitions (`appio_..input.. = hooks["AppIO_.."]`)
+    # and their `.execute(...)` calls, listed in source order
+    node_defs, executions = {}, {}
+    for node in iter_statements(ast.parse(preprocessed_code).body):
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)): continue
+        target, value = node.targets[0].id, node.value
+        if isinstance(value, ast.Subscript) and isinstance(value.value, ast.Name) and value.value.id == "hooks":
+            if isinstance(value.slice, ast.Constant) and re.fullmatch(r"AppIO_[a-zA-Z0-9]+", str(value.slice.value)) \
+                    and re.match(r"appio_[a-zA-Z0-9]+input", target):
+                node_defs.setdefault(target, (node.lineno, f'"{value.slice.value}"'))
+        elif isinstance(value, ast.Call) and isinstance(value.func, ast.Attribute) and value.func.attr == "execute" \
+                and isinstance(value.func.value, ast.Name) and re.fullmatch(r"appio_[a-z0-9_]+", target):
+            kwargs = {kw.arg: ast.unparse(kw.value) for kw in value.keywords}
+            executions.setdefault(value.func.value.id, []).append((node.lineno, target, kwargs))
     appio_nodes = {}
-    node_def_pattern = r"(appio_[a-zA-Z0-9]+input.*) = hooks\[(\"AppIO_[a-zA-Z0-9]+\")\]"
-
-    tree = ast.parse(preprocessed_code)
-    for node_def_match in re.finditer(node_def_pattern, preprocessed_code):
-        node_def_name, node_class = node_def_match.groups()
-        node_pattern = fr"(appio_[a-z0-9_]+) = {node_def_name}\.execute"
-        for node_id_match in re.finditer(node_pattern, preprocessed_code):
-            node_id = node_id_match.group(1)
-            arguments = extract_execute_arguments(tree, node_id)
-            appio_nodes[node_id] = InputNode(node_class, arguments)
+    for node_def_name, (_, node_class) in sorted(node_defs.items(), key=lambda item: item[1][0]):
+        for _, node_id, arguments in sorted(executions.get(node_def_name, []), key=lambda execution: execution[0]):
+            appio_nodes.setdefault(node_id, InputNode(node_class, arguments))
     return appio_nodes
 
+HOIST_SAFE_CALLS = ["get_value_at_index"]
+
+def is_invariant(expression, invariant_ids):
+    # Whether an argument is the same for every request: constants and outputs of invariant nodes. Any other call
+    # (e.g. `random.randint` for seeds) or variable (e.g. a loop counter) makes it vary
+    if isinstance(expression, ast.Constant): return True
+    if isinstance(expression, ast.Name): return expression.id in invariant_ids
+    if isinstance(expression, ast.Call):
+        return isinstance(expression.func, ast.Name) and expression.func.id in HOIST_SAFE_CALLS \
+            and all(is_invariant(arg, invariant_ids) for arg in expression.args) \
+            and all(is_invariant(keyword.value, invariant_ids) for keyword in expression.keywords)
+    if isinstance(expression, (ast.List, ast.Tuple, ast.Set)): return all(is_invariant(elt, invariant_ids) for elt in expression.elts)
+    if isinstance(expression, ast.Dict):
+        return all(key is None or is_invariant(key, invariant_ids) for key in expression.keys) \
+            and all(is_invariant(value, invariant_ids) for value in expression.values)
+    if isinstance(expression, ast.UnaryOp): return is_invariant(expression.operand, invariant_ids)
+    if isinstance(expression, ast.BinOp): return is_invariant(expression.left, invariant_ids) and is_invariant(expression.right, invariant_ids)
+    return False
+
+def iter_node_calls(tree, command='', no_hoist=()):
+    # `(node_id, class_name, hooked, hoisted, call)` of the `node_id = instance.method(...)` statements, where the
+    # instance comes from `NODE_CLASS_MAPPINGS["Class"]()` or `hooks["Class"]`. Calls are hoisted when their arguments
+    # don't depend on the outputs of the AppIO hooks, unless the class or `command.node_id` is in `no_hoist`
+    instances, invariant_ids = {}, set()
+    for node in iter_statements(tree.body):
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)): continue
+        target, value = node.targets[0].id, node.value
+        hooked = isinstance(value, ast.Subscript)
+        if hooked: mapping = value
+        elif isinstance(value, ast.Call) and isinstance(value.func, ast.Subscript) and not value.args and not value.keywords: mapping = value.func
+        else: mapping = None
+        if mapping is not None and isinstance(mapping.value, ast.Name) and isinstance(mapping.slice, ast.Constant) \
+                and mapping.value.id == ("hooks" if hooked else "NODE_CLASS_MAPPINGS"):
+            instances[target] = (str(mapping.slice.value), hooked)
+        elif isinstance(value, ast.Call) and isinstance(value.func, ast.Attribute) \
+                and isinstance(value.func.value, ast.Name) and value.func.value.id in instances:
+            class_name, hooked = instances[value.func.value.id]
+            invariant = not (hooked and class_name.startswith("AppIO_")) and len(value.args) == 0 \
+                and class_name not in no_hoist and f"{command}.{target}" not in no_hoist \
+                and all(is_invariant(keyword.value, invariant_ids) for keyword in value.keywords)
+            if invariant: invariant_ids.add(target)
+            else: invariant_ids.discard(target)
+            yield target, class_name, hooked, invariant and not hooked, value
+        else:
+            invariant_ids.discard(target)
+
+def get_dataflow_graph(preprocessed_code, command='', no_hoist=()):
+    # Node calls in source order with the nodes they take outputs from
+    graph: dict[str, GraphNode] = {}
+    for node_id, class_name, hooked, hoisted, call in iter_node_calls(ast.parse(preprocessed_code), command, no_hoist):
+        inputs = [node.id for node in ast.walk(call) if isinstance(node, ast.Name) and node.id in graph and node.id != node_id]
+        graph[node_id] = GraphNode(class_name, call.func.attr, list(dict.fromkeys(inputs)), hooked, hoisted)
+    return graph
+
+def route_node_calls(preprocessed_code, command='', no_hoist=(), hoist_prefix=None):
+    # Rewrites the calls of the nodes that aren't hooked, `ksampler_3 = ksampler.sample(...)` becomes
+    # `ksampler_3 = hooks["run_node"]("ksampler_3", "KSampler", ksampler.sample, ...)` so the worker sees every node.
+    # Hoisted calls go to `hooks["run_hoisted_node"]` with `hoist_prefix + node_id`, the key of their output
+    lines = preprocessed_code.splitlines(keepends=True)
+    line_starts = list(itertools.accumulate([0] + [len(line) for line in lines]))
+    def get_offset(lineno, col_offset): # AST columns count UTF-8 bytes
+        return line_starts[lineno - 1] + len(lines[lineno - 1].encode("utf-8")[:col_offset].decode("utf-8"))
+    edits = []
+    for node_id, class_name, hooked, hoisted, call in iter_node_calls(ast.parse(preprocessed_code), command, no_hoist):
+        if hooked or len(call.args): continue
+        start = get_offset(call.lineno, call.col_offset)
+        paren = preprocessed_code.index('(', get_offset(call.func.end_lineno, call.func.end_col_offset))
+        func = preprocessed_code[start:get_offset(call.func.end_lineno, call.func.end_col_offset)]
+        if hoisted and hoist_prefix is not None:
+            edits.append((start, paren + 1, f'hooks["run_hoisted_node"]({json.dumps(hoist_prefix + node_id)}, {json.dumps(class_name)}, {func}, '))
+        else:
+            edits.append((start, paren + 1, f'hooks["run_node"]({json.dumps(node_id)}, {json.dumps(class_name)}, {func}, '))
+    for start, end, text in reversed(edits):
+        preprocessed_code = preprocessed_code[:start] + text + preprocessed_code[end:]
+    return preprocessed_code
+
+def get_hoist_prefix(command, source_hash):
+    # Hoisted outputs are kept per version of the workflow
+    return f"{command}:{source_hash[:16]}:"
+
+def get_manifest_file():
+    return preprocessed_dir / "manifest.json"
+
+def load_manifest():
+    try:
+        return json.loads(get_manifest_file().read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+def get_command_input_nodes(manifest):
+    return {
+        command: {node_id: InputNode(**input_node) for node_id, input_node in entry["input_nodes"].items()}
+        for command, entry in manifest["workflows"].items()
+    }
+
+def update_preprocessed(hooks):
+    # Regenerates only the workflows whose source changed since the manifest was written (all of them when the hooks
+    # or PREPROCESS_VERSION changed), and stores their input nodes in the manifest. Returns the commands and the
+    # commands that were added, changed or removed
+    global command_input_nodes
+    preprocessed_dir.mkdir(exist_ok=True)
+    no_hoist = CommandConfig.get_no_hoist()
+    version = hashlib.sha256(json.dumps([PREPROCESS_VERSION, preprocessed_init_code, list(hooks), no_hoist]).encode()).hexdigest()
+    manifest = load_manifest()
+    if manifest is None or manifest.get("version") != version:
+        manifest = {"version": version, "workflows": {}}
+    workflows, changed = {}, []
+    for workflow_py in sorted(py_workflows_dir.iterdir()):
+        if workflow_py.name.startswith('.'): continue #E.g. .ipynb_checkpoints
+        if workflow_py.suffix != '.py': continue
+        source = workflow_py.read_bytes()
+        source_hash = hashlib.sha256(source).hexdigest()
+        command, preprocessed_file = workflow_py.stem, preprocessed_dir / f"appio_{workflow_py.name}"
+        entry = manifest["workflows"].get(command)
+        if entry is None or entry["hash"] != source_hash or not preprocessed_file.is_file():
+            code = preprocess_workflow(source.decode("utf-8"), hooks)
+            preprocessed_file.write_text(route_node_calls(code, command, no_hoist, get_hoist_prefix(command, source_hash)), encoding="utf-8")
+            input_nodes = {node_id: asdict(input_node) for node_id, input_node in get_input_nodes(code).items()}
+            graph = {node_id: asdict(graph_node) for node_id, graph_node in get_dataflow_graph(code, command, no_hoist).items()}
+            entry = {"hash": source_hash, "input_nodes": input_nodes, "graph": graph}
+            changed.append(command)
+        workflows[command] = entry
+    for preprocessed_file in preprocessed_dir.glob("appio_*.py"):
+        if preprocessed_file.stem[len("appio_"):] not in workflows:
+            preprocessed_file.unlink()
+            changed.append(preprocessed_file.stem[len("appio_"):])
+
+    init_code = preprocessed_init_code + "\n\n" + '\n'.join([f"from .appio_{command} import main as {command}" for command in workflows])
+    init_file = preprocessed_dir / "__init__.py"
+    if not init_file.is_file() or init_file.read_text(encoding="utf-8") != init_code:
+        init_file.write_text(init_code, encoding="utf-8")
+    manifest["workflows"] = workflows
+    temp_file = get_manifest_file().with_suffix(".tmp")
+    temp_file.write_text(json.dumps(manifest), encoding="utf-8")
+    os.replace(temp_file, get_manifest_file())
+    command_input_nodes = get_command_input_nodes(manifest)
+    return list(workflows), changed
+
+def preprocess(hooks):
+    commands = update_preprocessed(hooks)[0]
+    print(get_hoisting_report())
+    return commands
+
+def get_dataflow_graphs():
+    manifest = load_manifest() or {"workflows": {}}
+    return {
+        command: {node_id: GraphNode(**graph_node) for node_id, graph_node in entry.get("graph", {}).items()}
+        for command, entry in manifest["workflows"].items()
+    }
+
+def get_hoisting_report():
+    # Nodes computed once per process, by command. `no_hoist` in config.yaml opts classes or `command.node_id` out
+    text = "Hoisted nodes:\n"
+    for command, graph in get_dataflow_graphs().items():
+        hoisted = [f"{graph_node.class_name} ({node_id})" for node_id, graph_node in graph.items() if graph_node.hoisted]
+        text += f"• {command}: {len(hoisted)}/{len(graph)} nodes{': ' if len(hoisted) else ''}{', '.join(hoisted)}\n"
+    return text.strip()
+
 command_input_nodes = None
 def analyze_argument_from_preprocessed():
     global command_input_nodes
     if command_input_nodes is not None:
         return command_input_nodes
-    else:
-        command_input_nodes = {}
-    for workflow_py in preprocessed_dir.iterdir():
-        if workflow_py.stem.startswith("__"): continue
-        command_input_nodes[workflow_py.stem.replace("appio_", '')] = get_input_nodes(workflow_py.read_text(encoding="utf-8"))
+    manifest = load_manifest()
+    if manifest is not None:
+        command_input_nodes = get_command_input_nodes(manifest)
+        return command_input_nodes
+    input_nodes = {}
+    for workflow_py in preprocessed_dir.glob("appio_*.py"):
+        input_nodes[workflow_py.stem.replace("appio_", '')] = get_input_nodes(workflow_py.read_text(encoding="utf-8"))
+    command_input_nodes = input_nodes
     return command_input_nodes
 
+def reload_preprocessed_modules(commands):
+    # Swaps the `preprocessed` entry points of the given commands, if the package is already imported
+    preprocessed = sys.modules.get("preprocessed")
+    if preprocessed is None: return
+    importlib.invalidate_caches()
+    for command in commands:
+        module_name, module_file = f"preprocessed.appio_{command}", preprocessed_dir / f"appio_{command}.py"
+        if not module_file.is_file():
+            sys.modules.pop(module_name, None)
+            if hasattr(preprocessed, command): delattr(preprocessed, command)
+            continue
+        # The bytecode cache only checks the mtime in seconds and the size, an edit can slip through
+        Path(importlib.util.cache_from_source(str(module_file))).unlink(missing_ok=True)
+        if module_name in sys.modules: module = importlib.reload(sys.modules[module_name])
+        else: module = importlib.import_module(module_name)
+        setattr(preprocessed, command, module.main)
+
+class WorkflowWatcher:
+    # Polls python_workflows/ for edits. An edited workflow is preprocessed again on its own and its module reloaded
+    # in place, and config.yaml is read again, so the next request uses them without restarting the bot
+    def __init__(self, hooks, on_reload=None, interval=WORKFLOW_WATCH_SECS):
+        self.hooks = hooks
+        self.on_reload = on_reload
+        self.interval = interval
+
+    def get_mtimes(self):
+        return {path.name: path.stat().st_mtime_ns for path in py_workflows_dir.iterdir() if path.suffix in [".py", ".yaml"]}
+
+    def start(self):
+        if self.interval <= 0: return
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def loop(self):
+        mtimes = self.get_mtimes()
+        while True:
+            time.sleep(self.interval)
+            try:
+                new_mtimes = self.get_mtimes()
+                if new_mtimes == mtimes: continue
+                mtimes = new_mtimes
+                self.reload()
+            except Exception as e:
+                print(f"Can't reload workflows: {e}")
+
+    def reload(self):
+        CommandConfig.reload()
+        commands, changed = update_preprocessed(self.hooks)
+        reload_preprocessed_modules(changed)
+        if len(changed): print(f"Reloaded workflows: {', '.join(changed)}")
+        if self.on_reload is not None: self.on_reload(commands, changed)
+
 @dataclass
 class GuideCommand:
     name: str
@@ -159,11 +366,18 @@ class GuideCommand:
     text: str
     pil_images: list[Image.Image]
 
+def load_command_config(config_file_path):
+    return (yaml.safe_load(config_file_path.read_text(encoding="utf-8"))
+            if config_file_path.is_file() 
+            else {"display_names": {}, "no_return_original": []})
+
 class CommandConfig:
     CONFIG_FILE_PATH = Path(py_workflows_dir, "config.yaml")
-    CONFIG = (yaml.safe_load(CONFIG_FILE_PATH.read_text(encoding="utf-8"))
-            if CONFIG_FILE_PATH.is_file() 
-            else {"display_names": {}, "no_return_original": []})
+    CONFIG = load_command_config(CONFIG_FILE_PATH)
+
+    @classmethod
+    def reload(cls):
+        cls.CONFIG = load_command_config(cls.CONFIG_FILE_PATH)
     
     @classmethod
     def get_guide_files(cls):
@@ -188,6 +402,16 @@ class CommandConfig:
     @classmethod
     def get_no_return_original(cls):
         return cls.CONFIG["no_return_original"]
+
+    @classmethod
+    def get_no_hoist(cls):
+        # e.g. `no_hoist: [LoadImageFromUrl, restyle.cliptextencode_7]`, nodes to compute again for each request
+        return cls.CONFIG.get("no_hoist", None) or []
+
+    @classmethod
+    def get_video_options(cls, command: str):
+        # e.g. `video_input: {animate: {max_frames: 48, target_fps: 12, max_resolution: 768}}`
+        return cls.CONFIG.get("video_input", {}).get(command, {})
     
     @classmethod
     def get_guides(cls):
@@ -0,0 +1,123 @@
+import os, time, math, threading
+from collections import deque
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+from backed_bot_utils import mention
+from telegram_outbound import outbound, PRIORITY_STATUS
+from startup import Startup
+
+QUEUE_UPDATE_SECS = float(os.environ.get("QUEUE_UPDATE_SECS", "2.5"))
+QUEUE_EDITS_PER_SEC = float(os.environ.get("QUEUE_EDITS_PER_SEC", "5"))
+QUEUE_EDITS_PER_CHAT_MIN = int(os.environ.get("QUEUE_EDITS_PER_CHAT_MIN", "10")) # Telegram allows 20 messages/min per group
+QUEUE_DURATION_SMOOTHING = 0.2
+
+class QueueEntry:
+    def __init__(self, request):
+        self.request = request
+        self.position = 0
+        self.shown = None # (people ahead, ETA in minutes, warming up) last displayed
+        self.lock = threading.Lock() # Held while the queue message is edited
+
+class QueueBroadcaster:
+    # Shows queue positions to everyone waiting from a single thread. Positions are only pushed by `update`, and a
+    # message is edited only when the displayed position or ETA changed, nearest to the front first, within a global
+    # and a per-chat edit budget. Edits over budget are coalesced into the next round
+    def __init__(self, bot: TeleBot, concurrency=1):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.cond = threading.Condition()
+        self.entries: dict[object, QueueEntry] = {}
+        self.chat_edits: dict[int, deque] = {}
+        self.avg_duration = None
+        self.last_edit = 0.
+        self.paused_until = 0.
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    @staticmethod
+    def get_key(request):
+        return (request.orig_message.chat.id, request.orig_message.id)
+
+    def update(self, queued_requests):
+        # `queued_requests` in dequeue order. Requests no longer queued stop being updated
+        with self.cond:
+            queued_keys = set()
+            for position, request in enumerate(queued_requests):
+                if request.message is None: continue
+                key = self.get_key(request)
+                queued_keys.add(key)
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = self.entries[key] = QueueEntry(request)
+                entry.position = position
+            removed = [self.entries.pop(key) for key in list(self.entries) if key not in queued_keys]
+            self.cond.notify()
+        for entry in removed:
+            with entry.lock: pass # Wait for an edit in flight, so it can't overwrite what comes next
+
+    def untrack(self, request):
+        with self.cond:
+            entry = self.entries.pop(self.get_key(request), None)
+        if entry is not None:
+            with entry.lock: pass
+
+    def record_duration(self, seconds):
+        with self.cond:
+            if self.avg_duration is None: self.avg_duration = seconds
+            else: self.avg_duration += QUEUE_DURATION_SMOOTHING * (seconds - self.avg_duration)
+
+    def get_display(self, entry: QueueEntry):
+        eta_minutes = None
+        if self.avg_duration is not None:
+            eta_minutes = math.ceil(entry.position * self.avg_duration / self.concurrency / 60)
+        return entry.position, eta_minutes, not Startup.is_ready()
+
+    def render(self, entry: QueueEntry, display):
+        people_ahead, eta_minutes, warming_up = display
+        text = f"{mention(entry.request.orig_message.from_user)} Queuing: `{people_ahead}` people ahead"
+        if warming_up: text += ", the bot is warming up"
+        elif eta_minutes: text += f", about `{eta_minutes}` min"
+        return text + "..."
+
+    def take_chat_budget(self, chat_id, now):
+        edits = self.chat_edits.setdefault(chat_id, deque())
+        while edits and edits[0] <= now - 60: edits.popleft()
+        if len(edits) >= QUEUE_EDITS_PER_CHAT_MIN: return False
+        edits.append(now)
+        return True
+
+    def loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait(QUEUE_UPDATE_SECS)
+                pending = sorted(
+                    (entry for entry in self.entries.values() if self.get_display(entry) != entry.shown),
+                    key=lambda entry: entry.position
+                )
+            for entry in pending:
+                with self.cond:
+                    if not self.take_chat_budget(entry.request.message.chat.id, time.time()): continue
+                time.sleep(max(0., self.paused_until - time.time(), self.last_edit + 1 / QUEUE_EDITS_PER_SEC - time.time()))
+                with entry.lock:
+                    with self.cond:
+                        if self.entries.get(self.get_key(entry.request)) is not entry: continue
+                        display = self.get_display(entry)
+                    self.last_edit = time.time()
+                    if display != entry.shown:
+                        self.edit(entry, display)
+
+    def edit(self, entry: QueueEntry, display):
+        message = entry.request.message
+        try:
+            with outbound.priority(PRIORITY_STATUS):
+                self.bot.edit_message_text(self.render(entry, display), message.chat.id, message.id, parse_mode="Markdown")
+            entry.shown = display
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                self.paused_until = time.time() + e.result_json.get("parameters", {}).get("retry_after", 5)
+                return
+            entry.shown = display # Not retried until the position changes again
+            if "message is not modified" not in e.description:
+                print(f"Can't update queue position: {e.description}")
+        except Exception as e:
+            entry.shown = display
+            print(f"Can't update queue position: {e}")
@@ -0,0 +1,180 @@
+import os, json, time, uuid, hashlib, pickle, threading
+from pathlib import Path
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from telebot import types, TeleBot
+from backed_bot_utils import get_sqldict_db, get_message_file, TelegramFile
+from preprocess import py_workflows_dir, CommandConfig
+from auth_manager import AuthManager
+from metrics import CACHE_LOOKUPS
+from media_codec import EncodedImage
+
+RESULT_CACHE_MAX_MB = float(os.environ.get("RESULT_CACHE_MAX_MB", "1024"))
+result_cache_dir = Path(__file__).parent / "dbm_data" / "result_cache"
+
+@dataclass
+class CachedOutput:
+    size: int
+    telegram_file: TelegramFile = None
+
+@dataclass
+class ResultCacheEntry:
+    outputs: dict[int, CachedOutput] = field(default_factory=dict)
+    last_access: float = field(default_factory=time.time)
+    complete: bool = False # Set when published, once the run succeeded and every output was sent
+
+    @property
+    def size(self):
+        return sum(output.size for output in self.outputs.values())
+
+workflow_hashes = {}
+def get_workflow_info(command_name):
+    # (hash of the workflow code, whether it sends text), refreshed when the workflow is edited
+    workflow_py = py_workflows_dir / f"{command_name}.py"
+    if not workflow_py.is_file(): return None, False
+    mtime = workflow_py.stat().st_mtime
+    if workflow_hashes.get(command_name, (None,))[0] != mtime:
+        code = workflow_py.read_bytes()
+        workflow_hashes[command_name] = (mtime, hashlib.sha256(code).hexdigest(), b'"AppIO_StringOutput"' in code)
+    return workflow_hashes[command_name][1:]
+
+def get_workflow_hash(command_name):
+    return get_workflow_info(command_name)[0]
+
+class ResultCache:
+    index = None
+    lru: OrderedDict[str, int] = OrderedDict()
+    total_size = 0
+    lock = threading.Lock()
+    stats = {"hits": 0, "misses": 0, "resent_by_id": 0, "evictions": 0}
+    staged: dict[str, ResultCacheEntry] = {} # Outputs of runs in progress, by pending key
+
+    @classmethod
+    def enabled(cls, command_name):
+        # Only image outputs are stored, a hit would drop the text of workflows with an AppIO_StringOutput
+        return cls.index is not None and command_name not in CommandConfig.CONFIG.get("no_result_cache", []) \
+            and not get_workflow_info(command_name)[1]
+
+    @classmethod
+    def warmup(cls):
+        if RESULT_CACHE_MAX_MB <= 0: return
+        result_cache_dir.mkdir(exist_ok=True, parents=True)
+        cls.index = get_sqldict_db("result_cache")
+        for staged_path in result_cache_dir.glob("pending_*.pkl"): # Left by runs the bot was stopped in
+            staged_path.unlink(missing_ok=True)
+        entries: dict[str, ResultCacheEntry] = dict(cls.index.items())
+        for key, entry in list(entries.items()):
+            if getattr(entry, "complete", False): continue
+            for output_idx in entry.outputs:
+                cls.get_path(key, output_idx).unlink(missing_ok=True)
+            del cls.index[key], entries[key]
+        for key, entry in sorted(entries.items(), key=lambda item: item[1].last_access):
+            cls.lru[key] = entry.size
+            cls.total_size += entry.size
+
+    @classmethod
+    def get_key(cls, bot: TeleBot, command_name, message: types.Message, parsed_data: dict, input_file_ids):
+        # Same command, same form values and same input files (by file_unique_id) on the same workflow code
+        input_unique_ids = []
+        media = get_message_file(message)
+        if media is not None:
+            input_unique_ids.append(media.file_unique_id)
+        for file_id in input_file_ids:
+            input_unique_ids.append(bot.get_file(file_id).file_unique_id)
+        payload = json.dumps([
+            command_name,
+            {k: str(v) for k, v in parsed_data.items() if k != "id"},
+            input_unique_ids,
+            get_workflow_hash(command_name)
+        ], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @classmethod
+    def get_path(cls, key, output_idx):
+        return result_cache_dir / f"{key}_{output_idx}.pkl"
+
+    @classmethod
+    def get(cls, key) -> ResultCacheEntry:
+        with cls.lock:
+            entry: ResultCacheEntry = cls.index[key] if key in cls.lru else None
+            if entry is None or not getattr(entry, "complete", False):
+                cls.stats["misses"] += 1
+                return None
+            cls.stats["hits"] += 1
+            cls.lru.move_to_end(key)
+            entry.last_access = time.time()
+            cls.index[key] = entry
+            return entry
+
+    @classmethod
+    def load_output(cls, key, output_idx) -> EncodedImage:
+        return pickle.loads(cls.get_path(key, output_idx).read_bytes())
+
+    @classmethod
+    def stage(cls):
+        # Pending key under which the outputs of a run are put until it's published or discarded
+        return f"pending_{uuid.uuid4().hex}"
+
+    @classmethod
+    def put(cls, pending_key, output_idx, output: EncodedImage, telegram_file: TelegramFile = None):
+        blob = pickle.dumps(output)
+        with cls.lock:
+            cls.get_path(pending_key, output_idx).write_bytes(blob)
+            cls.staged.setdefault(pending_key, ResultCacheEntry()).outputs[output_idx] = CachedOutput(len(blob), telegram_file)
+
+    @classmethod
+    def publish(cls, key, pending_key):
+        # The staged outputs become the entry of `key`, unless an identical run published it first
+        with cls.lock:
+            entry = cls.staged.pop(pending_key, None)
+            if entry is None: return
+            if key in cls.lru or len(entry.outputs) == 0:
+                cls.staged[pending_key] = entry
+            else:
+                for output_idx in entry.outputs:
+                    cls.get_path(pending_key, output_idx).replace(cls.get_path(key, output_idx))
+                entry.complete = True
+                entry.last_access = time.time()
+                cls.index[key] = entry
+                cls.total_size += entry.size
+                cls.lru[key] = entry.size
+                cls.evict()
+                return
+        cls.discard(pending_key)
+
+    @classmethod
+    def discard(cls, pending_key):
+        with cls.lock:
+            entry = cls.staged.pop(pending_key, None)
+        if entry is None: return
+        for output_idx in entry.outputs:
+            cls.get_path(pending_key, output_idx).unlink(missing_ok=True)
+
+    @classmethod
+    def evict(cls):
+        while cls.total_size > RESULT_CACHE_MAX_MB * 1024 * 1024 and len(cls.lru) > 1:
+            key, size = cls.lru.popitem(last=False)
+            entry: ResultCacheEntry = cls.index.pop(key, None)
+            if entry is not None:
+                for output_idx in entry.outputs:
+                    cls.get_path(key, output_idx).unlink(missing_ok=True)
+            cls.total_size -= size
+            cls.stats["evictions"] += 1
+
+    @classmethod
+    def serialize_stats(cls):
+        lookups = cls.stats["hits"] + cls.stats["misses"]
+        hit_rate = cls.stats["hits"] / lookups * 100 if lookups else 0
+        return '\n'.join([
+            f"• Entries: `{len(cls.lru)}` (`{cls.total_size / 1024 / 1024:.1f}`/`{RESULT_CACHE_MAX_MB:.0f}` MB)",
+            f"• Hits: `{cls.stats['hits']}`, misses: `{cls.stats['misses']}` (hit rate `{hit_rate:.1f}%`)",
+            f"• Resent by Telegram file id: `{cls.stats['resent_by_id']}`",
+            f"• Evictions: `{cls.stats['evictions']}`",
+        ])
+
+    @classmethod
+    def get_stats(cls, bot: TeleBot, message: types.Message, parsed_data: dict):
+        if not AuthManager.check_admin(message, "get result cache stats"): return
+        bot.reply_to(message, cls.serialize_stats(), parse_mode="Markdown")
+
+CACHE_LOOKUPS.add(lambda: {("result", "hit"): ResultCache.stats["hits"], ("result", "miss"): ResultCache.stats["misses"]})
@@ -0,0 +1,174 @@
+import os, threading, heapq, itertools, time
+from collections import deque
+
+ADMIN_USER_ID = os.environ.get("ADMIN_USER_ID", '')
+LANE_ADMIN, LANE_ADVANCED, LANE_NORMAL = 0, 1, 2
+
+def parse_weights(weights_str):
+    weights = {}
+    for pair in weights_str.split(','):
+        if ':' not in pair: continue
+        key, weight = pair.rsplit(':', 1)
+        weights[key.strip()] = float(weight)
+    return weights
+
+# Format: "<chat_id or user_id>:<weight>,...", e.g. "-100123456:2,98765:0.5"
+SCHEDULER_WEIGHTS = parse_weights(os.environ.get("SCHEDULER_WEIGHTS", ''))
+
+class SchedulingPolicy:
+    # Lower lane is served first. Inside a lane, chats then users share the executor proportionally to their weights
+    def get_lane(self, request) -> int:
+        return 0
+
+    def get_chat_weight(self, chat_id: str) -> float:
+        return SCHEDULER_WEIGHTS.get(chat_id, 1.)
+
+    def get_user_weight(self, user_id: str) -> float:
+        return SCHEDULER_WEIGHTS.get(user_id, 1.)
+
+class PriorityFairPolicy(SchedulingPolicy):
+    def get_lane(self, request) -> int:
+        from auth_manager import AuthManager
+        if request.user_id == ADMIN_USER_ID:
+            return LANE_ADMIN
+        user_info = AuthManager.allowed_users.get(request.user_id, None)
+        if user_info is not None and user_info.advanced_info is not None:
+            return LANE_ADVANCED
+        return LANE_NORMAL
+
+class Flow:
+    def __init__(self, key, weight, vtime, seq):
+        self.key = key
+        self.weight = max(weight, 1e-6)
+        self.vtime = vtime
+        self.seq = seq
+        self.children: dict[str, "Flow"] = {}
+        self.clock = 0.
+        self.requests = deque()
+
+    def sort_key(self):
+        return (self.vtime, self.seq)
+
+    def pick(self):
+        return min(self.children.values(), key=Flow.sort_key)
+
+class RequestScheduler:
+    # Lane -> chat flow -> user flow -> FIFO of requests. Each flow carries a virtual time advanced by 1/weight
+    # per served request, the flow with the smallest virtual time is served next (start-time fair queuing).
+    def __init__(self, policy: SchedulingPolicy = None):
+        self.policy = policy or PriorityFairPolicy()
+        self.cond = threading.Condition()
+        self.lanes: dict[int, Flow] = {}
+        self.lane_of = {}
+        self.seq = itertools.count()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def put(self, request):
+        with self.cond:
+            lane_id = self.policy.get_lane(request)
+            if lane_id not in self.lanes:
+                self.lanes[lane_id] = Flow(lane_id, 1., 0., next(self.seq))
+            lane = self.lanes[lane_id]
+            chat = lane.children.get(request.chat_id)
+            if chat is None:
+                chat = lane.children[request.chat_id] = Flow(
+                    request.chat_id, self.policy.get_chat_weight(request.chat_id), lane.clock, next(self.seq)
+                )
+            user = chat.children.get(request.user_id)
+            if user is None:
+                user = chat.children[request.user_id] = Flow(
+                    request.user_id, self.policy.get_user_weight(request.user_id), chat.clock, next(self.seq)
+                )
+            user.requests.append(request)
+            self.lane_of[id(request)] = lane_id
+            self.size += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        # Blocks until a request is available. Returns None on timeout
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.size > 0, timeout):
+                return None
+            return self._pop()
+
+    def remove(self, request):
+        with self.cond:
+            lane_id = self.lane_of.pop(id(request), None)
+            if lane_id is None: return False
+            chat = self.lanes[lane_id].children[request.chat_id]
+            user = chat.children[request.user_id]
+            user.requests.remove(request)
+            self.size -= 1
+            self._prune(lane_id, chat, user)
+            return True
+
+    def take_matching(self, predicate, limit, timeout=0.):
+        # Removes up to `limit` queued requests satisfying `predicate`, in serving order,
+        # waiting up to `timeout` seconds for more of them to arrive
+        deadline = time.monotonic() + timeout
+        taken = []
+        with self.cond:
+            while True:
+                for request in self.snapshot():
+                    if len(taken) >= limit: break
+                    if predicate(request):
+                        self.remove(request)
+                        taken.append(request)
+                remaining = deadline - time.monotonic()
+                if len(taken) >= limit or remaining <= 0:
+                    return taken
+                self.cond.wait(remaining)
+
+    def snapshot(self):
+        # Simulates the dequeue order without mutating the scheduler
+        with self.cond:
+            order = []
+            for lane_id in sorted(self.lanes):
+                heap = []
+                for chat in self.lanes[lane_id].children.values():
+                    users = [[user.vtime, user.seq, user.weight, list(user.requests)] for user in chat.children.values()]
+                    heapq.heapify(users)
+                    heap.append([chat.vtime, chat.seq, chat.weight, users])
+                heapq.heapify(heap)
+                while heap:
+                    chat = heapq.heappop(heap)
+                    users = chat[3]
+                    user = heapq.heappop(users)
+                    order.append(user[3].pop(0))
+                    user[0] += 1 / user[2]
+                    if user[3]: heapq.heappush(users, user)
+                    chat[0] += 1 / chat[2]
+                    if users: heapq.heappush(heap, chat)
+            return order
+
+    def _pop(self):
+        lane_id = min(self.lanes)
+        lane = self.lanes[lane_id]
+        chat = lane.pick()
+        user = chat.pick()
+        request = user.requests.popleft()
+        lane.clock = chat.vtime
+        chat.clock = user.vtime
+        chat.vtime += 1 / chat.weight
+        user.vtime += 1 / user.weight
+        del self.lane_of[id(request)]
+        self.size -= 1
+        self._prune(lane_id, chat, user)
+        return request
+
+    def _prune(self, lane_id, chat: Flow, user: Flow):
+        if not user.requests:
+            del chat.children[user.key]
+        if not chat.children:
+            del self.lanes[lane_id].children[chat.key]
+        if not self.lanes[lane_id].children:
+            del self.lanes[lane_id]
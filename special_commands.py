@@ -4,7 +4,12 @@ from backed_bot_utils import telegram_reply_to, handle_exception, get_username,
 from PIL import Image
 from io import BytesIO
 import os
-from auth_manager import AuthManager, ComfyCommandManager
+from auth_manager import AuthManager, ComfyCommandManager, ADMIN_USER_ID
+from result_cache import ResultCache
+from node_cache import NodeOutputCache
+from media_cache import MediaCache
+from warm_pool import WarmPool
+from node_profiler import NodeProfiler
 
 IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png").upper()
 
@@ -38,8 +43,8 @@ def get_image_id(bot: TeleBot, message: types.Message, parsed_data: dict):
             file_id = image_ids[full_image_id]
             telegram_reply_to(bot, message, f"Found image id {_image_id}. Wait a second")
         
-        file_info = bot.get_file(file_id)
-        image_pil = Image.open(BytesIO(bot.download_file(file_info.file_path)))
+        content, _, _ = MediaCache.get_bytes(bot, file_id)
+        image_pil = Image.open(BytesIO(content))
         image_bytes = BytesIO()
         image_pil.save(image_bytes, format=IMAGE_FORMAT)
         image_bytes.seek(0)
@@ -47,16 +52,30 @@ def get_image_id(bot: TeleBot, message: types.Message, parsed_data: dict):
     except:
         handle_exception(bot, message)    
 
+def invalidating_users(command):
+    # Admin edits to users are committed right away, and the user cache reloads from the database afterwards
+    def invalidating_command(bot: TeleBot, message: types.Message, parsed_data: dict):
+        try: return command(bot, message, parsed_data)
+        finally:
+            if str(message.from_user.id) == ADMIN_USER_ID:
+                AuthManager.allowed_users.invalidate()
+    return invalidating_command
+
 SPECIAL_COMMANDS = {
     "set_image_id": set_image_id,
     "get_image_id": get_image_id,
     "get_allowed": AuthManager.get_allowed,
-    "add_allowed": AuthManager.add_allowed,
-    "remove_allowed": AuthManager.remove_allowed,
-    "add_advanced": AuthManager.add_advanced,
-    "remove_advanced": AuthManager.remove_advanced,
+    "add_allowed": invalidating_users(AuthManager.add_allowed),
+    "remove_allowed": invalidating_users(AuthManager.remove_allowed),
+    "add_advanced": invalidating_users(AuthManager.add_advanced),
+    "remove_advanced": invalidating_users(AuthManager.remove_advanced),
     "notify_advanced": AuthManager.notify_advanced,
-    "set_normal_uses": AuthManager.set_normal_uses,
+    "set_normal_uses": invalidating_users(AuthManager.set_normal_uses),
     "get_commands": ComfyCommandManager.get_commands,
-    "set_commands": ComfyCommandManager.set_commands
+    "set_commands": ComfyCommandManager.set_commands,
+    "result_cache": ResultCache.get_stats,
+    "node_cache": NodeOutputCache.admin,
+    "media_cache": MediaCache.get_stats,
+    "warmup": WarmPool.admin,
+    "node_profile": NodeProfiler.admin
 }
\ No newline at end of file
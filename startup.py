@@ -0,0 +1,50 @@
+import time, threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+WARMING_UP, READY, FAILED = "warming up", "ready", "failed"
+
+class Startup:
+    # Timings of the startup phases, and whether commands can be executed yet. Until the worker has imported
+    # ComfyUI the frontend accepts commands but tells users the bot is warming up
+    start_time = time.perf_counter()
+    state = WARMING_UP
+    phases: dict[str, float] = {}
+    lock = threading.Lock()
+    ready = threading.Event()
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name):
+        start = time.perf_counter()
+        try: yield
+        finally:
+            with cls.lock: cls.phases[name] = time.perf_counter() - start
+
+    @classmethod
+    def run_phase(cls, name, func):
+        with cls.phase(name): return func()
+
+    @classmethod
+    def run_parallel(cls, phases: dict):
+        # Runs independent phases on threads and returns their results by name, raising the first error
+        with ThreadPoolExecutor(max_workers=len(phases), thread_name_prefix="startup") as pool:
+            futures = {name: pool.submit(cls.run_phase, name, func) for name, func in phases.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    @classmethod
+    def set_state(cls, state):
+        cls.state = state
+        if state != WARMING_UP:
+            with cls.lock: cls.phases["total"] = time.perf_counter() - cls.start_time
+            print(f"Startup {state}: {cls.report()}")
+            cls.ready.set()
+
+    @classmethod
+    def is_ready(cls):
+        return cls.state == READY
+
+    @classmethod
+    def report(cls):
+        with cls.lock:
+            return ', '.join(f"{name} {seconds:.2f}s" for name, seconds in cls.phases.items())
@@ -0,0 +1,207 @@
+import os, time, bisect, asyncio, itertools, threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+from metrics import TELEGRAM_REQUEST_DURATION, TELEGRAM_RATE_LIMITED
+
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30")) # Requests/second for the whole bot
+TELEGRAM_GROUP_RATE = float(os.environ.get("TELEGRAM_GROUP_RATE", "20")) # Requests/minute per group
+TELEGRAM_PRIVATE_RATE = float(os.environ.get("TELEGRAM_PRIVATE_RATE", "1")) # Requests/second per private chat
+TELEGRAM_SEND_WORKERS = int(os.environ.get("TELEGRAM_SEND_WORKERS", "8"))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", "3")) # On 429, after waiting for retry_after
+PRIORITY_OUTPUT, PRIORITY_INTERACTIVE, PRIORITY_STATUS = 0, 1, 2
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.
+
+    def get_wait(self, now):
+        # Seconds until a token is available
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0., self.paused_until - now, (1 - self.tokens) / self.rate)
+
+@dataclass(order=True)
+class OutboundRequest:
+    priority: int
+    seq: int
+    chat_id: object = field(compare=False)
+    func: object = field(compare=False)
+    args: tuple = field(compare=False)
+    kwargs: dict = field(compare=False)
+    future: Future = field(compare=False, default_factory=Future)
+    attempts: int = field(compare=False, default=0)
+
+class TelegramOutbound:
+    # Every Bot API request addressed to a chat goes through here: requests wait in priority order for a token of
+    # the global bucket and of their chat's bucket, then run on a small thread pool. A 429 pauses the chat for
+    # retry_after and puts the request back in line instead of sleeping on a thread
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue: list[OutboundRequest] = []
+        self.seq = itertools.count()
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets: dict[str, TokenBucket] = {}
+        self.executor = ThreadPoolExecutor(max_workers=TELEGRAM_SEND_WORKERS, thread_name_prefix="telegram")
+        self.local = threading.local()
+        self.make_request = None
+        self.process_request = None
+        self.stats = {"sent": 0, "rate_limited": 0}
+        threading.Thread(target=self.dispatch_loop, daemon=True).start()
+
+    def install(self):
+        # Routes the requests of every TeleBot instance through the limiter
+        if self.make_request is not None: return
+        self.make_request = self.measured(apihelper._make_request)
+        apihelper._make_request = self.gated_make_request
+
+    def gated_make_request(self, token, method_name, method='get', params=None, files=None):
+        chat_id = (params or {}).get("chat_id")
+        if chat_id is None or getattr(self.local, "admitted", False):
+            return self.make_request(token, method_name, method, params, files)
+        priority = getattr(self.local, "priority", PRIORITY_INTERACTIVE)
+        return self.submit(chat_id, self.make_request, token, method_name, method, params, files, priority=priority).result()
+
+    def install_async(self):
+        # Same for AsyncTeleBot: coroutines wait for their token without holding a thread
+        from telebot import asyncio_helper
+        if self.process_request is not None: return
+        self.process_request = self.measured_async(asyncio_helper._process_request)
+        asyncio_helper._process_request = self.gated_process_request
+
+    async def gated_process_request(self, token, url, method='get', params=None, files=None, **kwargs):
+        chat_id = (params or {}).get("chat_id")
+        if chat_id is None:
+            return await self.process_request(token, url, method, params, files, **kwargs)
+        for attempt in itertools.count(1):
+            await asyncio.wrap_future(self.submit(chat_id, lambda: None))
+            try:
+                return await self.process_request(token, url, method, params, files, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt > TELEGRAM_MAX_RETRIES: raise
+                self.pause(chat_id, e)
+                self.rewind_files(params, files)
+
+    @staticmethod
+    def measured(make_request):
+        # Latency and 429s by Bot API method, every attempt counted
+        def request(token, method_name, *args, **kwargs):
+            start_time = time.perf_counter()
+            try: return make_request(token, method_name, *args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429: TELEGRAM_RATE_LIMITED.inc(method_name)
+                raise
+            finally: TELEGRAM_REQUEST_DURATION.observe(time.perf_counter() - start_time, method_name)
+        return request
+
+    @staticmethod
+    def measured_async(process_request):
+        async def request(token, url, *args, **kwargs):
+            start_time = time.perf_counter()
+            try: return await process_request(token, url, *args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429: TELEGRAM_RATE_LIMITED.inc(url)
+                raise
+            finally: TELEGRAM_REQUEST_DURATION.observe(time.perf_counter() - start_time, url)
+        return request
+
+    @contextmanager
+    def priority(self, priority):
+        # Priority of the requests made by the calling thread
+        previous = getattr(self.local, "priority", PRIORITY_INTERACTIVE)
+        self.local.priority = priority
+        try: yield
+        finally: self.local.priority = previous
+
+    def submit(self, chat_id, func, *args, priority=PRIORITY_INTERACTIVE, **kwargs) -> Future:
+        # `func(*args, **kwargs)` must make a single API request to `chat_id`
+        request = OutboundRequest(priority, next(self.seq), str(chat_id), func, args, kwargs)
+        self.put(request)
+        return request.future
+
+    def put(self, request: OutboundRequest):
+        with self.cond:
+            bisect.insort(self.queue, request)
+            self.cond.notify()
+
+    def get_chat_bucket(self, chat_id: str):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 4096:
+                now = time.monotonic()
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if b.get_wait(now) > 0 or b.tokens < b.capacity}
+            if chat_id.startswith('-'):
+                bucket = TokenBucket(TELEGRAM_GROUP_RATE / 60, 3)
+            else:
+                bucket = TokenBucket(TELEGRAM_PRIVATE_RATE, 3)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def dispatch_loop(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                request, wait = None, self.global_bucket.get_wait(now) if self.queue else None
+                if wait == 0:
+                    for queued_request in self.queue: # A chat over its budget doesn't hold back other chats
+                        chat_wait = self.get_chat_bucket(queued_request.chat_id).get_wait(now)
+                        if chat_wait == 0:
+                            request = queued_request
+                            break
+                        wait = chat_wait if wait == 0 else min(wait, chat_wait)
+                if request is None:
+                    self.cond.wait(wait)
+                    continue
+                self.queue.remove(request)
+                self.global_bucket.tokens -= 1
+                self.get_chat_bucket(request.chat_id).tokens -= 1
+            self.executor.submit(self.run, request)
+
+    def run(self, request: OutboundRequest):
+        if request.future.cancelled(): return
+        request.attempts += 1
+        self.local.admitted = True
+        try:
+            result, error = request.func(*request.args, **request.kwargs), None
+        except BaseException as e:
+            result, error = None, e
+        finally:
+            # Reset before resolving the future, so its callbacks are rate limited again
+            self.local.admitted = False
+
+        if isinstance(error, ApiTelegramException) and error.error_code == 429 and request.attempts <= TELEGRAM_MAX_RETRIES:
+            self.pause(request.chat_id, error)
+            self.rewind_files(*request.args, *request.kwargs.values())
+            return self.put(request)
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            self.stats["sent"] += 1
+            request.future.set_result(result)
+
+    def pause(self, chat_id, error: ApiTelegramException):
+        self.stats["rate_limited"] += 1
+        retry_after = (error.result_json or {}).get("parameters", {}).get("retry_after", 1)
+        print(f"Telegram rate limit hit on chat {chat_id}, retrying after {retry_after}s")
+        with self.cond:
+            bucket = self.get_chat_bucket(str(chat_id))
+            bucket.paused_until = max(bucket.paused_until, time.monotonic() + retry_after)
+
+    @staticmethod
+    def rewind_files(*values):
+        # Uploads are read again by the retry
+        for value in values:
+            if not isinstance(value, dict): continue
+            for file in value.values():
+                file = file[1] if isinstance(file, tuple) and len(file) > 1 else file
+                if hasattr(file, "seek"):
+                    try: file.seek(0)
+                    except: pass
+
+outbound = TelegramOutbound()
@@ -0,0 +1,77 @@
+import os, ast, time, threading, traceback
+from telebot import types, TeleBot
+from auth_manager import AuthManager
+
+WARMUP_COMMANDS = os.environ.get("WARMUP_COMMANDS", '') # '' disables the warmup, '*' warms up every command
+WARMUP_RUNS = int(os.environ.get("WARMUP_RUNS", "2")) # The first run is the cold one, the following are warm
+WARMUP_IMAGE_SIZE = int(os.environ.get("WARMUP_IMAGE_SIZE", "512"))
+WARMUP_PROMPT = os.environ.get("WARMUP_PROMPT", "a photo")
+
+def get_literal(value: str, default=None):
+    # Input node arguments are kept as source code by preprocess
+    try: return ast.literal_eval(value)
+    except (ValueError, SyntaxError): return default
+
+def get_warmup_data(input_nodes: dict):
+    # Command arguments the input hooks accept, from the defaults written in the workflow
+    parsed_data = {"prompt": WARMUP_PROMPT}
+    for input_node in input_nodes.values():
+        class_name = input_node.class_name.strip("\"'")
+        argument_name = get_literal(input_node.arguments.get("argument_name", "''"), '')
+        if class_name == "AppIO_StringInput":
+            parsed_data[argument_name] = get_literal(input_node.arguments.get("string", "''"), '') or WARMUP_PROMPT
+        elif class_name == "AppIO_IntegerInput":
+            parsed_data[argument_name] = get_literal(input_node.arguments.get("integer", "0"), 0)
+    return parsed_data
+
+class WarmPool:
+    # Runs each workflow with synthetic inputs before the bot takes requests, so checkpoints and custom nodes are
+    # loaded and the outputs of the pinned loader nodes (PINNED_NODES) are in the node cache for the first user
+    results: dict[str, dict] = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get_commands(cls):
+        from preprocess import analyze_argument_from_preprocessed
+        commands = list(analyze_argument_from_preprocessed().keys())
+        if WARMUP_COMMANDS.strip() == '*': return commands
+        return [command for command in map(str.strip, WARMUP_COMMANDS.split(',')) if command in commands]
+
+    @classmethod
+    def warmup(cls, run_command):
+        # `run_command(command_name)` executes the workflow once. Returns the warm latencies by command
+        commands = cls.get_commands()
+        if len(commands) == 0: return {}
+        for command_name in commands:
+            result = {"runs": []}
+            for _ in range(max(WARMUP_RUNS, 1)):
+                start_time = time.perf_counter()
+                try:
+                    run_command(command_name)
+                except Exception as e:
+                    traceback.print_exc()
+                    result["error"] = str(e) or type(e).__name__
+                    break
+                result["runs"].append(time.perf_counter() - start_time)
+            with cls.lock: cls.results[command_name] = result
+        print(cls.report())
+        return {command_name: result["runs"][-1] for command_name, result in cls.results.items() if len(result["runs"]) > 1}
+
+    @classmethod
+    def report(cls):
+        with cls.lock:
+            if len(cls.results) == 0: return "Warmup: no command warmed up"
+            text = "Warmup latencies:\n"
+            for command_name, result in cls.results.items():
+                runs = result["runs"]
+                text += f"• `{command_name}`: "
+                if len(runs): text += f"cold {runs[0]:.2f}s"
+                if len(runs) > 1: text += f", warm {runs[-1]:.2f}s ({runs[0] / max(runs[-1], 1e-6):.1f}x)"
+                if "error" in result: text += f"{', ' if len(runs) else ''}failed: `{result['error']}`"
+                text += '\n'
+        return text.strip()
+
+    @classmethod
+    def admin(cls, bot: TeleBot, message: types.Message, parsed_data: dict):
+        if not AuthManager.check_admin(message, "get the warmup report"): return
+        bot.reply_to(message, cls.report(), parse_mode="Markdown")
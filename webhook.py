@@ -0,0 +1,99 @@
+import os, ssl, json, hmac, queue, secrets, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from telebot import types
+
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", '') # Public HTTPS URL Telegram posts updates to. Long polling is used when empty
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN", '') or secrets.token_urlsafe(32)
+WEBHOOK_SSL_CERT = os.environ.get("WEBHOOK_SSL_CERT", '') # Leave empty behind a TLS terminating proxy
+WEBHOOK_SSL_KEY = os.environ.get("WEBHOOK_SSL_KEY", '')
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1024"))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+SKIP_PENDING_UPDATES = int(os.environ.get("SKIP_PENDING_UPDATES", "1")) # Drop the updates sent while the bot was down
+ALLOWED_UPDATES = ["message", "callback_query"]
+UPDATE_BATCH_SIZE = 100
+
+class WebhookServer:
+    # Receives updates over HTTP. Requests without the secret token are refused and accepted updates wait in a
+    # bounded queue for a single thread handing them to the bot. When the queue is full Telegram gets a 503 and
+    # delivers the update again later, so a burst can't pile up in memory
+    def __init__(self, process_updates, secret_token=WEBHOOK_SECRET_TOKEN, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                 queue_size=WEBHOOK_QUEUE_SIZE, certfile=WEBHOOK_SSL_CERT, keyfile=WEBHOOK_SSL_KEY):
+        self.process_updates = process_updates
+        self.secret_token = secret_token.encode()
+        self.queue = queue.Queue(queue_size)
+        self.stats = {"accepted": 0, "rejected": 0, "unauthorized": 0}
+        self.server = ThreadingHTTPServer((listen, port), self.make_handler())
+        self.server.daemon_threads = True
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile or None)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+
+    def make_handler(self):
+        webhook = self
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.send_response(webhook.receive(self))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+        return WebhookHandler
+
+    def receive(self, request: BaseHTTPRequestHandler):
+        # Returns the HTTP status answered to Telegram
+        secret_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", '').encode()
+        if not hmac.compare_digest(secret_token, self.secret_token):
+            self.stats["unauthorized"] += 1
+            return 401
+        try:
+            update = json.loads(request.rfile.read(int(request.headers.get("Content-Length", 0))))
+        except ValueError:
+            return 400
+        try:
+            self.queue.put_nowait(update)
+        except queue.Full:
+            self.stats["rejected"] += 1
+            return 503
+        self.stats["accepted"] += 1
+        return 200
+
+    def consume_loop(self):
+        while True:
+            updates = [self.queue.get()]
+            while len(updates) < UPDATE_BATCH_SIZE:
+                try: updates.append(self.queue.get_nowait())
+                except queue.Empty: break
+            try:
+                self.process_updates([types.Update.de_json(update) for update in updates])
+            except Exception as e:
+                print(f"Can't process webhook updates: {e}")
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        threading.Thread(target=self.consume_loop, daemon=True).start()
+        print(f"Listening for webhook updates on {self.server.server_address[0]}:{self.server.server_address[1]}")
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def get_webhook_kwargs():
+    # Arguments of set_webhook, for TeleBot and AsyncTeleBot alike
+    certificate = None
+    if WEBHOOK_SSL_CERT:
+        with open(WEBHOOK_SSL_CERT, 'rb') as cert_file: certificate = cert_file.read()
+    return dict(
+        url=WEBHOOK_URL,
+        certificate=certificate,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=bool(SKIP_PENDING_UPDATES),
+        secret_token=WEBHOOK_SECRET_TOKEN
+    )
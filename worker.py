@@ -1,57 +1,169 @@
 import dotenv;dotenv.load_dotenv()
 
 from types import SimpleNamespace
-from PIL import Image
-import torch
-import numpy as np
 from io import BytesIO, StringIO
-from collections import deque
 import threading
-from backed_bot_utils import telegram_reply_to, get_username, handle_exception, get_dbm, all_logging_disabled, mention
+from backed_bot_utils import telegram_reply_to, get_username, handle_exception, get_dbm, all_logging_disabled, mention, get_message_file, TelegramFile
 import os, gc, inspect
 from telebot import types, TeleBot
-from tqdm import tqdm
 import schedule
 from pathlib import Path
-import cv2
-import tempfile
+import time, uuid, pickle, itertools, traceback
+from concurrent.futures import ThreadPoolExecutor, Future
+from media_codec import CodecPool, EncodedImage, VideoOptions, frames_to_tensor
+from result_cache import ResultCache
+from node_cache import NodeOutputCache
+from node_profiler import NodeProfiler
+from media_cache import MediaCache
+from prefetch import Prefetcher
+from scheduler import RequestScheduler
+from queue_broadcaster import QueueBroadcaster
+from telegram_outbound import outbound, PRIORITY_OUTPUT, PRIORITY_STATUS
+from broker import SqliteBroker, serve_broker, BROKER_ADDRESS, DONE
+from startup import Startup, READY, FAILED
+from warm_pool import WarmPool, WARMUP_IMAGE_SIZE, get_warmup_data
+from metrics import QUEUE_DEPTH, QUEUE_WAIT, COMMAND_DURATION
 
 NODES_TO_CACHE = os.environ.get("NODES_TO_CACHE", '')
-NODE_OUTPUT_CACHES = {}
+# Loader nodes (e.g. CheckpointLoaderSimple,LoraLoader) whose outputs stay in the node cache, never evicted
+PINNED_NODES = [el.strip() for el in os.environ.get("PINNED_NODES", '').split(',') if len(el.strip())]
 NODES_TO_TRACK_PBAR = os.environ.get("NODES_TO_TRACK_PBAR", '')
 TELEBOT_DEBUG = int(os.environ.get("TELEBOT_DEBUG", "0"))
 IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png").upper()
+WORKER_MODE = os.environ.get("WORKER_MODE", "local") # "local" or "broker"
+BROKER_MAX_INFLIGHT = int(os.environ.get("BROKER_MAX_INFLIGHT", "2"))
+BROKER_POLL_SECS = float(os.environ.get("BROKER_POLL_SECS", "0.5"))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "1"))
+BATCH_WAIT_MS = int(os.environ.get("BATCH_WAIT_MS", "0"))
+HOOKED_NODES = (
+    ["AppIO_StringInput", "AppIO_StringOutput", "AppIO_ImageInput", "AppIO_ImageOutput", "AppIO_IntegerInput", "AppIO_IntegerInput", "AppIO_ImageInputFromID"]
+    + [el.strip() for el in NODES_TO_CACHE.split(',')]
+    + PINNED_NODES
+)
 
 def get_full_image_id(user_id, image_id):
     return f"{user_id}:{image_id}"
 
-def read_video(byte_stream: BytesIO, suffix: str):
-   # Create a temporary file
-    temp_file = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)  
-    temp_path = temp_file.name  
+def get_video_options(command_name):
+    from preprocess import CommandConfig
+    return VideoOptions(**CommandConfig.get_video_options(command_name))
 
-    try:
-        # Write BytesIO content to the temp file and close it
-        temp_file.write(byte_stream.getvalue())
-        temp_file.close()  # Necessary for Windows!
+def decode_media(content: bytes, suffix: str, video_options: VideoOptions = None):
+    def convert(frames, fps):
+        tensor = frames_to_tensor(frames)
+        tensor.fps = fps # Kept with the cached tensor so video outputs can reuse the input frame rate
+        return tensor
+    return CodecPool.decode(content, suffix, convert, video_options)
 
-        # Open video using OpenCV
-        cap = cv2.VideoCapture(temp_path)
+def load_input_media(bot: TeleBot, file_id, file_unique_id=None, video_options: VideoOptions = None):
+    video_options = video_options or VideoOptions()
+    return MediaCache.get_tensor(
+        bot, file_id, lambda content, suffix: decode_media(content, suffix, video_options), file_unique_id,
+        '' if video_options == VideoOptions() else repr(video_options)
+    )
 
-        frames = []
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-            frames.append(frame)
+def load_hook_media(self, file_id, file_unique_id=None, video_options: VideoOptions = None):
+    prefetcher: Prefetcher = getattr(self, "prefetcher", None)
+    tensor = prefetcher.take(file_id, video_options) if prefetcher is not None else None
+    if tensor is None:
+        tensor = load_input_media(self.bot, file_id, file_unique_id, video_options)
+    return tensor
 
-        cap.release()
+def load_message_media(self, message: types.Message, video_options: VideoOptions = None):
+    media = get_message_file(message)
+    return load_hook_media(self, media.file_id, media.file_unique_id, video_options)
 
-    finally:
-        os.remove(temp_path)  # Clean up temp file. F.U. Windows
-    return torch.from_numpy(np.stack(frames, axis=0)) / 255.
+def get_message_key(message: types.Message):
+    return (message.chat.id, message.id)
+
+def reply_image_output(bot: TeleBot, message: types.Message, output, image_output_callback=None):
+    # `output` is an EncodedImage or, for cached results, a TelegramFile. Outputs go out before other messages
+    with outbound.priority(PRIORITY_OUTPUT):
+        if image_output_callback is not None:
+            return image_output_callback(output)
+        return telegram_reply_to(bot, message, output)
+
+# Outputs are encoded by the codec pool and sent from here, so the executor can move on to the next request
+output_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="output")
+
+def when_done(futures: list[Future], callback):
+    # Calls `callback()` once every future is done
+    remaining, lock = [len(futures)], threading.Lock()
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]: return
+        callback()
+    if len(futures) == 0: return callback()
+    for future in futures: future.add_done_callback(on_done)
+
+class CachedResultWriter:
+    # image_output_callback of requests whose result is cached. Outputs are staged as they're sent, the entry is
+    # published once the run succeeded and every output was delivered, and discarded otherwise
+    def __init__(self, bot: TeleBot, cache_key, message: types.Message, image_output_callback):
+        self.bot = bot
+        self.cache_key = cache_key
+        self.message = message
+        self.image_output_callback = image_output_callback
+        self.pending_key = ResultCache.stage()
+        self.output_idxs = itertools.count()
+        self.deliveries: list[Future] = []
+
+    def __call__(self, output: EncodedImage):
+        sent = reply_image_output(self.bot, self.message, output, self.image_output_callback)
+        telegram_file = sent if isinstance(sent, TelegramFile) else TelegramFile.from_message(sent) if isinstance(sent, types.Message) else None
+        ResultCache.put(self.pending_key, next(self.output_idxs), output, telegram_file)
+        return sent
+
+    def finish(self, succeeded):
+        def publish():
+            if succeeded and not any(delivery.exception() for delivery in self.deliveries):
+                ResultCache.publish(self.cache_key, self.pending_key)
+            else:
+                ResultCache.discard(self.pending_key)
+        when_done(self.deliveries, publish)
+
+def finish_cached_result(image_output_callback, succeeded):
+    if isinstance(image_output_callback, CachedResultWriter): image_output_callback.finish(succeeded)
+
+def get_input_arguments(command_name, class_name):
+    # Argument names of the input nodes of `class_name` in a command
+    from preprocess import analyze_argument_from_preprocessed
+    input_nodes = analyze_argument_from_preprocessed().get(command_name, {})
+    return [
+        input_node.arguments.get("argument_name", '').strip("\"'")
+        for input_node in input_nodes.values() if input_node.class_name.strip("\"'") == class_name
+    ]
+
+def resolve_image_ids(command_name, message: types.Message, parsed_data: dict):
+    # Executors on other hosts can't read the image_ids dbm, so send them Telegram file ids instead
+    with get_dbm("image_ids") as image_ids:
+        for argument_name in get_input_arguments(command_name, "AppIO_ImageInputFromID"):
+            _image_id = parsed_data.get(argument_name, '') or ''
+            image_id = get_full_image_id(message.from_user.id, _image_id)
+            if len(_image_id) and not _image_id.startswith("TG-") and image_id in image_ids:
+                parsed_data[argument_name] = "TG-" + image_ids[image_id]
+
+def get_input_file_ids(command_name, parsed_data: dict):
+    return [
+        parsed_data[argument_name][len("TG-"):]
+        for argument_name in get_input_arguments(command_name, "AppIO_ImageInputFromID")
+        if (parsed_data.get(argument_name, '') or '').startswith("TG-")
+    ]
+
+def create_hooks(self, command_name, message: types.Message, parsed_data: dict, image_output_callback, string_output_callback=None, async_output=True):
+    video_options = get_video_options(command_name)
+    source = SimpleNamespace(fps=None)
+    def load_input(tensor):
+        source.fps = source.fps or getattr(tensor, "fps", None)
+        return tensor
+
+    def reply_text(string):
+        if string_output_callback is not None:
+            string_output_callback(string)
+        else:
+            telegram_reply_to(self.bot, message, string)
 
-def create_hooks(self, message: types.Message, parsed_data: dict, image_output_callback):
     def handle_string_input(required, string, argument_name):
         if required and argument_name not in parsed_data:
             if argument_name == "prompt": raise RuntimeError("A prompt is required")
@@ -61,22 +173,12 @@ def create_hooks(self, message: types.Message, parsed_data: dict, image_output_c
     def handle_string_output(string):
         if len(string.strip()) == 0:
             raise RuntimeError(f"String passed to StringOutput node must not be empty")
-        telegram_reply_to(self.bot, message, string)
+        reply_text(string)
 
     def handle_image_input(**kwargs):
         if message.content_type not in ["photo", "video", "animation"]:
             raise RuntimeError(f"This command requires an image or video")
-        if message.content_type == "photo":
-            file_id = max(message.photo, key=lambda p:p.width).file_id
-        else:
-            file_id = getattr(message, message.content_type).file_id
-        file_info = self.bot.get_file(file_id)
-        byte_stream = BytesIO(self.bot.download_file(file_info.file_path))
-        if (suffix:=Path(file_info.file_path).suffix.lower()) in [".mp4", ".avi", ".mov", ".mkv"]:
-            return (read_video(byte_stream, suffix),)
-        else:
-            img = Image.open(byte_stream)
-            return (torch.from_numpy(np.array(img)[:, :, :3]/255.).unsqueeze(0),)
+        return (load_input(load_message_media(self, message, video_options)),)
     
     def handle_image_input_from_id(argument_name):
         _image_id = parsed_data.get(argument_name, '') or ''
@@ -84,60 +186,53 @@ def create_hooks(self, message: types.Message, parsed_data: dict, image_output_c
             raise RuntimeError(f"Argument --{argument_name} is required, with the value being image id")
         
         if _image_id.startswith("TG-"):
-            file_info = self.bot.get_file(_image_id[len("TG-"):])
+            file_id = _image_id[len("TG-"):]
         else:
             with get_dbm("image_ids") as image_ids:
                 image_id = get_full_image_id(message.from_user.id, _image_id)
                 if image_id not in image_ids:
                     raise RuntimeError(f"Image_id {_image_id} isn't set for user {get_username(message.from_user)} ({message.from_user.id}). Run `/set_image_id {_image_id}` with a photo")
                 file_id = image_ids[image_id]
-                file_info = self.bot.get_file(file_id)
-
-        byte_stream = BytesIO(self.bot.download_file(file_info.file_path))
-        if (suffix:=Path(file_info.file_path).suffix.lower()) in [".mp4", ".avi", ".mov", ".mkv"]:
-            return (read_video(byte_stream, suffix),)
-        else:
-            img = Image.open(byte_stream)
-            return (torch.from_numpy(np.array(img)[:, :, :3]/255.).unsqueeze(0),)
+        return (load_input(load_hook_media(self, file_id, None, video_options)),)
     
     def handle_image_output(image):
-        image = image[..., :3].cpu().numpy().__mul__(255.).astype(np.uint8)
-        image_pils = [Image.fromarray(img.squeeze(0)) for img in np.split(image, image.shape[0], axis=0)]
-        if image_output_callback is not None:
-            image_output_callback(image_pils)
-        else:
-            image_bytes = BytesIO()
-            image_pils[0].save(image_bytes, format=IMAGE_FORMAT if len(image_pils) == 1 else "GIF", save_all=True, append_images=image_pils[1:])
-            image_bytes.seek(0)
-            telegram_reply_to(self.bot, message, image_bytes)
+        encoded_future = CodecPool.encode(image, IMAGE_FORMAT, source.fps)
+        if not async_output:
+            return reply_image_output(self.bot, message, encoded_future.result(), image_output_callback)
+        def deliver():
+            try: reply_image_output(self.bot, message, encoded_future.result(), image_output_callback)
+            except:
+                handle_exception(self.bot, message)
+                raise # Keeps the partial result out of the result cache
+        delivery = output_executor.submit(deliver)
+        if isinstance(image_output_callback, CachedResultWriter): image_output_callback.deliveries.append(delivery)
     
     def handle_integer_input(required, integer, integer_min, integer_max, argument_name):
         if argument_name not in parsed_data:
             raise RuntimeError(f"Missing argument {argument_name}")
         if required and argument_name not in parsed_data:
             raise RuntimeError(f"Argument --{argument_name} is required")
+        integer = int(parsed_data.get(argument_name, integer))
         warning_msg = ''
         if integer < integer_min:
             warning_msg += f"The minium of --{argument_name} is {integer_min}. Changing to that value\n"
-        if integer > integer_min:
-            warning_msg += f"The maximum of --{argument_name} is {integer_min}. Changing to that value\n"
-        if len(warning_msg): telegram_reply_to(self.bot, message, warning_msg)
-        integer = int(parsed_data.get(argument_name, integer))
-        integer = max(integer_max, min(integer, integer_min))
+        if integer > integer_max:
+            warning_msg += f"The maximum of --{argument_name} is {integer_max}. Changing to that value\n"
+        if len(warning_msg): reply_text(warning_msg)
+        integer = min(max(integer, integer_min), integer_max)
         return (integer,)
     
     def handle_nodes_to_cache():
         class NodeProxy:
-            def __init__(self, node, class_name):
+            def __init__(self, node, class_name, pinned=False):
                 self.node = node
                 self.class_name = class_name
+                self.pinned = pinned
             
             def __call__(self, **kwargs):
-                key = f"{self.class_name}({kwargs})"
-                if key not in NODE_OUTPUT_CACHES:
-                    print(f"Caching node {key}...")
-                    NODE_OUTPUT_CACHES[key] = getattr(self.node, self.node.FUNCTION)(**kwargs)
-                return NODE_OUTPUT_CACHES[key]
+                return NodeOutputCache.get_or_compute(
+                    self.class_name, kwargs, lambda: getattr(self.node, self.node.FUNCTION)(**kwargs), self.pinned
+                )
 
             @property
             def hooker(self):
@@ -151,6 +246,11 @@ def create_hooks(self, message: types.Message, parsed_data: dict, image_output_c
                 continue
             node = self.NODE_CLASS_MAPPINGS[node_to_cache]()
             hooks[node_to_cache] = NodeProxy(node, node_to_cache).hooker
+        for node_to_pin in PINNED_NODES:
+            if node_to_pin not in self.NODE_CLASS_MAPPINGS:
+                not_installed_nodes.append(node_to_pin)
+                continue
+            hooks[node_to_pin] = NodeProxy(self.NODE_CLASS_MAPPINGS[node_to_pin](), node_to_pin, pinned=True).hooker
         if len(not_installed_nodes):
             raise NotImplementedError(f"The following nodes are not installed: {', '.join(not_installed_nodes)}")
         return hooks
@@ -162,93 +262,349 @@ def create_hooks(self, message: types.Message, parsed_data: dict, image_output_c
         "AppIO_ImageOutput": SimpleNamespace(execute=handle_image_output),
         "AppIO_IntegerInput": SimpleNamespace(execute=handle_integer_input),
         "AppIO_ImageInputFromID": SimpleNamespace(execute=handle_image_input_from_id),
+        "run_node": NodeOutputCache.run_node,
+        "run_hoisted_node": NodeOutputCache.run_hoisted_node,
         **handle_nodes_to_cache()
     }
 
+def create_batch_hooks(self, batch, image_tensors):
+    # Runs a workflow once for several compatible requests: their input images are stacked along the batch
+    # dimension and the output batch is split back evenly between the requesters
+    import torch
+    hooks_list = [
+        create_hooks(self, command_name, orig_message, parsed_data, image_output_callback)
+        for _, command_name, orig_message, parsed_data, image_output_callback in batch
+    ]
+    def handle_image_input(**kwargs):
+        return (torch.cat(image_tensors, dim=0),)
+
+    def handle_image_output(image):
+        if image.shape[0] % len(batch) != 0:
+            raise RuntimeError(f"Can't split an output batch of {image.shape[0]} images between {len(batch)} requests")
+        for hooks, chunk in zip(hooks_list, torch.chunk(image, len(batch), dim=0)):
+            hooks["AppIO_ImageOutput"].execute(chunk)
+
+    def fan_out(class_name):
+        # Text outputs and input warnings go to every requester. Their arguments are the same (see get_batch_key),
+        # so the inputs of the first request are used
+        def execute(*args, **kwargs):
+            return [hooks[class_name].execute(*args, **kwargs) for hooks in hooks_list][0]
+        return SimpleNamespace(execute=execute)
+
+    return {
+        **hooks_list[0],
+        **{class_name: fan_out(class_name) for class_name in ["AppIO_StringInput", "AppIO_IntegerInput", "AppIO_StringOutput"]},
+        "AppIO_ImageInput": SimpleNamespace(execute=handle_image_input),
+        "AppIO_ImageOutput": SimpleNamespace(execute=handle_image_output),
+    }
+
+def create_warmup_hooks(self, command_name):
+    # Synthetic inputs through the regular hooks: argument defaults of the workflow, a random image, no outputs
+    import torch
+    from preprocess import analyze_argument_from_preprocessed
+    parsed_data = get_warmup_data(analyze_argument_from_preprocessed().get(command_name, {}))
+    hooks = create_hooks(self, command_name, None, parsed_data, None, string_output_callback=lambda string: None)
+    def handle_image_input(**kwargs):
+        return (torch.rand(1, WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3),)
+
+    def discard_output(*args, **kwargs):
+        pass
+
+    return {
+        **hooks,
+        "AppIO_ImageInput": SimpleNamespace(execute=handle_image_input),
+        "AppIO_ImageInputFromID": SimpleNamespace(execute=handle_image_input),
+        "AppIO_ImageOutput": SimpleNamespace(execute=discard_output),
+        "AppIO_StringOutput": SimpleNamespace(execute=discard_output),
+    }
+
+def run_warmup_command(self, command_name):
+    import preprocessed
+    import comfy.model_management as mm
+    from comfy.utils import set_progress_bar_global_hook
+    try:
+        getattr(preprocessed, command_name)(self.NODE_CLASS_MAPPINGS, create_warmup_hooks(self, command_name))
+    finally:
+        set_progress_bar_global_hook(None)
+        gc.collect()
+        mm.soft_empty_cache()
+
 class Request:
-    def __init__(self, bot: TeleBot, index: int, queue_len: int, orig_message: types.Message, message: types.Message, data):
+    def __init__(self, bot: TeleBot, orig_message: types.Message, message: types.Message, data):
         self.bot = bot
-        self.index = index
-        self.queue_len = queue_len
         self.message = message
         self.data = data
         self.orig_message = orig_message
-        self.update_queue_job = schedule.every(2.5).seconds.do(self.update_queue)
-        self.update_queue_job.run()
-    
-    def update_queue(self):
-        if self.message is not None:
-            user = self.orig_message.from_user
-            text = f"{mention(user)} Queuing: `{self.queue_len - self.index}` people ahead ({self.index+1}/{self.queue_len})..."
-            rendered_text = f"@{get_username(user)} Queuing: {self.queue_len - self.index} people ahead ({self.index+1}/{self.queue_len})..."
-            if self.message.text != rendered_text:
-                self.message = self.bot.edit_message_text(
-                    text,
-                    self.message.chat.id, self.message.id, parse_mode="Markdown"
-                )
+        self.user_id = str(orig_message.from_user.id)
+        self.chat_id = str(orig_message.chat.id)
+        self.enqueue_time = time.time()
     
     def pop(self):
-        schedule.cancel_job(self.update_queue_job)
+        QUEUE_WAIT.observe(time.time() - self.enqueue_time, self.data[1])
+        # The queue broadcaster has already stopped updating the message. The edit isn't waited for, so the workflow
+        # doesn't wait for the chat's rate limit
         if self.message is not None:
-            self.message = self.bot.edit_message_text(
-                f"Executing...",
-                self.message.chat.id, self.message.id, parse_mode="Markdown"
+            outbound.submit(
+                self.message.chat.id, self.bot.edit_message_text, f"Executing...",
+                self.message.chat.id, self.message.id, parse_mode="Markdown", priority=PRIORITY_STATUS
             )
         return self.data
 
 class ComfyWorker:
     def __init__(self, bot: TeleBot):
-        self.request_queue: deque[Request] = deque()
+        self.request_queue = RequestScheduler()
         self.bot = bot
         self.node_pbar = None
         self.NODE_CLASS_MAPPINGS = {}
-        threading.Thread(target=self.loop_thread, daemon=True).start()
         self.execute_lock = threading.Lock()
-        self.executing_user_id = None
+        self.executing_user_ids = set()
+        self.queue_broadcaster = QueueBroadcaster(bot, BROKER_MAX_INFLIGHT if WORKER_MODE == "broker" else 1)
+        QUEUE_DEPTH.add(lambda: {(): len(self.request_queue)})
+        if WORKER_MODE == "broker":
+            self.broker = SqliteBroker()
+            self.broker.clear()
+            if len(BROKER_ADDRESS): serve_broker(self.broker)
+            self.pending_jobs = {}
+            self.inflight_slots = threading.Semaphore(BROKER_MAX_INFLIGHT)
+            threading.Thread(target=self.dispatch_thread, daemon=True).start()
+            threading.Thread(target=self.result_thread, daemon=True).start()
+            Startup.set_state(READY) # Executors warm up on their own
+        else:
+            self.prefetcher = Prefetcher(
+                lambda file_id, file_unique_id, video_options: load_input_media(self.bot, file_id, file_unique_id, video_options),
+                self.get_request_media,
+                lambda req: get_message_key(req.orig_message)
+            )
+            threading.Thread(target=self.loop_thread, daemon=True).start()
 
     def execute(self, command_name, message: types.Message, parsed_data, pbar_message: types.Message=None, image_output_callback=None):
+        cache_key = None
+        try:
+            resolve_image_ids(command_name, message, parsed_data)
+            if ResultCache.enabled(command_name):
+                cache_key = ResultCache.get_key(self.bot, command_name, message, parsed_data, get_input_file_ids(command_name, parsed_data))
+        except:
+            print(f"Can't compute result cache key of command {command_name}")
+        if cache_key is not None:
+            if self.send_cached_result(cache_key, message, image_output_callback): return
+            image_output_callback = CachedResultWriter(self.bot, cache_key, message, image_output_callback)
+
+        if Startup.state == FAILED:
+            return telegram_reply_to(self.bot, message, "The bot failed to start, commands can't be executed")
+        if pbar_message is None and not Startup.is_ready():
+            telegram_reply_to(self.bot, message, "The bot is warming up, your command will run as soon as it's ready")
+
         with self.execute_lock:
             user_id = str(message.from_user.id)
-            user_ids_in_queue = set([str(req.orig_message.from_user.id) for req in self.request_queue])
-            if user_id in user_ids_in_queue or user_id == self.executing_user_id:
+            user_ids_in_queue = set([req.user_id for req in self.request_queue])
+            if user_id in user_ids_in_queue or user_id in self.executing_user_ids:
                 if pbar_message is not None:
                     return self.bot.edit_message_text(
                         f"{mention(message.from_user)} Multiple simultaneous requests are not allowed", 
                         pbar_message.chat.id, pbar_message.id, parse_mode="Markdown"
                     )
             
-            self.request_queue.append(Request(
-                self.bot, len(self.request_queue), len(self.request_queue)+1, message, pbar_message, 
+            self.request_queue.put(Request(
+                self.bot, message, pbar_message, 
                 (pbar_message, command_name, message, parsed_data, image_output_callback)
             ))
+            self.update_queue_positions()
     
+    def send_cached_result(self, cache_key, message: types.Message, image_output_callback):
+        entry = ResultCache.get(cache_key)
+        if entry is None: return False
+        print(f"Sending cached result to @{get_username(message.from_user)} ({message.from_user.id})")
+        try:
+            for output_idx, cached_output in sorted(entry.outputs.items()):
+                if cached_output.telegram_file is not None:
+                    ResultCache.stats["resent_by_id"] += 1
+                    output = cached_output.telegram_file
+                else:
+                    output = ResultCache.load_output(cache_key, output_idx)
+                reply_image_output(self.bot, message, output, image_output_callback)
+        except:
+            handle_exception(self.bot, message)
+        return True
+
+    def update_queue_positions(self):
+        queued_requests = self.request_queue.snapshot()
+        self.queue_broadcaster.update(queued_requests)
+        if hasattr(self, "prefetcher"):
+            self.prefetcher.update(queued_requests)
+
+    def get_request_media(self, req: Request):
+        _, command_name, orig_message, parsed_data, _ = req.data
+        media, video_options = [], get_video_options(command_name)
+        if len(get_input_arguments(command_name, "AppIO_ImageInput")) and (media_file := get_message_file(orig_message)) is not None:
+            media.append((media_file.file_id, media_file.file_unique_id, video_options))
+        media += [(file_id, None, video_options) for file_id in get_input_file_ids(command_name, parsed_data)]
+        return media
+
+    def is_batchable(self, req: Request):
+        _, command_name, orig_message, parsed_data, _ = req.data
+        if orig_message.content_type != "photo": return False
+        if len(get_input_arguments(command_name, "AppIO_ImageInput")) != 1: return False
+        # Images from ids are shared by the whole batch, so only Telegram file ids (same file for everyone) qualify
+        for argument_name in get_input_arguments(command_name, "AppIO_ImageInputFromID"):
+            if not (parsed_data.get(argument_name, '') or '').startswith("TG-"): return False
+        return True
+
+    def get_batch_key(self, req: Request):
+        _, command_name, _, parsed_data, _ = req.data
+        return command_name, tuple(sorted(
+            (k, str(v).replace("''", '') if k == "prompt" else str(v))
+            for k, v in parsed_data.items() if k != "id"
+        ))
+
+    def get_batch(self):
+        curr_req = self.request_queue.get()
+        batch = [curr_req]
+        if MAX_BATCH_SIZE > 1 and self.is_batchable(curr_req):
+            batch_key = self.get_batch_key(curr_req)
+            batch += self.request_queue.take_matching(
+                lambda req: self.is_batchable(req) and self.get_batch_key(req) == batch_key,
+                MAX_BATCH_SIZE - 1, BATCH_WAIT_MS / 1000
+            )
+        for req in batch:
+            self.executing_user_ids.add(req.user_id)
+            self.prefetcher.claim(get_message_key(req.orig_message))
+        self.update_queue_positions()
+        return [req.pop() for req in batch]
+
+    def execute_batch(self, batch):
+        # Inputs whose size differs from the first image can't be stacked and are executed alone
+        image_tensors = []
+        for request_data in batch:
+            orig_message = request_data[2]
+            try:
+                image_tensors.append(load_message_media(self, orig_message, get_video_options(request_data[1])))
+            except:
+                handle_exception(self.bot, orig_message)
+                image_tensors.append(None)
+        stacked, alone = [], []
+        for request_data, image_tensor in zip(batch, image_tensors):
+            if image_tensor is None:
+                self.executing_user_ids.discard(str(request_data[2].from_user.id))
+                self.prefetcher.release(get_message_key(request_data[2]))
+                finish_cached_result(request_data[4], False)
+            elif len(stacked) == 0 or image_tensor.shape == stacked[0][1].shape:
+                stacked.append((request_data, image_tensor))
+            else:
+                alone.append(request_data)
+        if len(stacked) == 1:
+            alone.insert(0, stacked[0][0])
+        elif len(stacked) > 1:
+            print(f"Executing {len(stacked)} requests of command {stacked[0][0][1]} as one batch")
+            self.run_command(
+                [request_data for request_data, _ in stacked],
+                create_batch_hooks(self, [request_data for request_data, _ in stacked], [image_tensor for _, image_tensor in stacked])
+            )
+        for request_data in alone:
+            self.run_command([request_data], None)
+
+    def run_command(self, batch, hooks):
+        import preprocessed
+        import comfy.model_management as mm
+        from comfy.utils import set_progress_bar_global_hook
+        _, command_name, orig_message, parsed_data, image_output_callback = batch[0]
+        if hooks is None:
+            hooks = create_hooks(self, command_name, orig_message, parsed_data, image_output_callback)
+        start_time, succeeded = time.time(), False
+        try:
+            with NodeProfiler.profile(command_name, hooks) as hooks:
+                getattr(preprocessed, command_name)(self.NODE_CLASS_MAPPINGS, hooks)
+            self.queue_broadcaster.record_duration((time.time() - start_time) / len(batch))
+            COMMAND_DURATION.observe(time.time() - start_time, command_name, "ok")
+            succeeded = True
+            gc.collect()
+            mm.soft_empty_cache()
+        except:
+            COMMAND_DURATION.observe(time.time() - start_time, command_name, "error")
+            for _, _, orig_message, _, _ in batch:
+                handle_exception(self.bot, orig_message)
+        finally:
+            set_progress_bar_global_hook(None)
+            for _, _, orig_message, _, image_output_callback in batch:
+                finish_cached_result(image_output_callback, succeeded)
+                self.executing_user_ids.discard(str(orig_message.from_user.id))
+                self.prefetcher.release(get_message_key(orig_message))
+
     def get_request(self):
-        curr_req = self.request_queue.popleft()
-        self.executing_user_id = str(curr_req.orig_message.from_user.id)
-        for idx, req in enumerate(self.request_queue):
-            req.index = idx
-            req.queue_len = len(self.request_queue)
+        curr_req = self.request_queue.get()
+        self.executing_user_ids.add(curr_req.user_id)
+        self.update_queue_positions()
         return curr_req.pop()
 
     def loop_thread(self):
-        with all_logging_disabled():
-            import preprocessed
-            import comfy.model_management as mm
-            from comfy.utils import set_progress_bar_global_hook
-            self.NODE_CLASS_MAPPINGS = preprocessed.NODE_CLASS_MAPPINGS
+        try:
+            with all_logging_disabled(), Startup.phase("comfy import"):
+                import preprocessed
+                self.NODE_CLASS_MAPPINGS = preprocessed.NODE_CLASS_MAPPINGS
+        except:
+            traceback.print_exc()
+            return Startup.set_state(FAILED)
+        with Startup.phase("warmup"):
+            for seconds in WarmPool.warmup(lambda command_name: run_warmup_command(self, command_name)).values():
+                self.queue_broadcaster.record_duration(seconds)
+        Startup.set_state(READY)
             
         print("Telegram bot running, listening for all commands")
         while True:
-            if not self.request_queue: continue
+            batch = self.get_batch()
+            for _, _, _, parsed_data, _ in batch:
+                parsed_data["prompt"] = parsed_data["prompt"].replace("''", '')
+            if len(batch) == 1:
+                self.run_command(batch, None)
+            else:
+                self.execute_batch(batch)
+
+    def finish_job(self, orig_message: types.Message):
+        self.executing_user_ids.discard(str(orig_message.from_user.id))
+        self.inflight_slots.release()
+
+    def dispatch_thread(self):
+        print("Telegram bot running, dispatching commands to executors through the broker")
+        while True:
+            self.inflight_slots.acquire()
             pbar_message, command_name, orig_message, parsed_data, image_output_callback = self.get_request()
             parsed_data["prompt"] = parsed_data["prompt"].replace("''", '')
-            hooks = create_hooks(self, orig_message, parsed_data, image_output_callback)
+            job_id = uuid.uuid4().hex
             try:
-                getattr(preprocessed, command_name)(self.NODE_CLASS_MAPPINGS, hooks)
-                gc.collect()
-                mm.soft_empty_cache()
+                self.pending_jobs[job_id] = (command_name, orig_message, image_output_callback, time.time())
+                self.broker.submit(job_id, command_name, pickle.dumps({"message": orig_message.json, "parsed_data": parsed_data}))
             except:
+                self.pending_jobs.pop(job_id, None)
                 handle_exception(self.bot, orig_message)
-            finally:
-                set_progress_bar_global_hook(None)
-                self.executing_user_id = None
\ No newline at end of file
+                finish_cached_result(image_output_callback, False)
+                self.finish_job(orig_message)
+
+    def deliver_outputs(self, orig_message: types.Message, outputs, image_output_callback):
+        for output_type, output in outputs:
+            if output_type == "string":
+                telegram_reply_to(self.bot, orig_message, output)
+            else:
+                reply_image_output(self.bot, orig_message, output, image_output_callback)
+
+    def result_thread(self):
+        while True:
+            finished_jobs = self.broker.pop_finished()
+            if not finished_jobs:
+                time.sleep(BROKER_POLL_SECS)
+                continue
+            for job_id, status, result, error in finished_jobs:
+                if job_id not in self.pending_jobs: continue
+                command_name, orig_message, image_output_callback, dispatch_time = self.pending_jobs.pop(job_id)
+                COMMAND_DURATION.observe(time.time() - dispatch_time, command_name, "ok" if status == DONE else "error")
+                succeeded = False
+                try:
+                    if status == DONE:
+                        self.queue_broadcaster.record_duration(time.time() - dispatch_time)
+                        self.deliver_outputs(orig_message, pickle.loads(result), image_output_callback)
+                        succeeded = True
+                    else:
+                        handle_exception(self.bot, orig_message, error)
+                except:
+                    handle_exception(self.bot, orig_message)
+                finally:
+                    finish_cached_result(image_output_callback, succeeded)
+                    self.finish_job(orig_message)